@@ -11,6 +11,10 @@
 # 3. Set/modify the DI server name like this: di.fqdn = 'SERVER-NAME'
 # 4. Set/modify the DI REST API key like this: di.key = 'API-KEY'
 # 5. Invoke the REST API methods like this:  di.function_name(arg1, arg2)
+#    To work with more than one server at a time, create a client per server
+#    instead of steps 3 and 4, and invoke the same methods on it:
+#    client = di.DeepInstinctClient('SERVER-NAME', 'API-KEY')
+#    client.function_name(arg1, arg2)
 # 6. For testing and interactive usage, I use and recommend Jupyter Notebook,
 #    which is installed as part of Anaconda (https://www.anaconda.com/)
 #
@@ -29,27 +33,925 @@ debug_mode = False
 quiet_mode = False
 
 # Import various libraries used by one or more method below.
-import requests, json, datetime, pandas, re, ipaddress, time, os, hashlib
+import requests, json, datetime, pandas, re, ipaddress, time, os, hashlib, threading, contextlib, functools, asyncio, random, email.utils, collections, urllib.parse, queue, concurrent.futures, sqlite3, bisect, socket, math, numpy, csv, gzip, itertools, urllib3, pickle, tempfile
 #If any of the above throw import errors, try running 'pip install library_name'
 #If that doesn't fix the problem I recommend to search Google for the error
 #that you are getting.
 
-# Export Device List to disk in Excel format
-def export_devices(include_deactivated=False):
-    #get the devices from server
-    devices = get_devices(include_deactivated=include_deactivated)
-    #convert to Pandas Data Frame
-    devices_df = pandas.DataFrame(devices)
-    #calculate timestamp
-    timestamp = datetime.datetime.today().strftime('%Y-%m-%d_%H.%M')
-    #calculate folder name
+# HTTP transport settings, used by every request made by the methods below.
+# Requests to a server share one requests.Session with a keep-alive connection
+# pool, so bulk operations reuse TCP/TLS connections instead of doing a new
+# handshake for every page of data. Modify these like di.pool_maxsize = 64,
+# then call di.reset_session() if any request has already been made.
+pool_connections = 10      #number of distinct servers to keep a pool for
+pool_maxsize = 32          #maximum keep-alive connections kept per server
+pool_block = False         #if True, wait for a free connection instead of opening an extra one
+connect_timeout = 10       #seconds to wait for a connection to be established
+read_timeout = 60          #seconds to wait for the server to send data
+verify_tls = True          #True, False, or path to a CA bundle file
+client_certificate = None  #optional path to a client cert, or (cert, key) tuple
+
+
+# Decides which failed requests are retried and how long to wait in between.
+# Connection errors, timeouts and the statuses in retry_statuses (throttling
+# and gateway errors) are retried with exponential backoff and full jitter,
+# honouring any Retry-After header sent by the server. Each request gets at
+# most max_attempts tries and max_total_delay seconds of waiting; after that
+# the last response is returned (or the last exception raised) to the caller.
+#
+# Only the idempotent methods in retry_methods, and requests to the paths in
+# retry_paths (POST endpoints that only read data, such as the event search),
+# are retried in all of these cases. Other requests (POST creates policies,
+# users, tenants, ...) may have been applied by the server before a timeout or
+# gateway error, so they are only retried when the connection could not be
+# established (the request never reached the server) or on 429/503 with a
+# Retry-After header.
+class RetryPolicy:
+
+    def __init__(self, max_attempts=6, backoff_base=1, backoff_max=30, max_total_delay=120,
+            retry_statuses=(429, 502, 503, 504), jitter=True, retry_methods=('GET', 'HEAD', 'PUT', 'DELETE'),
+            retry_paths=(r'/api/v1/events/search', r'/api/v1/suspicious-events/search')):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_total_delay = max_total_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self.jitter = jitter
+        self.retry_methods = frozenset(method.upper() for method in retry_methods)
+        self.retry_paths = tuple(retry_paths)
+        self._retry_path_patterns = [re.compile(path) for path in self.retry_paths]
+
+    def __repr__(self):
+        return (f'RetryPolicy(max_attempts={self.max_attempts}, backoff_base={self.backoff_base}, '
+            f'backoff_max={self.backoff_max}, max_total_delay={self.max_total_delay}, '
+            f'retry_statuses={sorted(self.retry_statuses)}, jitter={self.jitter}, '
+            f'retry_methods={sorted(self.retry_methods)}, retry_paths={list(self.retry_paths)})')
+
+    # True if a request with this method (to request_url, if given) may be sent
+    # again whatever happened to the previous attempt
+    def is_idempotent(self, method, request_url=None):
+        if method.upper() in self.retry_methods:
+            return True
+        if request_url is None:
+            return False
+        path = urllib.parse.urlsplit(request_url).path.rstrip('/')
+        return any(pattern.fullmatch(path) for pattern in self._retry_path_patterns)
+
+    def is_retryable_status(self, status_code, method='GET', retry_after=None, request_url=None):
+        if status_code not in self.retry_statuses:
+            return False
+        if self.is_idempotent(method, request_url):
+            return True
+        return status_code in (429, 503) and retry_after is not None
+
+    # SSL errors (for example a failed certificate check) will not go away by
+    # trying again, so only plain connection errors and timeouts are retried
+    def is_retryable_exception(self, exception, method='GET', request_url=None):
+        if isinstance(exception, requests.exceptions.SSLError):
+            return False
+        if not self.is_idempotent(method, request_url):
+            return _connection_not_established(exception)
+        return isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    # Seconds to wait before retry number attempt (0 = first retry)
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    # Returns the delay to wait before the next attempt, or None if the retry
+    # budget for this request has been used up
+    def next_delay(self, attempt, waited, retry_after=None):
+        if attempt + 1 >= self.max_attempts:
+            return None
+        delay = self.delay(attempt, retry_after)
+        if waited + delay > self.max_total_delay:
+            return None
+        return delay
+
+
+# True if a requests exception means the connection to the server could not be
+# opened, so the request was never sent
+def _connection_not_established(exception):
+    if isinstance(exception, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exception, requests.exceptions.ConnectionError) and len(exception.args) > 0:
+        reason = getattr(exception.args[0], 'reason', exception.args[0])
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+    return False
+
+
+# Parses a Retry-After header (seconds or HTTP date) into seconds, or None
+def _retry_after_seconds(headers):
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+retry_policy = RetryPolicy()  #used by every request; replace to change retry behavior
+
+
+# Client-side rate limiting, applied per server (fqdn) across every client and
+# thread in this process. Requests wait for a token from a token bucket that
+# refills at rate_limit requests per second, and at most max_in_flight
+# requests to a server are outstanding at once. With adaptive_rate_limit, a
+# throttling response (429) halves the allowed rate, which then climbs back
+# gradually, so bulk jobs settle near the highest rate the server tolerates
+# instead of triggering retry storms. Modify these like di.rate_limit = 20,
+# then call di.reset_rate_limiters() if any request has already been made.
+rate_limit = None           #max requests per second per server; None for no limit
+rate_limit_burst = 10       #requests that may be sent back-to-back before rate_limit applies
+max_in_flight = None        #max concurrent requests per server; None for no limit
+adaptive_rate_limit = True  #lower the rate when the server throttles, then slowly raise it again
+
+
+class RateLimiter:
+
+    def __init__(self, rate=None, burst=10, max_in_flight=None, adaptive=True,
+            min_rate=0.5, recovery_rate=0.5, window=10):
+        self.max_rate = rate              #configured ceiling (None = unlimited)
+        self.rate = rate                  #currently allowed rate (None = unlimited)
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.recovery_rate = recovery_rate  #requests/sec regained per second after throttling
+        self.window = window              #seconds of history used for current_rate
+        self.throttle_count = 0
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._throttled_at = None
+        self._throttled_rate = None
+        self._in_flight = 0
+        self._sent = collections.deque()
+        self._lock = threading.Lock()
+        self._slot_available = threading.Condition(self._lock)
+        self._async_waiters = collections.deque()
+
+    def __repr__(self):
+        return (f'RateLimiter(rate={self.rate}, max_in_flight={self.max_in_flight}, '
+            f'current_rate={self.current_rate:.2f}, in_flight={self.in_flight})')
+
+    # Observed requests per second sent over the last window seconds
+    @property
+    def current_rate(self):
+        with self._lock:
+            now = time.monotonic()
+            self._expire_history(now)
+            return self._observed_rate(now)
+
+    def _observed_rate(self, now):
+        if not self._sent:
+            return 0.0
+        return len(self._sent) / min(self.window, max(1, now - self._sent[0]))
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _expire_history(self, now):
+        while self._sent and self._sent[0] < now - self.window:
+            self._sent.popleft()
+
+    # Raises the allowed rate back towards max_rate after throttling
+    def _recover(self, now):
+        if self._throttled_at is None:
+            return
+        rate = self._throttled_rate + self.recovery_rate * (now - self._throttled_at)
+        if self.max_rate is not None and rate >= self.max_rate:
+            self.rate = self.max_rate
+            self._throttled_at = None
+        else:
+            self.rate = rate
+
+    # Takes a token and returns how many seconds the caller must wait before
+    # sending. Tokens may go negative, which queues callers fairly.
+    def _reserve(self, now):
+        self._recover(now)
+        self._expire_history(now)
+        self._sent.append(now)
+        if self.rate is None:
+            return 0
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    # Blocks until a request may be sent; pair with release(). If the caller is
+    # interrupted while waiting for its token the slot is given back here.
+    def acquire(self):
+        with self._slot_available:
+            while self.max_in_flight is not None and self._in_flight >= self.max_in_flight:
+                self._slot_available.wait()
+            self._in_flight += 1
+            delay = self._reserve(time.monotonic())
+        try:
+            if delay > 0:
+                time.sleep(delay)
+        except BaseException:
+            self.release()
+            raise
+
+    # Same as acquire(), for use from asyncio code. Waiting coroutines park on a
+    # future that release() resolves from whichever thread frees the slot.
+    async def acquire_async(self):
+        while True:
+            with self._lock:
+                if self.max_in_flight is None or self._in_flight < self.max_in_flight:
+                    self._in_flight += 1
+                    delay = self._reserve(time.monotonic())
+                    break
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except BaseException:
+                with self._lock:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    elif waiter.done() and not waiter.cancelled():
+                        #woken but not going to use the slot; pass it on
+                        self._wake_async_waiter()
+                raise
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.release()
+            raise
+
+    # Must be called with _lock held
+    def _wake_async_waiter(self):
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._resolve_waiter, waiter)
+                return
+            except RuntimeError:
+                #event loop already closed
+                continue
+
+    def _resolve_waiter(self, waiter):
+        if waiter.done():
+            #cancelled after being picked; wake the next one instead
+            with self._lock:
+                self._wake_async_waiter()
+        else:
+            waiter.set_result(None)
+
+    def release(self):
+        with self._slot_available:
+            self._in_flight -= 1
+            self._slot_available.notify()
+            self._wake_async_waiter()
+
+    # Feeds a response status back into the limiter
+    def record(self, status_code):
+        if status_code != 429 or not self.adaptive:
+            return
+        with self._lock:
+            now = time.monotonic()
+            #several requests in flight are usually throttled together; only
+            #count that as one event
+            if self._throttled_at is not None and now - self._throttled_at < 1:
+                return
+            self._expire_history(now)
+            rate = self.rate if self.rate is not None else self._observed_rate(now)
+            self._throttled_rate = max(self.min_rate, rate / 2)
+            self._throttled_at = now
+            self.rate = self._throttled_rate
+            self._tokens = min(self._tokens, 0)
+            self.throttle_count += 1
+        if not quiet_mode:
+            print(f'WARNING: Server is throttling requests. Lowered rate limit to {self._throttled_rate:.2f} requests/sec.')
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+# Returns the RateLimiter for a server, creating it from the module settings
+# on first use. Defaults to the server of the active client.
+def get_rate_limiter(server=None):
+    if server is None:
+        server = _active_client().fqdn
+    with _rate_limiters_lock:
+        if server not in _rate_limiters:
+            _rate_limiters[server] = RateLimiter(rate=rate_limit, burst=rate_limit_burst,
+                max_in_flight=max_in_flight, adaptive=adaptive_rate_limit)
+        return _rate_limiters[server]
+
+
+# Discards all rate limiters, so that new ones are built with the current
+# values of the rate limit settings
+def reset_rate_limiters():
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
+
+
+# Per-endpoint request instrumentation. Every request made by a client is
+# recorded under its method and endpoint template (ids and hashes in the path
+# are replaced by {id} and {hash}, the query string is dropped), with status,
+# latency histogram, bytes sent and received, retries, and time spent waiting
+# on the rate limiter and retry backoff. Comparing request latency with wait
+# time and the caller's own run time shows whether a slow job is bound by the
+# server or by the client. Examples:
+#   di.get_metrics().summary()                       #list of dicts, one per endpoint
+#   di.get_metrics().write_prometheus('/var/lib/node_exporter/di.prom')
+#   di.get_metrics().write_json('metrics.json')
+class RequestMetrics:
+
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self._series = {}     #(server, method, endpoint, status) -> counters and histogram
+        self._endpoints = {}  #(server, method, endpoint) -> retries and wait time
+        self._lock = threading.Lock()
+
+    # Converts a request URL into (server, endpoint template), for example
+    # ('foo.customers.deepinstinctweb.com', '/api/v1/policies/{id}/allow-list/hashes')
+    @staticmethod
+    def endpoint_template(request_url):
+        url = urllib.parse.urlsplit(request_url)
+        segments = []
+        for segment in (url.path.rstrip('/') or '/').split('/'):
+            if segment.isdigit():
+                segment = '{id}'
+            elif re.fullmatch(r'[0-9a-fA-F]{32,128}', segment):
+                segment = '{hash}'
+            segments.append(segment)
+        return url.netloc, '/'.join(segments)
+
+    # Records one HTTP attempt. status is None when an exception was raised.
+    def record(self, method, request_url, status, latency, bytes_out=0, bytes_in=0):
+        server, endpoint = self.endpoint_template(request_url)
+        key = (server, method, endpoint, 'exception' if status is None else status)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {'count': 0, 'latency_sum': 0.0, 'latency_max': 0.0, 'bytes_out': 0, 'bytes_in': 0,
+                    'buckets': [0] * len(self.latency_buckets)}
+                self._series[key] = series
+            series['count'] += 1
+            series['latency_sum'] += latency
+            series['latency_max'] = max(series['latency_max'], latency)
+            series['bytes_out'] += bytes_out
+            series['bytes_in'] += bytes_in
+            for index, bound in enumerate(self.latency_buckets):
+                if latency <= bound:
+                    series['buckets'][index] += 1
+                    break
+
+    # Records a retry of a request, and/or time spent waiting before sending
+    def record_wait(self, method, request_url, seconds, retry=False):
+        server, endpoint = self.endpoint_template(request_url)
+        key = (server, method, endpoint)
+        with self._lock:
+            endpoint = self._endpoints.setdefault(key, {'retries': 0, 'wait_seconds': 0.0})
+            endpoint['wait_seconds'] += seconds
+            if retry:
+                endpoint['retries'] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self._endpoints.clear()
+
+    # Estimates a latency percentile (0-100) from histogram bucket counts
+    def _percentile(self, buckets, count, percentile, latency_max):
+        if count == 0:
+            return None
+        target = count * percentile / 100
+        seen = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.latency_buckets, buckets):
+            if bucket_count and seen + bucket_count >= target:
+                upper = min(bound, latency_max)
+                return lower + (upper - lower) * (target - seen) / bucket_count
+            seen += bucket_count
+            lower = bound
+        return latency_max
+
+    # Returns one dict per server, method and endpoint, busiest first
+    def summary(self):
+        with self._lock:
+            grouped = {}
+            for (server, method, endpoint, status), series in self._series.items():
+                row = grouped.setdefault((server, method, endpoint), {'server': server, 'method': method, 'endpoint': endpoint,
+                    'count': 0, 'statuses': {}, 'latency_sum': 0.0, 'latency_max': 0.0,
+                    'bytes_out': 0, 'bytes_in': 0, 'buckets': [0] * len(self.latency_buckets)})
+                row['count'] += series['count']
+                row['statuses'][status] = series['count']
+                row['latency_sum'] += series['latency_sum']
+                row['latency_max'] = max(row['latency_max'], series['latency_max'])
+                row['bytes_out'] += series['bytes_out']
+                row['bytes_in'] += series['bytes_in']
+                row['buckets'] = [a + b for a, b in zip(row['buckets'], series['buckets'])]
+            rows = []
+            for key, row in grouped.items():
+                endpoint = self._endpoints.get(key, {'retries': 0, 'wait_seconds': 0.0})
+                buckets = row.pop('buckets')
+                row['latency_mean'] = row['latency_sum'] / row['count']
+                row['latency_p50'] = self._percentile(buckets, row['count'], 50, row['latency_max'])
+                row['latency_p95'] = self._percentile(buckets, row['count'], 95, row['latency_max'])
+                row['retries'] = endpoint['retries']
+                row['wait_seconds'] = endpoint['wait_seconds']
+                rows.append(row)
+        rows.sort(key=lambda row: row['count'], reverse=True)
+        return rows
+
+    # Returns totals across all endpoints
+    def totals(self):
+        totals = {'requests': 0, 'statuses': {}, 'retries': 0, 'latency_sum': 0.0, 'wait_seconds': 0.0,
+            'bytes_out': 0, 'bytes_in': 0}
+        for row in self.summary():
+            totals['requests'] += row['count']
+            for status, count in row['statuses'].items():
+                totals['statuses'][status] = totals['statuses'].get(status, 0) + count
+            for field in ('retries', 'latency_sum', 'wait_seconds', 'bytes_out', 'bytes_in'):
+                totals[field] += row[field]
+        return totals
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=4, default=str)
+
+    # Returns metrics in Prometheus text exposition format
+    def to_prometheus(self):
+        def labels(**values):
+            return '{' + ','.join(f'{name}="{value}"' for name, value in values.items()) + '}'
+        lines = [
+            '# HELP deepinstinct_requests_total Requests sent to the Deep Instinct REST API.',
+            '# TYPE deepinstinct_requests_total counter',
+        ]
+        with self._lock:
+            series_items = sorted(self._series.items(), key=lambda item: str(item[0]))
+            endpoint_items = sorted(self._endpoints.items())
+        for (server, method, endpoint, status), series in series_items:
+            lines.append(f'deepinstinct_requests_total{labels(server=server, method=method, endpoint=endpoint, status=status)} {series["count"]}')
+        lines += ['# HELP deepinstinct_request_duration_seconds Request latency.',
+            '# TYPE deepinstinct_request_duration_seconds histogram']
+        for (server, method, endpoint, status), series in series_items:
+            cumulative = 0
+            for bound, count in zip(self.latency_buckets, series['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'deepinstinct_request_duration_seconds_bucket{labels(server=server, method=method, endpoint=endpoint, status=status, le=le)} {cumulative}')
+            lines.append(f'deepinstinct_request_duration_seconds_sum{labels(server=server, method=method, endpoint=endpoint, status=status)} {series["latency_sum"]}')
+            lines.append(f'deepinstinct_request_duration_seconds_count{labels(server=server, method=method, endpoint=endpoint, status=status)} {series["count"]}')
+        for name, field, help_text in (('deepinstinct_request_bytes_total', 'bytes_out', 'Bytes sent in request bodies.'),
+                ('deepinstinct_response_bytes_total', 'bytes_in', 'Bytes received in response bodies.')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (server, method, endpoint, status), series in series_items:
+                lines.append(f'{name}{labels(server=server, method=method, endpoint=endpoint, status=status)} {series[field]}')
+        for name, field, help_text in (('deepinstinct_request_retries_total', 'retries', 'Requests retried.'),
+                ('deepinstinct_request_wait_seconds_total', 'wait_seconds', 'Time spent waiting on rate limiting and retry backoff.')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (server, method, endpoint), values in endpoint_items:
+                lines.append(f'{name}{labels(server=server, method=method, endpoint=endpoint)} {values[field]}')
+        return '\n'.join(lines) + '\n'
+
+    # Writes to a file atomically, so a Prometheus textfile collector never
+    # reads a partial file
+    def _write(self, path, text):
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(text)
+        os.replace(temporary_path, path)
+        return path
+
+    def write_prometheus(self, path):
+        return self._write(path, self.to_prometheus())
+
+    def write_json(self, path):
+        return self._write(path, self.to_json())
+
+
+# Length in bytes of a request body as sent by requests
+def _body_length(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+_transport_settings = ('pool_connections', 'pool_maxsize', 'pool_block',
+    'connect_timeout', 'read_timeout', 'verify_tls', 'client_certificate', 'retry_policy')
+
+
+# A DeepInstinctClient holds everything needed to talk to one server: the
+# server name and API key, its own connection pool, caches and metrics. The
+# methods in this module run against the "active" client, which is the one
+# activated on the current thread or else the default client. The default
+# client follows di.fqdn and di.key, so existing scripts keep working as-is.
+#
+# To work with several servers at once (including from multiple threads),
+# create one client per server and call the module methods through it:
+#   source = di.DeepInstinctClient('foo.customers.deepinstinctweb.com', 'API-KEY')
+#   policies = source.get_policies(include_policy_data=True)
+# or activate it for a block of code on the current thread:
+#   with source.activate():
+#       devices = di.get_devices()
+#
+# Transport settings passed to the constructor override the module-level
+# values above for this client only; settings not passed follow the module.
+class DeepInstinctClient:
+
+    def __init__(self, fqdn=None, key=None, **transport_settings):
+        for name in transport_settings:
+            if name not in _transport_settings:
+                raise TypeError(f'Unknown transport setting {name}')
+        self._fqdn = fqdn
+        self._key = key
+        self._transport_settings = transport_settings
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.cache = {}  #per-server cached data, keyed by cache name
+        self.metrics = RequestMetrics()
+
+    def __repr__(self):
+        return f'DeepInstinctClient({self.fqdn!r})'
+
+    # Server name; a client created without one follows di.fqdn
+    @property
+    def fqdn(self):
+        if self._fqdn is None:
+            return globals().get('fqdn')
+        return self._fqdn
+
+    @fqdn.setter
+    def fqdn(self, value):
+        self._fqdn = value
+
+    # API key; a client created without one follows di.key
+    @property
+    def key(self):
+        if self._key is None:
+            return globals().get('key')
+        return self._key
+
+    @key.setter
+    def key(self, value):
+        self._key = value
+
+    # Returns the value of a transport setting for this client
+    def setting(self, name):
+        if name in self._transport_settings:
+            return self._transport_settings[name]
+        return globals()[name]
+
+    # Returns this client's requests.Session, creating it on first use
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.setting('pool_connections'),
+                    pool_maxsize=self.setting('pool_maxsize'), pool_block=self.setting('pool_block'))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    # Closes pooled connections. The next request builds a new session using
+    # the current transport settings.
+    def reset_session(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+    def close(self):
+        self.reset_session()
+
+    # Sends a request over this client's session, retrying transient failures
+    # as allowed by the retry policy. Cached data that a write may have changed
+    # is dropped once the write completes.
+    def request(self, method, request_url, **kwargs):
+        try:
+            return self._send(method, request_url, **kwargs)
+        finally:
+            if method.upper() != 'GET':
+                self._invalidate_caches(request_url)
+
+    # Drops cached data that a write to request_url may have changed
+    def _invalidate_caches(self, request_url):
+        path = urllib.parse.urlsplit(request_url).path
+        if re.match(r'/api/v1/(devices|groups)(/|$)', path):
+            for cached in list(self.cache.values()):
+                if isinstance(cached, DeviceInventory):
+                    cached.invalidate()
+        match = re.match(r'/api/v1/policies(?:/(\d+))?(/[^?]*)?$', path.rstrip('/'))
+        if match:
+            for cached in list(self.cache.values()):
+                if isinstance(cached, PolicyCache):
+                    if match.group(1) is not None:
+                        cached.invalidate(int(match.group(1)))  #data or lists of this policy changed
+                    if match.group(1) is None or match.group(2) is None:
+                        cached.invalidate(None)  #a policy was created, renamed or deleted
+
+    def _send(self, method, request_url, **kwargs):
+        kwargs.setdefault('timeout', (self.setting('connect_timeout'), self.setting('read_timeout')))
+        #TLS settings are passed per request because requests lets environment
+        #variables such as REQUESTS_CA_BUNDLE override session-level values
+        kwargs.setdefault('verify', self.setting('verify_tls'))
+        kwargs.setdefault('cert', self.setting('client_certificate'))
+        policy = self.setting('retry_policy')
+        limiter = get_rate_limiter(urllib.parse.urlsplit(request_url).netloc)
+        attempt = 0
+        waited = 0
+        while True:
+            if debug_mode:
+                print('DEBUG:', method, request_url)
+            wait_start = time.perf_counter()
+            limiter.acquire()
+            try:
+                start = time.perf_counter()
+                self.metrics.record_wait(method, request_url, start - wait_start)
+                response = self.session.request(method, request_url, **kwargs)
+                exception = None
+            except requests.exceptions.RequestException as e:
+                response = None
+                exception = e
+            finally:
+                limiter.release()
+            latency = time.perf_counter() - start
+            if response is not None:
+                self.metrics.record(method, request_url, response.status_code, latency,
+                    _body_length(response.request.body), len(response.content))
+                limiter.record(response.status_code)
+                retry_after = _retry_after_seconds(response.headers)
+                if not policy.is_retryable_status(response.status_code, method, retry_after, request_url):
+                    return response
+                delay = policy.next_delay(attempt, waited, retry_after)
+                reason = f'return code {response.status_code}'
+            else:
+                self.metrics.record(method, request_url, None, latency)
+                delay = None
+                if policy.is_retryable_exception(exception, method, request_url):
+                    delay = policy.next_delay(attempt, waited)
+                reason = type(exception).__name__
+            if delay is None:
+                if exception is not None:
+                    raise exception
+                return response
+            if not quiet_mode:
+                print('WARNING:', reason, 'on', method, request_url, f'. Retrying in {delay:.1f} seconds.')
+            time.sleep(delay)
+            self.metrics.record_wait(method, request_url, delay, retry=True)
+            waited += delay
+            attempt += 1
+
+    # Makes this the active client on the current thread for a block of code
+    @contextlib.contextmanager
+    def activate(self):
+        previous = getattr(_context, 'client', None)
+        _context.client = self
+        try:
+            yield self
+        finally:
+            _context.client = previous
+
+    # Exposes the module methods (get_devices, get_events, ...) on the client,
+    # each running with this client active
+    def __getattr__(self, name):
+        function = globals().get(name)
+        if name.startswith('_') or not callable(function) or isinstance(function, type):
+            raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+        @functools.wraps(function)
+        def bound_method(*args, **kwargs):
+            with self.activate():
+                return function(*args, **kwargs)
+        return bound_method
+
+
+_context = threading.local()
+_default_client = DeepInstinctClient()
+
+
+# Returns the client that methods in this module should use on this thread
+def _active_client():
+    client = getattr(_context, 'client', None)
+    if client is None:
+        return _default_client
+    return client
+
+
+# Returns the server name and API key of the active client
+def _credentials():
+    client = _active_client()
+    return client.fqdn, client.key
+
+
+# Wraps func so that it runs with the current thread's active client, for use
+# when handing work to another thread
+def _with_active_client(func):
+    client = _active_client()
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with client.activate():
+            return func(*args, **kwargs)
+    return run
+
+
+# Returns the RequestMetrics of the active client
+def get_metrics():
+    return _active_client().metrics
+
+
+# Writes request metrics of the active client to the export folder, in
+# Prometheus text format ('prometheus') or as JSON ('json')
+def export_metrics(file_format='prometheus'):
+    fqdn, key = _credentials()
+    metrics = get_metrics()
     folder_name = create_export_folder()
-    #calculate file name
-    file_name = f'device_list_{timestamp}_{fqdn.split(".",1)[0]}.xlsx'
-    #write data to disk
-    devices_df.to_excel(f'{folder_name}/{file_name}', index=False)
+    timestamp = datetime.datetime.today().strftime('%Y-%m-%d_%H.%M')
+    if file_format == 'json':
+        file_name = metrics.write_json(f'{folder_name}/request_metrics_{timestamp}_{fqdn.split(".",1)[0]}.json')
+    else:
+        file_name = metrics.write_prometheus(f'{folder_name}/request_metrics_{timestamp}_{fqdn.split(".",1)[0]}.prom')
+    print('INFO: Request metrics exported to', file_name)
+    return file_name
+
+
+# Decorator for generator functions in this module. A generator body runs
+# lazily, possibly after the client that created it is no longer active (for
+# example client.iter_events() returns before any request is made), so this
+# captures the active client when the generator is created and activates it
+# around every step.
+def _client_bound_generator(generator_function):
+    @functools.wraps(generator_function)
+    def wrapper(*args, **kwargs):
+        client = _active_client()
+        generator = generator_function(*args, **kwargs)
+        def run():
+            try:
+                while True:
+                    with client.activate():
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                    yield item
+            finally:
+                with client.activate():
+                    generator.close()
+        return run()
+    return wrapper
+
+
+# Number of pages that iter_events, iter_devices, get_events and get_devices
+# request ahead in a background thread while the caller works on the current
+# page. 0 disables prefetching. Can also be set per call with prefetch=N.
+prefetch_depth = 0
+
+# Methods that send many independent requests, such as get_policies fetching
+# data and lists for every policy, run up to max_workers of them at once.
+# Keep this at or below pool_maxsize so every worker has a pooled connection.
+max_workers = 16
+
+# Pages each shard of iter_event_pages_sharded keeps in memory while the
+# caller is still reading earlier shards. Further pages are written to a
+# temporary file, so shards keep fetching at full speed with bounded memory.
+shard_queue_depth = 4
+
+
+# Wraps an iterator of pages so that up to depth pages are fetched ahead in a
+# background thread, overlapping requests with the caller's processing.
+# Exceptions raised while fetching are re-raised to the caller in order.
+def prefetch_pages(pages, depth):
+    if not depth:
+        yield from pages
+        return
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def fetch():
+        try:
+            for page in pages:
+                while not stop.is_set():
+                    try:
+                        buffer.put(page, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    break
+            item = done
+        except Exception as e:
+            item = e
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    thread = threading.Thread(target=fetch, name='deepinstinct-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = buffer.get()
+            if page is done:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+
+
+# Returns the requests.Session of the active client
+def get_session():
+    return _active_client().session
+
+
+# Closes pooled connections of the active client. The next request builds a
+# new session using the current values of the transport settings above.
+def reset_session():
+    _active_client().reset_session()
+
+
+# Sends a request using the active client. All methods in this module use this
+# instead of calling requests.get/post/put/delete directly.
+def _request(method, request_url, **kwargs):
+    return _active_client().request(method, request_url, **kwargs)
+
+
+# Function used to decode JSON response bodies (bytes -> Python objects). None
+# means auto-detect: orjson if installed, then msgspec, then the standard
+# library json module. Set with set_json_decoder.
+json_decoder = None
+_auto_json_decoder = None
+
+
+# Replaces the function used to decode JSON responses, e.g.
+#   di.set_json_decoder(orjson.loads)
+# Pass None to go back to auto-detection.
+def set_json_decoder(decoder):
+    global json_decoder
+    json_decoder = decoder
+
+
+# Returns the fastest JSON decoder available in this environment
+def _detect_json_decoder():
+    global _auto_json_decoder
+    if _auto_json_decoder is None:
+        try:
+            import orjson
+            _auto_json_decoder = orjson.loads
+        except ImportError:
+            try:
+                import msgspec.json
+                _auto_json_decoder = msgspec.json.decode
+            except ImportError:
+                _auto_json_decoder = json.loads
+    return _auto_json_decoder
+
+
+# Parses a JSON document (str or bytes) with the configured decoder
+def _json_loads(data):
+    decoder = json_decoder
+    if decoder is None:
+        decoder = _detect_json_decoder()
+    return decoder(data)
+
+
+# Parses the body of a response as JSON. All methods in this module use this
+# instead of response.json(), and parse each response only once.
+def _decode(response):
+    return _json_loads(response.content)
+
+# Export Device List to disk in Excel format, or with file_format='csv',
+# 'jsonl' or 'parquet' streamed to disk page by page (see export_writers)
+def export_devices(include_deactivated=False, file_format='xlsx'):
+    #stream the devices from server to disk
+    devices = iter_devices(include_deactivated=include_deactivated)
+    writer = _export_records('device_list', devices, file_format=file_format)
     #return confirmation message
-    print (f'INFO: {str(len(devices))} devices exported to {folder_name}/{file_name}')
+    print (f'INFO: {str(writer.rows)} devices exported to {writer.file_name}')
+    return writer.file_name
 
 
 # Accepts a list of (exact hostnames | hostname regex patterns | CIDRs) and
@@ -67,21 +969,20 @@ def move_devices(search_list, group_name, regex_hostname_search=False, cidr_sear
 
 # Accepts list of hostnames, removes any explicit/manual group assignment.
 def move_devices_to_automatic_assignment(hostnames):
-    #Get all devices from server
-    devices = get_devices(include_deactivated=False)
-
-    #Establish a list to store the devices that match the search list
-    devices_to_move = []
+    #Get all devices (indexed by hostname)
+    index = get_device_index(include_deactivated=False)
 
-    #Search the full device list and pull out those that match our search list
-    for device in devices:
-        if device['hostname'] in hostnames:
-            devices_to_move.append(device)
+    #Look up the devices that match our search list
+    devices_to_move = [index.device(device_id) for device_id in index.ids_by_hostnames(hostnames)]
 
-    #Iterate through the list of matching devices
+    #Group the matching devices by their current group
+    device_ids_by_group = {}
     for device in devices_to_move:
-        #Remove the device from it's current group
-        remove_devices_from_group([device['id']], device['group_id'])
+        device_ids_by_group.setdefault(device['group_id'], []).append(device['id'])
+
+    #Remove the devices from their current groups, one request per group
+    for group_id, device_ids in device_ids_by_group.items():
+        remove_devices_from_group(device_ids, group_id)
 
     #Return a message indicating how many devices were moved
     return(str(len(devices_to_move)) + ' devices were moved to automatic assignment')
@@ -89,6 +990,7 @@ def move_devices_to_automatic_assignment(hostnames):
 
 #Archives (hides from GUI and API) a list of devices
 def archive_devices(device_ids, unarchive=False):
+    fqdn, key = _credentials()
     # Calculate headers and URL
     headers = {'Content-Type': 'application/json', 'Authorization': key}
     if unarchive:
@@ -100,7 +1002,7 @@ def archive_devices(device_ids, unarchive=False):
     payload = {'ids': device_ids}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
 
     # Check response code
     if response.status_code == 200:
@@ -116,60 +1018,57 @@ def unarchive_devices(device_ids):
     return archive_devices(device_ids=device_ids, unarchive=True)
 
 
-# Write Device Policy data to disk in MS Excel format.
-def export_policies(include_allow_deny_lists=True):
+# Platforms of policies exported by export_policies, with the name of the
+# sheet (or file name suffix) for each
+policy_export_platforms = {
+    'WINDOWS': 'Windows',
+    'MAC': 'macOS',
+    'IOS': 'iOS',
+    'ANDROID': 'Android',
+    'CHROME': 'Chrome OS',
+    'LINUX': 'Linux',
+    'NETWORK_AGENTLESS': 'Agentless',
+}
+
+
+# Write Device Policy data to disk in MS Excel format, one sheet per platform.
+# With file_format='csv', 'jsonl' or 'parquet' one file per platform is
+# written instead.
+def export_policies(include_allow_deny_lists=True, file_format='xlsx'):
+    fqdn, key = _credentials()
     # Get all policies from server, including auxilary data
     policies = get_policies(include_policy_data=True, include_allow_deny_lists=include_allow_deny_lists)
 
     # Divide the policies into platform-specific lists
     # --> This is done for purposes of cleaner/more usable exports, since
     #     different platform policies have different columns of data.
-    windows_policies = []
-    mac_policies = []
-    ios_policies = []
-    android_policies = []
-    chrome_policies = []
-    network_agentless_policies = []
-    linux_policies = []
+    policies_by_platform = {platform: [] for platform in policy_export_platforms}
     for policy in policies:
-        if policy['os'] == 'WINDOWS':
-            windows_policies.append(policy)
-        elif policy['os'] == 'MAC':
-            mac_policies.append(policy)
-        elif policy['os'] == 'ANDROID':
-            android_policies.append(policy)
-        elif policy['os'] == 'IOS':
-            ios_policies.append(policy)
-        elif policy['os'] == 'NETWORK_AGENTLESS':
-            network_agentless_policies.append(policy)
-        elif policy['os'] == 'LINUX':
-            linux_policies.append(policy)
-
-    #create dataframes to allow subsequent export to Excel
-    windows_policies_df = pandas.DataFrame(windows_policies)
-    mac_policies_df = pandas.DataFrame(mac_policies)
-    ios_policies_df = pandas.DataFrame(ios_policies)
-    android_policies_df = pandas.DataFrame(android_policies)
-    chrome_policies_df = pandas.DataFrame(chrome_policies)
-    network_agentless_policies_df = pandas.DataFrame(network_agentless_policies)
-    linux_policies_df = pandas.DataFrame(linux_policies)
+        if policy['os'] in policies_by_platform:
+            policies_by_platform[policy['os']].append(policy)
+
+    if file_format != 'xlsx':
+        file_names = []
+        for platform, sheet_name in policy_export_platforms.items():
+            name = 'deepinstinct_policies_' + re.sub(r'[^a-z0-9]', '', sheet_name.lower())
+            writer = _export_records(name, policies_by_platform[platform], file_format=file_format)
+            file_names.append(writer.file_name)
+        print(f'INFO: {str(len(policies))} policies exported to {", ".join(file_names)}')
+        return file_names
 
     #export dataframes to disk
     timestamp = datetime.datetime.today().strftime('%Y-%m-%d_%H.%M')
     folder_name = create_export_folder()
     file_name = f'deepinstinct_policies_{timestamp}_{fqdn.split(".",1)[0]}.xlsx'
     with pandas.ExcelWriter(f'{folder_name}/{file_name}') as writer:
-        windows_policies_df.to_excel(writer, sheet_name='Windows', index=False)
-        mac_policies_df.to_excel(writer, sheet_name='macOS', index=False)
-        ios_policies_df.to_excel(writer, sheet_name='iOS', index=False)
-        android_policies_df.to_excel(writer, sheet_name='Android', index=False)
-        chrome_policies_df.to_excel(writer, sheet_name='Chrome OS', index=False)
-        linux_policies_df.to_excel(writer, sheet_name='Linux', index=False)
-        network_agentless_policies_df.to_excel(writer, sheet_name='Agentless', index=False)
+        for platform, sheet_name in policy_export_platforms.items():
+            pandas.DataFrame(policies_by_platform[platform]).to_excel(writer, sheet_name=sheet_name, index=False)
     print(f'INFO: {str(len(policies))} policies exported to {folder_name}/{file_name}')
+    return f'{folder_name}/{file_name}'
 
 # Enable automatic upgrade setting in policies
 def enable_upgrades(platforms=['WINDOWS','MAC'], automatic_upgrade=True, return_modified_policies_id_list=False):
+    fqdn, key = _credentials()
     # Get list of policies
     policies = get_policies()
 
@@ -189,14 +1088,14 @@ def enable_upgrades(platforms=['WINDOWS','MAC'], automatic_upgrade=True, return_
             # If yes, get policy data from the server
             policy_id = policy['id']
             request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-            response = requests.get(request_url, headers=headers)
-            policy_data = response.json()
+            response = _request('GET', request_url, headers=headers)
+            policy_data = _decode(response)
             # Check if the upgrade setting needs changing
             if policy_data['data']['automatic_upgrade'] != automatic_upgrade:
                 # If yes, set it to desired setting
                 policy_data['data']['automatic_upgrade'] = automatic_upgrade
                 # Write modified policy data back to server (saving change)
-                response = requests.put(request_url, json=policy_data, headers=headers)
+                response = _request('PUT', request_url, json=policy_data, headers=headers)
                 # Increment the counter of how many policies we have modified
                 modified_policy_counter += 1
                 modified_policies_id_list.append(policy['id'])
@@ -217,6 +1116,7 @@ def disable_upgrades(platforms=['WINDOWS','MAC'], return_modified_policies_id_li
 
 # Enables upgrades for a list of policy IDs
 def enable_upgrades_for_list_of_policy_ids(policy_ids, automatic_upgrade=True):
+    fqdn, key = _credentials()
 
     # Establish a counter of how many policies were modified (used in return)
     modified_policy_counter = 0
@@ -227,14 +1127,14 @@ def enable_upgrades_for_list_of_policy_ids(policy_ids, automatic_upgrade=True):
     # Iterate through the poliocy ids provided
     for policy_id in policy_ids:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-        response = requests.get(request_url, headers=headers)
-        policy_data = response.json()
+        response = _request('GET', request_url, headers=headers)
+        policy_data = _decode(response)
         # Check if the upgrade setting needs changing
         if policy_data['data']['automatic_upgrade'] != automatic_upgrade:
             # If yes, set it to desired setting
             policy_data['data']['automatic_upgrade'] = automatic_upgrade
             # Write modified policy data back to server (saving change)
-            request = requests.put(request_url, json=policy_data, headers=headers)
+            request = _request('PUT', request_url, json=policy_data, headers=headers)
             # Increment the counter of how many policies we have modified
             modified_policy_counter += 1
 
@@ -243,27 +1143,28 @@ def enable_upgrades_for_list_of_policy_ids(policy_ids, automatic_upgrade=True):
 
 # Returns list of visible Tenants
 def get_tenants():
+    fqdn, key = _credentials()
     #get data
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/'
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
 
     #return data
     if response.status_code == 200:
         #return list of tenants
-        return response.json()['tenants']
+        return _decode(response)['tenants']
     else:
         #in case of error return an empty list
         return []
 
 
-# Returns a list of all visible Devices
-def get_devices(include_deactivated=True):
-    # CREATE VARIABLES
+# Yields all visible Devices, one page (list of up to 50 devices) at a time.
+# Only one page is held in memory at once.
+@_client_bound_generator
+def iter_device_pages(include_deactivated=True, after_device_id=0):
+    fqdn, key = _credentials()
     #cursor to keep track of highest device id returned
-    last_id = 0
-    #list to collect the devices
-    collected_devices = []
+    last_id = after_device_id
     #static set of headers for requests in this method
     headers = {'accept': 'application/json', 'Authorization': key}
 
@@ -272,15 +1173,16 @@ def get_devices(include_deactivated=True):
     # device id returned. We will know we have all devices visible to our API
     # key when we get last_id=None in a response.
 
-    error_count = 0
-    # COLLECT DATA
-    while last_id != None and error_count < 10: #loop until all visible devices have been collected
+    # Transient errors are retried by _request, so anything other than 200
+    # here is fatal; raise rather than return an incomplete device list.
+
+    while last_id != None: #loop until all visible devices have been collected
         #calculate URL for request
         request_url = f'https://{fqdn}/api/v1/devices?after_device_id={last_id}'
         #make request, store response
-        response = requests.get(request_url, headers=headers)
+        response = _request('GET', request_url, headers=headers)
         if response.status_code == 200:
-            response = response.json() #convert to Python list
+            response = _decode(response) #convert to Python list
             if 'last_id' in response:
                 last_id = response['last_id'] #save returned last_id for reuse on next request
             else: #added this to handle issue where some server versions fail to return last_id on final batch of devices
@@ -289,54 +1191,458 @@ def get_devices(include_deactivated=True):
                 print(request_url, 'returned 200 with last_id', last_id, end='\r')
             if 'devices' in response:
                 devices = response['devices'] #extract devices from response
-                for device in devices: #iterate through the list of devices
-                    if device['license_status'] == 'ACTIVATED' or include_deactivated:
-                        collected_devices.append(device) #add to collected devices
+                if not include_deactivated:
+                    devices = [device for device in devices if device['license_status'] == 'ACTIVATED']
+                yield devices
         else:
-            print('WARNING: Unexpected return code', response.status_code,
-            'on request to\n', request_url, '\nwith headers\n', headers)
-            error_count += 1  #increment error counter
-            time.sleep(10) #wait before trying request again
+            print('ERROR: Unexpected return code', response.status_code, 'on request to', request_url)
+            raise requests.exceptions.HTTPError(f'Unexpected return code {response.status_code} on GET {request_url}', response=response)
     if not quiet_mode:
         print('\n')
 
-    # When while loop exists, we know we have collected all visible data
 
-    # RETURN COLLECTED DATA
-    return collected_devices
+# Yields all visible Devices one at a time, with constant memory use. With
+# prefetch=N, up to N pages are requested ahead while the caller works.
+@_client_bound_generator
+def iter_devices(include_deactivated=True, prefetch=None):
+    if prefetch is None:
+        prefetch = prefetch_depth
+    pages = iter_device_pages(include_deactivated=include_deactivated)
+    for devices in prefetch_pages(pages, prefetch):
+        yield from devices
 
 
-# Translates a list of device names, regex patterns, or CIDRs to a list of device IDs
-def get_device_ids(search_list, regex_hostname_search=False, cidr_search=False):
-    # GET ALL DEVICES
-    devices = get_devices(include_deactivated=False)
+# Returns a list of all visible Devices. The list comes from the device
+# inventory if it was refreshed less than max_age seconds ago (default
+# device_cache_ttl); max_age=0 always downloads the devices from the server.
+def get_devices(include_deactivated=True, prefetch=None, max_age=None):
+    if max_age is None:
+        max_age = device_cache_ttl
+    if max_age > 0:
+        return get_device_inventory().devices(include_deactivated=include_deactivated, max_age=max_age, prefetch=prefetch)
+    return list(iter_devices(include_deactivated=include_deactivated, prefetch=prefetch))
 
-    # CREATE A LIST TO COLLECT SEARCH RESULTS
-    device_ids = []
 
-    # ITERATE THROUGH THE DEVICES, COLLECT MATCHES
+# Number of seconds that get_devices (and the methods built on it) reuse the
+# device inventory before walking the whole fleet again. 0 (the default)
+# disables the cache, so every call returns live data.
+device_cache_ttl = 0
 
-    # Regex-based matching on hostname
-    if regex_hostname_search:
+# Device fields compared to detect which devices changed between refreshes
+device_change_fields = ('last_contact', 'connectivity_status', 'license_status', 'deployment_status',
+    'hostname', 'ip_address', 'group_id', 'policy_id')
+
+
+# A copy of all devices on one server, shared by every method in this module
+# that needs the full device list (one per server and API key, see
+# get_device_inventory).
+#
+# devices() reuses the copy for device_cache_ttl seconds. After that, a full
+# refresh walks the fleet again, because the API has no "changed since"
+# filter. Each refresh records which devices were added, changed (compared
+# by device_change_fields) or removed in changes, and version only increases
+# when something did change. refresh(full=False) only asks for devices newer
+# than the highest id already known, which is enough to pick up new
+# enrollments. Writes to devices or groups made through the client
+# invalidate the inventory, so the next read does a full refresh.
+class DeviceInventory:
+
+    def __init__(self, client=None):
+        if client is None:
+            client = _active_client()
+        self.client = client
+        self.fqdn = client.fqdn
+        self.version = 0
+        self.changes = {'added': [], 'changed': [], 'removed': []}
+        self._devices = {}  #device id -> device
+        self._fingerprints = {}  #device id -> values of device_change_fields
+        self._refreshed = None
+        self._indexes = {}  #include_deactivated -> DeviceIndex of the current devices
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f'DeviceInventory({self.fqdn!r}, devices={len(self._devices)}, version={self.version})'
+
+    def __len__(self):
+        return len(self._devices)
+
+    # Seconds since the last full refresh, or None if it needs one
+    @property
+    def age(self):
+        if self._refreshed is None:
+            return None
+        return time.monotonic() - self._refreshed
+
+    # Forces a full refresh on the next read
+    def invalidate(self):
+        with self._lock:
+            self._refreshed = None
+
+    # Downloads devices from the server (all devices, or with full=False only
+    # those newer than the highest id already known), updates the inventory
+    # and returns the changes found
+    def refresh(self, full=True, prefetch=None):
+        if prefetch is None:
+            prefetch = prefetch_depth
+        with self._lock, self.client.activate():
+            refreshed = time.monotonic()
+            after_device_id = 0 if full else max(self._devices, default=0)
+            devices = {} if full else dict(self._devices)
+            fingerprints = {} if full else dict(self._fingerprints)
+            changes = {'added': [], 'changed': [], 'removed': []}
+            for page in prefetch_pages(iter_device_pages(after_device_id=after_device_id), prefetch):
+                for device in page:
+                    fingerprint = tuple(device.get(field) for field in device_change_fields)
+                    if device['id'] not in self._fingerprints:
+                        changes['added'].append(device['id'])
+                    elif self._fingerprints[device['id']] != fingerprint:
+                        changes['changed'].append(device['id'])
+                    devices[device['id']] = device
+                    fingerprints[device['id']] = fingerprint
+            if full:
+                changes['removed'] = [device_id for device_id in self._devices if device_id not in devices]
+                self._refreshed = refreshed
+            self._devices = devices
+            self._fingerprints = fingerprints
+            self._indexes = {}
+            self.changes = changes
+            if changes['added'] or changes['changed'] or changes['removed']:
+                self.version += 1
+            return changes
+
+    # Returns a list of all devices, refreshing first if the inventory is older
+    # than max_age seconds (default device_cache_ttl). The devices are copies,
+    # so callers may modify them.
+    def devices(self, include_deactivated=True, max_age=None, prefetch=None):
+        if max_age is None:
+            max_age = device_cache_ttl
+        with self._lock:
+            age = self.age
+            if age is None or age > max_age:
+                self.refresh(prefetch=prefetch)
+            return [dict(device) for device in self._devices.values()
+                if include_deactivated or device['license_status'] == 'ACTIVATED']
+
+    # Returns a DeviceIndex of all devices, refreshing first if the inventory is
+    # older than max_age seconds. The index is built once per refresh.
+    def index(self, include_deactivated=True, max_age=None):
+        if max_age is None:
+            max_age = device_cache_ttl
+        with self._lock:
+            age = self.age
+            if age is None or age > max_age:
+                self.refresh()
+            if include_deactivated not in self._indexes:
+                self._indexes[include_deactivated] = DeviceIndex(device for device in self._devices.values()
+                    if include_deactivated or device['license_status'] == 'ACTIVATED')
+            return self._indexes[include_deactivated]
+
+
+# Lookup tables over a list of devices: id -> device, hostname -> device ids,
+# and a sorted index of IP addresses (as integers, per address family) for
+# exact and range lookups by binary search. Devices without a valid IP
+# address are left out of the IP index only.
+#   index = di.get_device_index()
+#   index.ids_by_hostnames(['host1', 'host2'])
+class DeviceIndex:
+
+    def __init__(self, devices):
+        self._by_id = {}
+        self._by_hostname = {}
+        self._by_lowercase_hostname = {}
+        addresses = {4: [], 6: []}
         for device in devices:
-            for regex in search_list: #for each regex...
-                if re.match(regex, device['hostname']): #check if hostname matches
-                    if device['id'] not in device_ids: #avoid duplicates
-                        device_ids.append(device['id']) #append id to search results
+            self._by_id[device['id']] = device
+            hostname = device.get('hostname')
+            if hostname is not None:
+                self._by_hostname.setdefault(hostname, []).append(device['id'])
+                self._by_lowercase_hostname.setdefault(hostname.lower(), []).append(device['id'])
+            address_key = _ip_address_key(device.get('ip_address'))
+            if address_key is not None:
+                addresses[address_key[0]].append((address_key[1], device['id']))
+        self._ip_keys = {}
+        self._ip_ids = {}
+        for version, entries in addresses.items():
+            entries.sort()
+            self._ip_keys[version] = [entry[0] for entry in entries]
+            self._ip_ids[version] = [entry[1] for entry in entries]
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, device_id):
+        return device_id in self._by_id
+
+    # Returns a copy of the device with this id, or None
+    def device(self, device_id):
+        device = self._by_id.get(device_id)
+        if device is None:
+            return None
+        return dict(device)
+
+    # Returns copies of all devices, in id order
+    def devices(self):
+        return [dict(device) for device in self._by_id.values()]
+
+    # Returns the distinct hostnames
+    def hostnames(self):
+        return list(self._by_hostname)
+
+    # Returns the ids of devices with this hostname, lowest id first
+    def ids_by_hostname(self, hostname, ignore_case=False):
+        if ignore_case:
+            return list(self._by_lowercase_hostname.get(hostname.lower(), []))
+        return list(self._by_hostname.get(hostname, []))
+
+    # Returns the ids of devices matching any of the hostnames, in id order
+    # and without duplicates
+    def ids_by_hostnames(self, hostnames, ignore_case=False):
+        device_ids = set()
+        for hostname in hostnames:
+            device_ids.update(self.ids_by_hostname(hostname, ignore_case=ignore_case))
+        return sorted(device_ids)
+
+    # Returns the ids of devices with this IP address
+    def ids_by_ip(self, ip_address):
+        return self.ids_in_ip_range(ip_address, ip_address)
+
+    # Returns the ids of devices with an IP address from first to last
+    # (inclusive, same address family), in address order
+    def ids_in_ip_range(self, first, last):
+        version, first = _ip_address_key(first)
+        version, last = _ip_address_key(last)
+        keys = self._ip_keys[version]
+        start = bisect.bisect_left(keys, first)
+        end = bisect.bisect_right(keys, last)
+        return self._ip_ids[version][start:end]
+
+
+# Returns (address family, address as integer) for an IP address string or
+# ipaddress object, or None if missing or invalid. IPv4-mapped IPv6 addresses
+# are returned as IPv4. Uses inet_pton, which is much faster than the
+# ipaddress module when parsing every device in a large fleet.
+def _ip_address_key(ip_address):
+    if isinstance(ip_address, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        ip_address = str(ip_address)
+    if not isinstance(ip_address, str) or ip_address == '':
+        return None
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), 'big')
+    except OSError:
+        pass
+    try:
+        key = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), 'big')
+    except OSError:
+        return None
+    if key >> 32 == 0xffff:
+        return 4, key & 0xffffffff
+    return 6, key
+
+
+# Matches IP addresses against a list of CIDRs, which may mix IPv4 and IPv6.
+# The networks are parsed once into sorted, merged integer intervals per
+# address family, so each lookup is one binary search however many CIDRs
+# there are. Missing or invalid addresses never match, and IPv4-mapped IPv6
+# addresses (::ffff:10.0.0.1) are matched as IPv4.
+#   matcher = di.CidrMatcher(['10.0.0.0/8', '2001:db8::/32'])
+#   matcher.matches('10.1.2.3')  -> True
+class CidrMatcher:
+
+    def __init__(self, cidrs):
+        ranges = {4: [], 6: []}
+        for cidr in cidrs:
+            network = ipaddress.ip_network(cidr, strict=False)
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        self._starts = {}
+        self._ends = {}
+        for version in ranges:
+            merged = []
+            for start, end in sorted(ranges[version]):
+                if len(merged) > 0 and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)  #overlapping or adjacent
+                else:
+                    merged.append([start, end])
+            self._starts[version] = [interval[0] for interval in merged]
+            self._ends[version] = [interval[1] for interval in merged]
+
+    def __repr__(self):
+        return f'CidrMatcher({len(self._starts[4])} IPv4 and {len(self._starts[6])} IPv6 ranges)'
+
+    # Returns the merged ranges as a list of (first, last) IP addresses
+    def intervals(self):
+        intervals = []
+        for version, address_type in ((4, ipaddress.IPv4Address), (6, ipaddress.IPv6Address)):
+            for start, end in zip(self._starts[version], self._ends[version]):
+                intervals.append((address_type(start), address_type(end)))
+        return intervals
+
+    # Returns True if the IP address (string or ipaddress object) is in any of
+    # the CIDRs
+    def matches(self, ip_address):
+        address_key = _ip_address_key(ip_address)
+        if address_key is None:
+            return False
+        version, key = address_key
+        position = bisect.bisect_right(self._starts[version], key) - 1
+        return position >= 0 and key <= self._ends[version][position]
+
+    def __contains__(self, ip_address):
+        return self.matches(ip_address)
+
+    # Returns the devices whose ip_address is in any of the CIDRs
+    def filter_devices(self, devices):
+        return [device for device in devices if self.matches(device.get('ip_address'))]
+
+
+# Matches hostnames against a list of regex patterns with the same semantics
+# as re.match (anchored at the start), reporting the first pattern in the list
+# that matches. Patterns are compiled once into combined alternations with one
+# named group per pattern. Patterns that start with a literal (e.g. 'NYC-WS'
+# in 'NYC-WS\d+') are bucketed by that prefix, so a hostname is only tried
+# against the patterns whose prefix it starts with plus those without a
+# literal prefix. Patterns that can't be combined safely (backreferences,
+# inline flags, ...) are matched one by one.
+#   matcher = di.HostnameMatcher(['NYC-.*', 'LAB-\d+'])
+#   matcher.matching_pattern('LAB-12')  -> 'LAB-\d+'
+class HostnameMatcher:
+
+    def __init__(self, patterns, ignore_case=False):
+        self.patterns = list(patterns)
+        self._flags = re.IGNORECASE if ignore_case else 0
+        self._ignore_case = ignore_case
+        self._buckets = {}  #literal prefix -> pattern indexes
+        self._unprefixed = []  #pattern indexes without a literal prefix
+        for position, pattern in enumerate(self.patterns):
+            prefix = self._literal_prefix(pattern)
+            if prefix == '':
+                self._unprefixed.append(position)
+            else:
+                self._buckets.setdefault(prefix.lower() if ignore_case else prefix, []).append(position)
+        self._prefix_lengths = sorted(set(len(prefix) for prefix in self._buckets))
+        self._compiled_buckets = {prefix: self._compile(positions) for prefix, positions in self._buckets.items()}
+        self._compiled_unprefixed = self._compile(self._unprefixed)
+
+    def __repr__(self):
+        return f'HostnameMatcher({len(self.patterns)} patterns)'
+
+    # Returns the literal characters every match of the pattern starts with
+    # (conservatively; '' when unsure)
+    @staticmethod
+    def _literal_prefix(pattern):
+        if '|' in pattern:
+            return ''
+        prefix = ''
+        for position, character in enumerate(pattern):
+            if character in '.^$*+?{}[]\\|()':
+                if character in '*?{':
+                    prefix = prefix[:-1]  #the previous character is optional
+                break
+            prefix += character
+        return prefix
+
+    # Returns a list of (compiled regex, group name -> pattern index) for the
+    # patterns at these positions: one combined regex, or one per pattern if
+    # they can't be combined
+    def _compile(self, positions):
+        if len(positions) == 0:
+            return []
+        if not any(re.search(r'\\\d|\(\?P=|\(\?[aiLmsux]', self.patterns[position]) for position in positions):
+            try:
+                combined = '|'.join(f'(?P<p{position}>{self.patterns[position]})' for position in positions)
+                return [(re.compile(combined, self._flags), None)]
+            except re.error:
+                pass
+        return [(re.compile(self.patterns[position], self._flags), position) for position in positions]
+
+    # Returns the index of the first pattern matching the hostname, or None
+    def match(self, hostname):
+        if not hostname:
+            return None
+        key = hostname.lower() if self._ignore_case else hostname
+        candidates = list(self._compiled_unprefixed)
+        for length in self._prefix_lengths:
+            if length > len(key):
+                break
+            candidates += self._compiled_buckets.get(key[:length], [])
+        best = None
+        for regex, position in candidates:
+            match = regex.match(hostname)
+            if match is not None:
+                if position is None:
+                    position = int(match.lastgroup[1:])  #the pattern's group closes last
+                if best is None or position < best:
+                    best = position
+        return best
+
+    # Returns the first pattern matching the hostname, or None
+    def matching_pattern(self, hostname):
+        position = self.match(hostname)
+        if position is None:
+            return None
+        return self.patterns[position]
+
+    # Returns True if any pattern matches the hostname
+    def matches(self, hostname):
+        return self.match(hostname) is not None
+
+    # Returns the devices whose hostname matches any of the patterns
+    def filter_devices(self, devices):
+        return [device for device in devices if self.matches(device.get('hostname'))]
+
+
+# Returns a DeviceIndex of the active client's device inventory, by default
+# of activated devices only
+def get_device_index(include_deactivated=False):
+    return get_device_inventory().index(include_deactivated=include_deactivated)
+
+
+# Returns the DeviceInventory for the active client's server and API key,
+# creating it on first use. Keys can see different devices (e.g. one tenant
+# each), so each key gets its own inventory.
+def get_device_inventory():
+    client = _active_client()
+    cache_name = ('device_inventory', client.fqdn, client.key)
+    if cache_name not in client.cache:
+        client.cache[cache_name] = DeviceInventory(client)
+    return client.cache[cache_name]
+
 
-    # IP range (CIDR) matching
+# Drops the cached device inventory of the active client, e.g. after devices
+# were changed by another tool
+def invalidate_device_cache():
+    get_device_inventory().invalidate()
+
+
+# Translates a list of device names, regex patterns, or CIDRs to a list of device IDs.
+# For regex and CIDR searches, search_list may also be a HostnameMatcher or
+# CidrMatcher built earlier, so the patterns are only compiled once.
+def get_device_ids(search_list, regex_hostname_search=False, cidr_search=False):
+    # GET ALL DEVICES (INDEXED)
+    index = get_device_index(include_deactivated=False)
+
+    # CREATE A SET TO COLLECT SEARCH RESULTS WITHOUT DUPLICATES
+    found = set()
+
+    # Regex-based matching on hostname; each distinct hostname is matched once
+    # against all patterns combined
+    if regex_hostname_search:
+        matcher = search_list if isinstance(search_list, HostnameMatcher) else HostnameMatcher(search_list)
+        for hostname in index.hostnames():
+            if matcher.matches(hostname):
+                found.update(index.ids_by_hostname(hostname))
+        device_ids = sorted(found) #in device id order
+
+    # IP range (CIDR) matching; the CIDRs are merged into non-overlapping
+    # ranges, each looked up in the IP index of the devices
     elif cidr_search:
-        for cidr in search_list: #for each cidr in the search list...
-            for device in devices:
-                if ipaddress.ip_address(device['ip_address']) in ipaddress.ip_network(cidr):
-                    if device['id'] not in device_ids: #avoid duplicates
-                        device_ids.append(device['id']) #append id to search results
+        matcher = search_list if isinstance(search_list, CidrMatcher) else CidrMatcher(search_list)
+        for first, last in matcher.intervals():
+            found.update(index.ids_in_ip_range(first, last))
+        device_ids = sorted(found) #in device id order
 
     # Hostname search (exact match only)
     else:
-        for device in devices:
-            if device['hostname'] in search_list:
-                device_ids.append(device['id']) #append id to search results
+        device_ids = index.ids_by_hostnames(search_list)
 
     # RETURN THE SEARCH RESULTS
     return device_ids
@@ -357,6 +1663,7 @@ def get_group_id(group_name, exclude_default_groups=False):
 
 # Adds a list of Devices to a Device Group
 def add_devices_to_group(device_ids, group_id, remove=False):
+    fqdn, key = _credentials()
     # Calculate headers and URL
     headers = {'Content-Type': 'application/json', 'Authorization': key}
     if remove:
@@ -368,7 +1675,7 @@ def add_devices_to_group(device_ids, group_id, remove=False):
     payload = {'devices': device_ids}
 
     # Send to server, return confirmation if successful
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
     if response.status_code == 204: #expected return code
         if remove:
             return str(len(device_ids)) + ' devices removed from group ' + str(group_id)
@@ -383,17 +1690,140 @@ def remove_devices_from_group(device_ids, group_id):
     return add_devices_to_group(device_ids=device_ids, group_id=group_id, remove=True)
 
 
-# Collect and return list of Device Policies.
-def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep_data_encapsulated=False, msp_id='ALL'):
-    # GET POLICIES (basic data only)
-
-    # Calculate headers and URL
+# Types of allow list, deny list, and exclusion list attached to a policy
+allow_deny_and_exclusion_list_types = [
+    'allow-list/hashes',
+    'allow-list/paths',
+    'allow-list/certificates',
+    'allow-list/process_paths',
+    'allow-list/scripts',
+    'deny-list/hashes',
+    'exclusion-list/folder_path',
+    'exclusion-list/process_path'
+]
+
+# Number of seconds that get_policies reuses the policy list, policy data and
+# list contents fetched earlier. 0 (the default) disables the cache, so every
+# call returns live data.
+policy_cache_ttl = 0
+
+
+# Responses for the policies of one server and API key, keyed by policy id and
+# part: 'data' or a list type such as 'allow-list/hashes' (policy id None holds the list of
+# policies). Each entry keeps the raw response body and a hash of it, and
+# callers get freshly decoded copies, so modifying them doesn't change the
+# cache. Writes to a policy made through the client (PUT data, POST/DELETE on
+# a list, ...) drop the entries of that policy only, so reads after writes stay
+# correct while unchanged policies are not fetched again.
+class PolicyCache:
+
+    def __init__(self):
+        self._entries = {}  #(policy id, part) -> (time stored, status code, content, hash)
+        self._generations = {}  #policy id -> number of times invalidated
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Returns (status code, decoded content) of a cached response, or None if
+    # it isn't cached or is older than max_age seconds (default policy_cache_ttl)
+    def get(self, policy_id, part, max_age=None):
+        if max_age is None:
+            max_age = policy_cache_ttl
+        with self._lock:
+            entry = self._entries.get((policy_id, part))
+        if entry is None or time.monotonic() - entry[0] > max_age:
+            return None
+        stored, status_code, content, content_hash = entry
+        if status_code != 200:
+            return status_code, None
+        return status_code, _json_loads(content)
+
+    # Returns a token to pass to put; a response fetched after calling this is
+    # only stored if the policy wasn't invalidated in the meantime
+    def generation(self, policy_id):
+        with self._lock:
+            return self._generations.get(policy_id, 0)
+
+    # Stores a response for part of a policy
+    def put(self, policy_id, part, response, generation):
+        content = response.content if response.status_code == 200 else b''
+        entry = (time.monotonic(), response.status_code, content, hashlib.sha256(content).hexdigest())
+        with self._lock:
+            if self._generations.get(policy_id, 0) == generation:
+                self._entries[policy_id, part] = entry
+
+    # Returns a hash of the cached parts of a policy, which changes when its
+    # data or any of its lists change (None if nothing is cached)
+    def content_hash(self, policy_id):
+        with self._lock:
+            parts = sorted((part, entry[3]) for (cached_id, part), entry in self._entries.items() if cached_id == policy_id)
+        if len(parts) == 0:
+            return None
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    # Drops the cached parts of one policy (None for the list of policies)
+    def invalidate(self, policy_id):
+        with self._lock:
+            self._generations[policy_id] = self._generations.get(policy_id, 0) + 1
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == policy_id]:
+                del self._entries[cache_key]
+
+    # Drops everything
+    def clear(self):
+        with self._lock:
+            for policy_id in set(cache_key[0] for cache_key in self._entries):
+                self._generations[policy_id] = self._generations.get(policy_id, 0) + 1
+            self._entries.clear()
+
+
+# Returns the PolicyCache for the active client's server and API key, creating
+# it on first use
+def get_policy_cache():
+    client = _active_client()
+    cache_name = ('policy_cache', client.fqdn, client.key)
+    if cache_name not in client.cache:
+        client.cache[cache_name] = PolicyCache()
+    return client.cache[cache_name]
+
+
+# Gets part of a policy ('data' or a list type; policy_id None and part
+# 'policies' for the list of policies), from the policy cache if it has a
+# recent enough copy. Returns the status code and the decoded content (None
+# unless the status code was 200).
+def _get_policy_part(policy_id, part, max_age=None):
+    fqdn, key = _credentials()
+    if max_age is None:
+        max_age = policy_cache_ttl
+    cache = get_policy_cache()
+    cached = cache.get(policy_id, part, max_age=max_age)
+    if cached is not None:
+        return cached
+    if policy_id is None:
+        request_url = f'https://{fqdn}/api/v1/policies/'
+    else:
+        request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/{part}'
     headers = {'accept': 'application/json', 'Authorization': key}
-    request_url = f'https://{fqdn}/api/v1/policies/'
-
-    # Get data, convert to Python list
-    response = requests.get(request_url, headers=headers)
-    policies = response.json()
+    generation = cache.generation(policy_id)
+    response = _request('GET', request_url, headers=headers)
+    if not quiet_mode:
+        print(request_url, 'returned', response.status_code, end='\r')
+    #only keep successful responses, and the 404 returned for a policy without
+    #data or a list type (some platforms have none); errors such as 401/403
+    #or throttling must not be remembered
+    if max_age > 0 and (response.status_code == 200 or (response.status_code == 404 and policy_id is not None)):
+        cache.put(policy_id, part, response, generation)
+    if response.status_code != 200:
+        return response.status_code, None
+    return response.status_code, _decode(response)
+
+
+# Collect and return list of Device Policies. Policy data and lists fetched by
+# an earlier call less than max_age seconds ago (default policy_cache_ttl) are
+# reused instead of being fetched again.
+def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep_data_encapsulated=False, msp_id='ALL', max_age=None):
+    # GET POLICIES (basic data only)
+    status_code, policies = _get_policy_part(None, 'policies', max_age=max_age)
 
     # Apply filter based on msp, if enabled
     if msp_id != 'ALL':
@@ -403,60 +1833,46 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
                 filtered_policies.append(policy)
         policies = filtered_policies
 
-    # APPEND POLICY DATA (IF ENABLED)
-    if include_policy_data:
-
-        # Iterate through policy list
-        for policy in policies:
-            # Extract ID, calculate URL, and pull policy data from server
-            policy_id = policy['id']
-            request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-            response = requests.get(request_url, headers=headers)
-            if not quiet_mode:
-                print(request_url, 'returned', response.status_code, end='\r')
-            # Check response code (for some platforms, no policy data available)
-            if response.status_code == 200:
-                # Extract policy data from response and append it to policy
-                if keep_data_encapsulated:
-                    policy_data = response.json()
-                else:
-                    policy_data = response.json()['data']
-                policy.update(policy_data)
-        if not quiet_mode:
-            print('\n')
-
-    # APPEND ALLOW-LIST, DENY-LIST, AND EXCLUSION DATA (IF ENABLED)
-    if include_allow_deny_lists:
-
-        allow_deny_and_exclusion_list_types = [
-            'allow-list/hashes',
-            'allow-list/paths',
-            'allow-list/certificates',
-            'allow-list/process_paths',
-            'allow-list/scripts',
-            'deny-list/hashes',
-            'exclusion-list/folder_path',
-            'exclusion-list/process_path'
-        ]
-
-        # Iterate through policy list
-        for policy in policies:
-
-            # Extract the policy id, which is used in subsequent requests
-            policy_id = policy['id']
-
-            #create a dictionary in the policy to store this data
-            policy['allow_deny_and_exclusion_lists'] = {}
-
-            #iterate through list types to migrate
-            for list_type in allow_deny_and_exclusion_list_types:
-
-                request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/{list_type}'
-                response = requests.get(request_url, headers=headers)
-                print(request_url, 'returned', response.status_code, end='\r')
-                if response.status_code == 200:
-                    response = response.json()
-                    policy['allow_deny_and_exclusion_lists'][list_type] = response
+    # APPEND POLICY DATA AND ALLOW-LIST, DENY-LIST, AND EXCLUSION DATA (IF ENABLED)
+    # Requests for these run concurrently on up to max_workers threads; results
+    # are added to the policies in the same order as before once all are done
+
+    # Returns policy data, or None if not available (for some platforms, no
+    # policy data available)
+    def get_policy_data(policy_id):
+        status_code, policy_data = _get_policy_part(policy_id, 'data', max_age=max_age)
+        if policy_data is not None and not keep_data_encapsulated:
+            return policy_data['data']
+        return policy_data
+
+    # Returns the contents of a list, or None if not available
+    def get_list(policy_id, list_type):
+        status_code, items = _get_policy_part(policy_id, list_type, max_age=max_age)
+        return items
+
+    if include_policy_data or include_allow_deny_lists:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            data_futures = {}
+            list_futures = {}
+            for policy in policies:
+                if include_policy_data:
+                    data_futures[policy['id']] = executor.submit(_with_active_client(get_policy_data), policy['id'])
+                if include_allow_deny_lists:
+                    for list_type in allow_deny_and_exclusion_list_types:
+                        list_futures[policy['id'], list_type] = executor.submit(_with_active_client(get_list), policy['id'], list_type)
+
+            for policy in policies:
+                if include_policy_data:
+                    policy_data = data_futures[policy['id']].result()
+                    if policy_data is not None:
+                        policy.update(policy_data)
+                if include_allow_deny_lists:
+                    #create a dictionary in the policy to store this data
+                    policy['allow_deny_and_exclusion_lists'] = {}
+                    for list_type in allow_deny_and_exclusion_list_types:
+                        items = list_futures[policy['id'], list_type].result()
+                        if items is not None:
+                            policy['allow_deny_and_exclusion_lists'][list_type] = items
         if not quiet_mode:
             print('\n')
 
@@ -466,15 +1882,16 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
 
 # Returns list of visible MSPs
 def get_msps():
+    fqdn, key = _credentials()
     #get data
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/'
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
 
     #return data
     if response.status_code == 200:
         #return list of msps
-        return response.json()['msps']
+        return _decode(response)['msps']
     else:
         #in case of error return an empty list
         return []
@@ -482,17 +1899,18 @@ def get_msps():
 
 # Create a new MSP
 def create_msp(msp_name, license_limit):
+    fqdn, key = _credentials()
     # Calculate headers, URL, and payload
     headers = {'Content-Type': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/'
     payload = {'name': msp_name, 'license_limit': license_limit}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 200:
-        return response.json()
+        return _decode(response)
     elif response.status_code == 409:
         return 'ERROR: MSP name already exists'
     elif response.status_code == 401:
@@ -505,6 +1923,7 @@ def create_msp(msp_name, license_limit):
 
 # Delete an MSP based on provided name
 def delete_msp(msp_name):
+    fqdn, key = _credentials()
     # Get the list of MSPs
     msps = get_msps()
 
@@ -519,7 +1938,7 @@ def delete_msp(msp_name):
     # DELETE THE MSP
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/{msp_id}'
     headers = {'Authorization': key}
-    response = requests.delete(request_url, headers=headers)
+    response = _request('DELETE', request_url, headers=headers)
 
     # RETURN SUCCESS/FAILURE BASED ON RETURN CODE
     if response.status_code == 204:
@@ -535,6 +1954,7 @@ def delete_msp(msp_name):
 
 # Remotely uninstall a device
 def remove_device(device, device_id_only=False):
+    fqdn, key = _credentials()
 
     #PROCESS INPUT
     if device_id_only:
@@ -547,7 +1967,7 @@ def remove_device(device, device_id_only=False):
     #UNINSTALL THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/remove'
     headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = _request('POST', request_url, headers=headers)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -558,16 +1978,16 @@ def remove_device(device, device_id_only=False):
         return False
 
 
-# Return a list of events matching specified search parameters and/or minimum
-# event id. If neither are provided, all visible events are returned.
-def get_events(search={}, minimum_event_id=0, suspicious=False):
+# Yields events matching specified search parameters and/or minimum event id,
+# one page (list of up to 50 events) at a time. If neither are provided, all
+# visible events are returned. Only one page is held in memory at once.
+@_client_bound_generator
+def iter_event_pages(search={}, minimum_event_id=0, suspicious=False):
+    fqdn, key = _credentials()
 
     #define HTTP headers for all requests in this method
     headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
 
-    #list to collect events
-    collected_events = []
-
     #Note that the API method we are calling returns up to 50 events at a time,
     #and we know we have all events when we get last_id=None back in the response
 
@@ -580,67 +2000,441 @@ def get_events(search={}, minimum_event_id=0, suspicious=False):
         else:
             request_url = f'https://{fqdn}/api/v1/events/search?after_event_id={str(minimum_event_id)}'
 
-        try:
-            #make request to server, store response
-            response = requests.post(request_url, headers=headers, json=search, timeout=30)
-            if response.status_code == 200:
-                #store the returned last_id value
-                minimum_event_id = response.json()['last_id']
-
-                #print result to console
-                if not quiet_mode:
-                    print(request_url, 'returned', response.status_code, 'with last_id', minimum_event_id, end='\r')
-
-                #if we got a none-null last_id back
-                if minimum_event_id != None:
-                    #then extract the events
-                    events = response.json()['events']
-                    #append the event(s) from this response to collected_events
-                    for event in events:
-                        collected_events.append(event)
-        except requests.exceptions.RequestException:
-            print('WARNING: Exception on', request_url, '. Will sleep for 10 seconds and try again.')
-            time.sleep(10)
+        #make request to server, store response (transient errors are retried
+        #by _request; if the retry budget runs out the exception is raised)
+        response = _request('POST', request_url, headers=headers, json=search)
 
         if response.status_code == 200:
+            response = _decode(response)
+
             #store the returned last_id value
-            minimum_event_id = response.json()['last_id']
+            minimum_event_id = response['last_id']
 
             #print result to console
             if not quiet_mode:
-                print(request_url, 'returned', response.status_code, 'with last_id', minimum_event_id, end='\r')
+                print(request_url, 'returned 200 with last_id', minimum_event_id, end='\r')
 
-            #if we got a none-null last_id back
+            #if we got a none-null last_id back, pass on the event(s) from this response
             if minimum_event_id != None:
-                #then extract the events
-                events = response.json()['events']
-                #append the event(s) from this response to collected_events
-                for event in events:
-                    collected_events.append(event)
+                yield response['events']
+        else:
+            print('ERROR: Unexpected return code', response.status_code, 'on request to', request_url)
+            raise requests.exceptions.HTTPError(f'Unexpected return code {response.status_code} on POST {request_url}', response=response)
     if not quiet_mode:
         print('\n')
 
-    #return the list of collected events
-    return collected_events
+
+# Returns the highest event id currently visible (0 if there are no events).
+# The search API has no sort order, so this finds it with an exponential then
+# binary search over after_event_id, which takes about 2*log2(max id) requests.
+def get_max_event_id(suspicious=False):
+    fqdn, key = _credentials()
+    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+    if suspicious:
+        base_url = f'https://{fqdn}/api/v1/suspicious-events/search'
+    else:
+        base_url = f'https://{fqdn}/api/v1/events/search'
+
+    #returns the last_id of the first page of events after after_event_id
+    def last_id_after(after_event_id):
+        request_url = f'{base_url}?after_event_id={after_event_id}'
+        response = _request('POST', request_url, headers=headers, json={})
+        if response.status_code != 200:
+            print('ERROR: Unexpected return code', response.status_code, 'on request to', request_url)
+            raise requests.exceptions.HTTPError(f'Unexpected return code {response.status_code} on POST {request_url}', response=response)
+        return _decode(response)['last_id']
+
+    #lower is always an existing event id (or 0), upper has no events after it
+    lower = 0
+    step = 1024
+    upper = None
+    while upper is None:
+        last_id = last_id_after(lower + step)
+        if last_id is None:
+            upper = lower + step
+        else:
+            lower = last_id
+            step *= 2
+    while upper > lower:
+        middle = (lower + upper) // 2
+        last_id = last_id_after(middle)
+        if last_id is None:
+            upper = middle
+        else:
+            lower = last_id
+    return lower
+
+
+# First-in first-out queue of pages for one shard of iter_event_pages_sharded.
+# Holds up to depth items in memory; while more are waiting, further items are
+# pickled to a temporary file and read back in order. put() never blocks.
+class _SpillQueue:
+
+    def __init__(self, depth):
+        self.depth = max(1, depth)
+        self._memory = collections.deque()
+        self._file = None
+        self._read_position = 0
+        self._spilled = 0  #items in the file not read yet
+        self._closed = False
+        self._ready = threading.Condition()
+
+    def put(self, item):
+        with self._ready:
+            if self._closed:
+                return
+            if self._spilled == 0 and len(self._memory) < self.depth:
+                self._memory.append(item)
+            else:
+                #everything in memory is older than anything in the file
+                if self._file is None:
+                    self._file = tempfile.TemporaryFile()
+                self._file.seek(0, os.SEEK_END)
+                pickle.dump(item, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+                self._spilled += 1
+            self._ready.notify()
+
+    def get(self):
+        with self._ready:
+            while len(self._memory) == 0 and self._spilled == 0:
+                self._ready.wait()
+            if len(self._memory) > 0:
+                return self._memory.popleft()
+            self._file.seek(self._read_position)
+            item = pickle.load(self._file)
+            self._read_position = self._file.tell()
+            self._spilled -= 1
+            if self._spilled == 0:
+                #reuse the file from the start
+                self._file.seek(0)
+                self._file.truncate()
+                self._read_position = 0
+            return item
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._memory.clear()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._spilled = 0
+
+
+# Yields pages of events after after_event_id, stopping at upper_event_id
+# (inclusive; None for no upper bound)
+@_client_bound_generator
+def _iter_event_pages_in_range(search, after_event_id, upper_event_id, suspicious):
+    pages = iter_event_pages(search=search, minimum_event_id=after_event_id, suspicious=suspicious)
+    try:
+        for events in pages:
+            if upper_event_id is not None:
+                events = [event for event in events if event['id'] <= upper_event_id]
+            if len(events) > 0:
+                yield events
+            if upper_event_id is not None and (len(events) == 0 or events[-1]['id'] >= upper_event_id):
+                break
+    finally:
+        pages.close()
+
+
+# Same as iter_event_pages, but splits the event id space into shards ranges
+# which are fetched concurrently, one thread per shard. Pages are still
+# yielded in event id order: pages of later shards are buffered until all
+# earlier shards are done, up to shard_queue_depth pages per shard in memory
+# and the rest in temporary files. The last shard has no upper bound, so
+# events created during the export are included just as with
+# iter_event_pages.
+@_client_bound_generator
+def iter_event_pages_sharded(search={}, minimum_event_id=0, suspicious=False, shards=8):
+    max_event_id = get_max_event_id(suspicious=suspicious)
+    span = max(0, max_event_id - minimum_event_id)
+    shards = max(1, min(shards, span // 50 or 1))  #no point in shards smaller than a page
+    bounds = [minimum_event_id + span * shard // shards for shard in range(shards)] + [None]
+    shard_queues = [_SpillQueue(shard_queue_depth) for shard in range(shards)]
+    stop = threading.Event()
+
+    def fetch_shard(shard):
+        pages = _iter_event_pages_in_range(search, bounds[shard], bounds[shard + 1], suspicious)
+        try:
+            for events in pages:
+                if stop.is_set():
+                    return
+                shard_queues[shard].put(events)
+            item = None
+        except Exception as e:
+            item = e
+        finally:
+            pages.close()
+        shard_queues[shard].put(item)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=shards) as executor:
+        for shard in range(shards):
+            executor.submit(_with_active_client(fetch_shard), shard)
+        try:
+            for shard_queue in shard_queues:
+                while True:
+                    events = shard_queue.get()
+                    if events is None:
+                        break
+                    if isinstance(events, Exception):
+                        raise events
+                    yield events
+        finally:
+            stop.set()
+            for shard_queue in shard_queues:
+                shard_queue.close()
+
+
+# Yields events matching specified search parameters and/or minimum event id
+# one at a time, with constant memory use. With shards greater than 1, the
+# pages are fetched concurrently by iter_event_pages_sharded. With
+# prefetch=N, up to N pages are requested ahead while the caller works.
+@_client_bound_generator
+def iter_events(search={}, minimum_event_id=0, suspicious=False, shards=1, prefetch=None, event_store=None):
+    store = _synced_event_store(search, suspicious, event_store, shards=shards)
+    if store is not None:
+        yield from store.iter_events(search=search, minimum_event_id=minimum_event_id)
+        return
+    if prefetch is None:
+        prefetch = prefetch_depth
+    if shards > 1:
+        pages = iter_event_pages_sharded(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious, shards=shards)
+    else:
+        pages = iter_event_pages(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious)
+    for events in prefetch_pages(pages, prefetch):
+        yield from events
+
+
+# Return a list of events matching specified search parameters and/or minimum
+# event id. If neither are provided, all visible events are returned. For
+# large exports, use shards=N to fetch N ranges of event ids in parallel.
+# With event_store=True, the local event store is synced and then searched
+# instead (see EventStore).
+def get_events(search={}, minimum_event_id=0, suspicious=False, shards=1, prefetch=None, event_store=None):
+    return list(iter_events(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious, shards=shards, prefetch=prefetch, event_store=event_store))
 
 
 # Return a list of suspicious events matching specified search parameters
 # and/or minimum event id. If neither are provided, all visible susipcious
 # events are returned.
-def get_suspicious_events(search={}, minimum_event_id=0):
-    return get_events(suspicious=True, search=search, minimum_event_id=minimum_event_id)
+def get_suspicious_events(search={}, minimum_event_id=0, shards=1, event_store=None):
+    return get_events(suspicious=True, search=search, minimum_event_id=minimum_event_id, shards=shards, event_store=event_store)
+
+
+# Folder in which EventStore keeps its SQLite files, one file per server
+event_store_folder = 'event_store'
+
+# If True, get_events, iter_events and get_event_counts_by_device_id answer
+# from the local event store (after syncing new events) instead of paging
+# through every event on the server. Can also be set per call with
+# event_store=True.
+use_event_store = False
+
+
+# Event fields which the server can change after an event is created (for
+# example when an event is closed, archived or re-occurs). The event store
+# does not answer searches on these fields, since its copy of older events
+# may be out of date; get_events sends such searches to the server instead.
+event_store_mutable_fields = {'status', 'close_trigger', 'close_timestamp',
+    'last_action', 'last_reoccurrence', 'reoccurrence_count', 'comment',
+    'file_status', 'sandbox_status', 'file_archive_hash', 'deep_classification',
+    'threat_severity', 'recorded_device_info'}
+
+
+# A local, append-only copy of the events on one server visible to one API
+# key, kept in a SQLite file (one per server and key, since keys of different
+# tenants see different events). sync() downloads only events newer than the highest event id already
+# stored (the high-water mark), so repeat analyses don't re-download the full
+# history:
+#   store = di.get_event_store()
+#   store.sync()
+#   events = store.get_events(search={'device_id': [1, 2]})
+#
+# Searches use the same format as get_events: a list of accepted values, a
+# single exact value, or a {'from': ..., 'to': ...} range per field. Searches
+# the store can't evaluate, including any search on a field in
+# event_store_mutable_fields, are answered by the server instead.
+#
+# Note that sync() only downloads new events. Changes to events already stored
+# (for example an event being closed or archived) are picked up by a full
+# re-download with sync(full=True).
+class EventStore:
+
+    def __init__(self, client=None, suspicious=False, path=None):
+        if client is None:
+            client = _active_client()
+        self.client = client
+        self.fqdn = client.fqdn
+        self.suspicious = suspicious
+        self._key_hash = _key_hash(client.key)
+        if path is None:
+            os.makedirs(event_store_folder, exist_ok=True)
+            path = os.path.join(event_store_folder, re.sub(r'[^\w.-]', '_', self.fqdn) + '_' + self._key_hash + '.sqlite')
+        self.path = path
+        self._table = 'suspicious_events' if suspicious else 'events'
+        self._sync_lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self._table} (id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS high_water_marks (name TEXT PRIMARY KEY, event_id INTEGER NOT NULL)')
+
+    def __repr__(self):
+        return f'EventStore({self.fqdn!r}, suspicious={self.suspicious})'
+
+    # Opens a connection to the SQLite file, committing on success
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    # Highest event id stored (0 if the store is empty)
+    @property
+    def high_water_mark(self):
+        with self._connect() as connection:
+            row = connection.execute('SELECT event_id FROM high_water_marks WHERE name = ?', (self._table,)).fetchone()
+        return row[0] if row else 0
+
+    # Number of events stored
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()[0]
+
+    # Downloads events newer than the high-water mark (all events if full is
+    # True) and stores them. Each page is committed together with the new
+    # high-water mark, so an interrupted sync resumes where it stopped.
+    # Returns the number of events downloaded.
+    def sync(self, full=False, shards=1):
+        if _key_hash(self.client.key) != self._key_hash:
+            raise ValueError(f'The API key of {self.client} changed since {self} was created; use get_event_store() for the new key')
+        with self._sync_lock, self.client.activate(), self._connect() as connection:
+            high_water_mark = self.high_water_mark
+            after_event_id = 0 if full else high_water_mark
+            if shards > 1:
+                pages = iter_event_pages_sharded(minimum_event_id=after_event_id, suspicious=self.suspicious, shards=shards)
+            else:
+                pages = iter_event_pages(minimum_event_id=after_event_id, suspicious=self.suspicious)
+            count = 0
+            for events in pages:
+                connection.executemany(f'INSERT OR REPLACE INTO {self._table} (id, data) VALUES (?, ?)',
+                    [(event['id'], json.dumps(event)) for event in events])
+                high_water_mark = max(high_water_mark, max(event['id'] for event in events))
+                connection.execute('INSERT OR REPLACE INTO high_water_marks (name, event_id) VALUES (?, ?)',
+                    (self._table, high_water_mark))
+                connection.commit()
+                count += len(events)
+        if not quiet_mode:
+            print('INFO:', count, 'events downloaded to', self.path, 'with high-water mark', high_water_mark)
+        return count
+
+    # Returns a SQL condition and parameters equivalent to a get_events search,
+    # or None if the search uses something the store can't evaluate or a field
+    # whose stored value may be out of date
+    @staticmethod
+    def _where(search, minimum_event_id=0):
+        conditions = ['id > ?']
+        parameters = [minimum_event_id]
+        for field, value in search.items():
+            if not re.fullmatch(r'\w+', field) or field in event_store_mutable_fields:
+                return None
+            column = f"json_extract(data, '$.{field}')"
+            if isinstance(value, list):
+                if len(value) == 0 or not all(isinstance(item, (str, int, float)) for item in value):
+                    return None
+                conditions.append(f'{column} IN ({", ".join("?" * len(value))})')
+                parameters.extend(value)
+            elif isinstance(value, dict):
+                #timestamp ranges; ISO 8601 timestamps in the same format sort as text
+                if len(value) == 0 or not set(value) <= {'from', 'to'}:
+                    return None
+                if 'from' in value:
+                    conditions.append(f'{column} >= ?')
+                    parameters.append(value['from'])
+                if 'to' in value:
+                    conditions.append(f'{column} <= ?')
+                    parameters.append(value['to'])
+            elif isinstance(value, (str, int, float)):
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+            else:
+                return None
+        return ' AND '.join(conditions), parameters
+
+    # Returns True if the store can evaluate the search locally
+    def supports(self, search):
+        return self._where(search) is not None
+
+    # Yields stored events matching the search parameters and/or minimum event
+    # id, in event id order, without syncing first
+    def iter_events(self, search={}, minimum_event_id=0):
+        where = self._where(search, minimum_event_id)
+        if where is None:
+            raise ValueError(f'Search {search} is not supported by the event store')
+        condition, parameters = where
+        with self._connect() as connection:
+            for row in connection.execute(f'SELECT data FROM {self._table} WHERE {condition} ORDER BY id', parameters):
+                yield _json_loads(row[0])
+
+    # Returns a list of stored events matching the search parameters and/or
+    # minimum event id, without syncing first
+    def get_events(self, search={}, minimum_event_id=0):
+        return list(self.iter_events(search=search, minimum_event_id=minimum_event_id))
+
+    # Returns a dictionary of {value: count} of stored events matching the
+    # search, grouped by the value of field (same as count_data_by_field)
+    def count_by(self, field, search={}, minimum_event_id=0):
+        where = self._where(search, minimum_event_id)
+        if where is None or not re.fullmatch(r'\w+', field) or field in event_store_mutable_fields:
+            raise ValueError(f'Search {search} by {field} is not supported by the event store')
+        condition, parameters = where
+        with self._connect() as connection:
+            rows = connection.execute(f"SELECT json_extract(data, '$.{field}'), COUNT(*) FROM {self._table} WHERE {condition} GROUP BY 1", parameters)
+            return dict(rows.fetchall())
+
+
+# Returns a short hash identifying an API key, for use in file names
+def _key_hash(key):
+    return hashlib.sha256(str(key).encode()).hexdigest()[:16]
+
+
+# Returns the EventStore for the active client's server and API key, creating
+# it on first use
+def get_event_store(suspicious=False):
+    client = _active_client()
+    cache_name = ('event_store', client.fqdn, client.key, suspicious)
+    if cache_name not in client.cache:
+        client.cache[cache_name] = EventStore(client, suspicious=suspicious)
+    return client.cache[cache_name]
+
+
+# Returns the synced EventStore if the search should and can be answered
+# locally, otherwise None
+def _synced_event_store(search, suspicious, event_store, shards=1):
+    if event_store is None:
+        event_store = use_event_store
+    if not event_store:
+        return None
+    store = get_event_store(suspicious=suspicious)
+    if not store.supports(search):
+        return None
+    store.sync(shards=shards)
+    return store
 
 
 #Return a list of all visible Device Groups
 def get_groups(exclude_default_groups=False):
+    fqdn, key = _credentials()
     # Calculate headers and URL
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/groups/'
     # Get Device Groups from server
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
     #Check response code
     if response.status_code == 200:
-        groups = response.json() #convert to Python list
+        groups = _decode(response) #convert to Python list
         #optionally remove the default groups before returning the data
         if exclude_default_groups:
             #Note [:]: syntax on line below to make a copy of list before iterating over it sincer we're going to be removing elements, as per https://stackoverflow.com/questions/7210578/why-does-list-remove-not-behave-as-one-might-expect
@@ -654,14 +2448,15 @@ def get_groups(exclude_default_groups=False):
 
 #Gets a single device
 def get_device(device_id):
+    fqdn, key = _credentials()
     # Calculate headers and URL
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}'
     # Get data on the requested device ID from the server
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
     # Check response code
     if response.status_code == 200:
-        device = response.json() #convert to Python list
+        device = _decode(response) #convert to Python list
         return device
     else:
         #in case of error getting data, return None
@@ -669,6 +2464,7 @@ def get_device(device_id):
 
 #hides a list of event ids from the GUI and REST API
 def archive_events (event_id_list, unarchive=False, suspicious=False):
+    fqdn, key = _credentials()
 
     # set headers (same for all requests in this method)
     headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
@@ -687,7 +2483,7 @@ def archive_events (event_id_list, unarchive=False, suspicious=False):
         request_url = f'https://{fqdn}/api/v1/suspicious-events/actions/unarchive'
 
     #send request to server
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = _request('POST', request_url, headers=headers, json=payload)
 
     #return true if successful, false otherwise
     return (response.status_code == 204)
@@ -710,6 +2506,7 @@ def unarchive_suspicious_events(event_id_list):
 
 #allows organization of exported data by server-specific folders
 def create_export_folder():
+    fqdn, key = _credentials()
     exported_data_folder_name = f'exported_data_from_{fqdn}'
     # Check if a folder already exists for data exports from this server
     if not os.path.exists(exported_data_folder_name):
@@ -717,7 +2514,379 @@ def create_export_folder():
         os.makedirs(exported_data_folder_name)
     return exported_data_folder_name
 
+# Number of rows that streaming export writers hold in memory and write at a
+# time
+export_chunk_size = 10000
+
+
+# Returns a copy of a record with nested dictionaries flattened into dotted
+# column names, like pandas.json_normalize. Example: recorded_device_info.hostname
+def _flatten_record(record, prefix=''):
+    flat = {}
+    for name, value in record.items():
+        if isinstance(value, dict) and len(value) > 0:
+            flat.update(_flatten_record(value, f'{prefix}{name}.'))
+        else:
+            flat[f'{prefix}{name}'] = value
+    return flat
+
+
+# Returns a value as written to text-based export formats: lists and
+# dictionaries as JSON, everything else unchanged
+def _export_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return value
+
+
+# Base class of the export writers. A writer is created with the file name
+# and optionally the columns to export, as a list or as a function that gets
+# the field names found in the records and returns the list. By default all
+# fields are exported, in order of first appearance. Records passed to write()
+# are consumed in chunks of export_chunk_size, so a writer can be fed straight
+# from iter_events or iter_devices without holding all the records in memory.
+#   with di.CsvExportWriter('devices.csv') as writer:
+#       writer.write(di.iter_devices())
+#
+# Unless a list of columns is given, the header is only known once every
+# record has been seen (a field may first appear in the last record). Until
+# then chunks are held in a temporary file next to the export and written out
+# on close(). If the export fails, the partial file is removed.
+class ExportWriter:
+
+    extension = ''
+
+    def __init__(self, file_name, columns=None, sheet_name='Sheet1'):
+        self.file_name = file_name
+        self.columns = columns
+        self.sheet_name = sheet_name
+        self.rows = 0  #number of records written
+        self._started = False
+        self._field_names = {}  #field names seen so far, in order of first appearance
+        self._held = None  #temporary file of chunks waiting for the columns
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.file_name!r}, rows={self.rows})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    # Writes records from a list or iterator
+    def write(self, records):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= export_chunk_size:
+                self._write_chunk(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            self._write_chunk(chunk)
+
+    # True if chunks can be written as they arrive
+    def _streaming(self):
+        return self.columns is not None and not callable(self.columns)
+
+    def _write_chunk(self, records):
+        if self._streaming():
+            self._begin()
+            self._write_rows(records)
+            self.rows += len(records)
+        else:
+            self._hold(records)
+
+    # Keeps a chunk in the temporary file until close()
+    def _hold(self, records):
+        for record in records:
+            self._field_names.update(dict.fromkeys(record))
+        if self._held is None:
+            self._held = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.file_name)))
+        pickle.dump(records, self._held, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Fixes the columns, calls _start and writes any held chunks
+    def _begin(self):
+        if self._started:
+            return
+        field_names = list(self._field_names)
+        if self.columns is None:
+            self.columns = field_names
+        elif callable(self.columns):
+            self.columns = list(self.columns(field_names))
+        self._start()
+        self._started = True
+        if self._held is not None:
+            self._held.seek(0)
+            while True:
+                try:
+                    records = pickle.load(self._held)
+                except EOFError:
+                    break
+                self._write_rows(records)
+                self.rows += len(records)
+            self._held.close()
+            self._held = None
+
+    # Called once the columns are known, before the first rows are written
+    def _start(self):
+        pass
+
+    def _write_rows(self, records):
+        raise NotImplementedError
+
+    # Closes the output file
+    def _finish(self):
+        pass
+
+    # Writes everything still held and closes the file. If that fails, the
+    # partial file is removed.
+    def close(self):
+        try:
+            self._begin()
+            self._finish()
+        except BaseException:
+            self.discard()
+            raise
+
+    # Closes and removes the file, e.g. after an error
+    def discard(self):
+        if self._held is not None:
+            self._held.close()
+            self._held = None
+        try:
+            self._finish()
+        except Exception:
+            pass
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+# Writes records to a CSV file. Lists and dictionaries are written as JSON.
+class CsvExportWriter(ExportWriter):
+
+    extension = '.csv'
+
+    def __init__(self, file_name, columns=None, sheet_name='Sheet1'):
+        super().__init__(file_name, columns=columns, sheet_name=sheet_name)
+        self._file = open(file_name, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+
+    def _start(self):
+        self._writer.writerow(self.columns)
+
+    def _write_rows(self, records):
+        columns = self.columns
+        self._writer.writerows([_export_value(record.get(column)) for column in columns] for record in records)
+
+    def _finish(self):
+        self._file.close()
+
+
+# Writes records to a gzip-compressed JSON Lines file (one JSON object per line)
+class JsonLinesExportWriter(ExportWriter):
+
+    extension = '.jsonl.gz'
+
+    def __init__(self, file_name, columns=None, sheet_name='Sheet1'):
+        super().__init__(file_name, columns=columns, sheet_name=sheet_name)
+        self._file = gzip.open(file_name, 'wt', encoding='utf-8')
+
+    def _write_rows(self, records):
+        columns = self.columns
+        self._file.writelines(json.dumps({column: record.get(column) for column in columns}, default=str) + '\n' for record in records)
+
+    def _finish(self):
+        self._file.close()
+
+
+# Writes records to a Parquet file, one row group per chunk. Requires the
+# optional pyarrow library (pip install pyarrow). Column types are chosen
+# from all records: a column holding only booleans, only integers or only
+# numbers is stored as such, and anything else (mixed types, text, empty
+# columns, lists and dictionaries as JSON) is stored as strings.
+class ParquetExportWriter(ExportWriter):
+
+    extension = '.parquet'
+
+    def __init__(self, file_name, columns=None, sheet_name='Sheet1'):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet export requires pyarrow. Install it with: pip install pyarrow')
+        super().__init__(file_name, columns=columns, sheet_name=sheet_name)
+        self._pyarrow = pyarrow
+        self._value_types = {}  #field name -> set of value types seen
+        self._schema = None
+        self._writer = None
+
+    #column types depend on every record, so records are always held first
+    def _streaming(self):
+        return False
+
+    def _hold(self, records):
+        for record in records:
+            for name, value in record.items():
+                value = _export_value(value)
+                if value is None:
+                    continue
+                value_type = type(value)
+                if value_type is int and not -2**63 <= value < 2**63:
+                    value_type = str
+                self._value_types.setdefault(name, set()).add(value_type)
+        super()._hold(records)
+
+    def _start(self):
+        pyarrow = self._pyarrow
+        fields = []
+        for column in self.columns:
+            value_types = self._value_types.get(column, set())
+            if value_types == {bool}:
+                field_type = pyarrow.bool_()
+            elif value_types == {int}:
+                field_type = pyarrow.int64()
+            elif len(value_types) > 0 and value_types <= {int, float}:
+                field_type = pyarrow.float64()
+            else:
+                field_type = pyarrow.string()
+            fields.append(pyarrow.field(column, field_type))
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(self.file_name, self._schema)
+
+    def _write_rows(self, records):
+        pyarrow = self._pyarrow
+        data = {}
+        for field in self._schema:
+            values = [_export_value(record.get(field.name)) for record in records]
+            if pyarrow.types.is_string(field.type):
+                values = [value if value is None else str(value) for value in values]
+            elif pyarrow.types.is_floating(field.type):
+                values = [value if value is None else float(value) for value in values]
+            data[field.name] = values
+        self._writer.write_table(pyarrow.Table.from_pydict(data, schema=self._schema))
+
+    def _finish(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# Largest number of rows on an Excel worksheet, including the header row
+excel_max_rows = 1048576
+
+
+# Returns a value as written to an Excel cell: lists and dictionaries as JSON,
+# NaN as an empty cell, and text cut to Excel's limit of 32,767 characters
+def _excel_value(value):
+    value = _export_value(value)
+    if isinstance(value, str):
+        return value[:32767]
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+# Writes records to an Excel workbook row by row with constant memory use,
+# using xlsxwriter in constant_memory mode if installed, otherwise openpyxl
+# in write-only mode. When a sheet reaches excel_max_rows, writing continues
+# on a new sheet (Event_Data, Event_Data_2, ...) with the same header row.
+class ExcelExportWriter(ExportWriter):
+
+    extension = '.xlsx'
+
+    def __init__(self, file_name, columns=None, sheet_name='Sheet1'):
+        super().__init__(file_name, columns=columns, sheet_name=sheet_name)
+        try:
+            import xlsxwriter
+            self._workbook = xlsxwriter.Workbook(file_name, {'constant_memory': True,
+                'strings_to_numbers': False, 'strings_to_formulas': False, 'strings_to_urls': False})
+            self._engine = 'xlsxwriter'
+        except ImportError:
+            try:
+                import openpyxl
+            except ImportError:
+                raise ImportError('Excel export requires xlsxwriter or openpyxl. Install one with: pip install xlsxwriter')
+            self._workbook = openpyxl.Workbook(write_only=True)
+            self._engine = 'openpyxl'
+        self._sheet = None
+        self._sheet_rows = 0  #rows on the current sheet, including the header
+        self.sheets = 0  #number of sheets written
+
+    def _add_sheet(self):
+        self.sheets += 1
+        sheet_name = self.sheet_name
+        if self.sheets > 1:
+            sheet_name = f'{sheet_name[:25]}_{self.sheets}'
+        if self._engine == 'xlsxwriter':
+            self._sheet = self._workbook.add_worksheet(sheet_name)
+        else:
+            self._sheet = self._workbook.create_sheet(sheet_name)
+        self._sheet_rows = 0
+        self._append(self.columns)
+
+    def _append(self, values):
+        if self._engine == 'xlsxwriter':
+            self._sheet.write_row(self._sheet_rows, 0, values)
+        else:
+            self._sheet.append(values)
+        self._sheet_rows += 1
+
+    def _start(self):
+        self._add_sheet()
+
+    def _write_rows(self, records):
+        columns = self.columns
+        for record in records:
+            if self._sheet_rows >= excel_max_rows:
+                self._add_sheet()
+            self._append([_excel_value(record.get(column)) for column in columns])
+
+    def _finish(self):
+        if self._workbook is None:
+            return
+        if self._sheet is None:
+            #nothing was written; a workbook needs at least one sheet
+            self._add_sheet()
+        if self._engine == 'xlsxwriter':
+            self._workbook.close()
+        else:
+            self._workbook.save(self.file_name)
+        self._workbook = None
+
+
+# Export file formats supported by the export_ methods (file_format=...), as
+# {file_format: writer class}. All of them stream the records to disk with
+# flat memory use: 'xlsx' (the default), 'csv', 'jsonl' (gzip-compressed JSON
+# Lines) and 'parquet'.
+export_writers = {
+    'xlsx': ExcelExportWriter,
+    'csv': CsvExportWriter,
+    'jsonl': JsonLinesExportWriter,
+    'parquet': ParquetExportWriter,
+}
+
+
+# Writes records (a list or iterator) to a new file in the export folder named
+# <name>_<timestamp>_<server>.<extension>. Returns the writer, which has the
+# file_name and number of rows written.
+def _export_records(name, records, file_format='xlsx', columns=None, sheet_name='Sheet1'):
+    fqdn, key = _credentials()
+    if file_format not in export_writers:
+        raise ValueError(f'Unknown export file format {file_format}. Supported formats are: {", ".join(export_writers)}')
+    writer_class = export_writers[file_format]
+    folder_name = create_export_folder()
+    timestamp = datetime.datetime.today().strftime('%Y-%m-%d_%H.%M')
+    file_name = f'{folder_name}/{name}_{timestamp}_{fqdn.split(".",1)[0]}{writer_class.extension}'
+    with writer_class(file_name, columns=columns, sheet_name=sheet_name) as writer:
+        writer.write(records)
+    return writer
+
+
 def get_event(event_id, suspicious=False):
+    fqdn, key = _credentials()
 
     #define headers
     headers = {'accept': 'application/json', 'Authorization': key}
@@ -729,11 +2898,11 @@ def get_event(event_id, suspicious=False):
         request_url = f'https://{fqdn}/api/v1/events/{str(event_id)}'
 
     #make request, store response
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
 
     # based on response code, return event or alternately an error code
     if response.status_code == 200:
-        return response.json()['event']
+        return _decode(response)['event']
     elif response.status_code == 404:
         print('ERROR: Event', str(event_id), 'not found')
         return []
@@ -742,6 +2911,7 @@ def get_event(event_id, suspicious=False):
         return []
 
 def create_policy(name, base_policy_id, comment='', quiet_mode=False):
+    fqdn, key = _credentials()
 
     #define headers
     headers = {'accept': 'application/json', 'Authorization': key}
@@ -753,11 +2923,11 @@ def create_policy(name, base_policy_id, comment='', quiet_mode=False):
     payload = {'name': name, 'comment': comment, 'base_policy_id': base_policy_id}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
 
     # Check response code
     if response.status_code == 200:
-        response = response.json()
+        response = _decode(response)
         if not quiet_mode:
             print('INFO: Policy', response['id'], response['name'], 'created')
         return response
@@ -767,6 +2937,7 @@ def create_policy(name, base_policy_id, comment='', quiet_mode=False):
         return None
 
 def delete_policy(policy_id):
+    fqdn, key = _credentials()
 
     #define headers
     headers = {'accept': 'application/json', 'Authorization': key}
@@ -775,7 +2946,7 @@ def delete_policy(policy_id):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}'
 
     # Send request to server
-    response = requests.delete(request_url, headers=headers)
+    response = _request('DELETE', request_url, headers=headers)
 
     # Check response code
     if response.status_code == 204:
@@ -792,45 +2963,47 @@ def delete_policy(policy_id):
         'on DELETE to', request_url)
         return False
 
-def export_events(minimum_event_id=0, suspicious=False, flatten_device_info=True, search={}):
+# Columns exported by export_events, in order. Columns not present in the
+# event data are skipped, which keeps exports working if the product API adds
+# or removes event fields.
+event_export_column_names = ['id', 'status', 'action', 'type', 'trigger', 'threat_severity', 'file_hash', 'deep_classification', 'file_archive_hash', 'path', 'timestamp', 'insertion_timestamp', 'close_timestamp', 'close_trigger', 'last_reoccurrence', 'reoccurrence_count', 'last_action', 'device_id', 'recorded_device_info.os', 'recorded_device_info.mac_address', 'recorded_device_info.hostname', 'recorded_device_info.tag', 'recorded_device_info.group_name', 'recorded_device_info.policy_name', 'recorded_device_info.tenant_name', 'comment', 'mitre_classifications', 'file_size', 'file_status', 'sandbox_status', 'msp_name', 'msp_id', 'tenant_name', 'tenant_id']
 
-    events = get_events(minimum_event_id=minimum_event_id, suspicious=suspicious, search=search)
 
-    if len(events) > 0:
+# Returns the columns of event_export_column_names that are in column_names
+def _event_export_columns(column_names):
+    return [column_name for column_name in event_export_column_names if column_name in column_names]
+
+
+# Exports events (sorted by id) to Excel, or with file_format='csv', 'jsonl'
+# or 'parquet' streamed to disk page by page (see export_writers)
+def export_events(minimum_event_id=0, suspicious=False, flatten_device_info=True, search={}, file_format='xlsx'):
+    events = iter_events(minimum_event_id=minimum_event_id, suspicious=suspicious, search=search)
+    first_event = next(events, None)
+
+    if first_event is not None:
+        events = itertools.chain([first_event], events)
         if flatten_device_info:
             #flattens recorded_device_info into discreet columns. Examples: recorded_device_info.hostname, recorded_device_info.policy_name
-            events = pandas.json_normalize(events)
-        events_df = pandas.DataFrame(events)
-        events_df.sort_values(by=['id'], inplace=True)
-        folder_name = create_export_folder()
-        file_name = f'events_{datetime.datetime.today().strftime("%Y-%m-%d_%H.%M")}_{fqdn.split(".",1)[0]}.xlsx'
+            events = (_flatten_record(event) for event in events)
+        name = 'events'
         if suspicious:
-            file_name = f'suspicious_{file_name}'
-
-        #this logic improves resiliency case the product API adds/removes columns from event data
-        export_column_names = ['id', 'status', 'action', 'type', 'trigger', 'threat_severity', 'file_hash', 'deep_classification', 'file_archive_hash', 'path', 'timestamp', 'insertion_timestamp', 'close_timestamp', 'close_trigger', 'last_reoccurrence', 'reoccurrence_count', 'last_action', 'device_id', 'recorded_device_info.os', 'recorded_device_info.mac_address', 'recorded_device_info.hostname', 'recorded_device_info.tag', 'recorded_device_info.group_name', 'recorded_device_info.policy_name', 'recorded_device_info.tenant_name', 'comment', 'mitre_classifications', 'file_size', 'file_status', 'sandbox_status', 'msp_name', 'msp_id', 'tenant_name', 'tenant_id']
-        events_df_column_names = list(events_df.columns.values)
-        columns = []
-        for column_name in export_column_names:
-            if column_name in events_df_column_names:
-                columns.append(column_name)
-
-        #now that we have what we know is a valid list of coulmns, proceed
-        events_df.to_excel(f'{folder_name}/{file_name}', index=False, sheet_name='Event_Data', columns=columns)
-        print (f'INFO: {str(len(events))} events exported to {folder_name}/{file_name}')
+            name = f'suspicious_{name}'
+
+        writer = _export_records(name, events, file_format=file_format, columns=_event_export_columns, sheet_name='Event_Data')
+        print (f'INFO: {str(writer.rows)} events exported to {writer.file_name}')
+        return writer.file_name
     else:
         print('WARNING: No events were found on the server')
 
-def export_groups(exclude_default_groups=False):
+def export_groups(exclude_default_groups=False, file_format='xlsx'):
     groups = get_groups(exclude_default_groups=exclude_default_groups)
-    groups_df = pandas.DataFrame(groups)
-    folder_name = create_export_folder()
-    file_name = f'groups_{datetime.datetime.today().strftime("%Y-%m-%d_%H.%M")}_{fqdn.split(".",1)[0]}.xlsx'
-    groups_df.to_excel(f'{folder_name}/{file_name}', index=False)
-    print (f'INFO: {str(len(groups))} groups exported to {folder_name}/{file_name}')
+    writer = _export_records('groups', groups, file_format=file_format)
+    print (f'INFO: {str(writer.rows)} groups exported to {writer.file_name}')
+    return writer.file_name
 
 
 def create_tenant(tenant_name, license_limit, msp_name):
+    fqdn, key = _credentials()
 
     #convert provided msp_name to msp_id
     msp_id = get_msp_id(msp_name)
@@ -847,7 +3020,7 @@ def create_tenant(tenant_name, license_limit, msp_name):
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/'
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return success or descriptive error
     if response.status_code == 200: #tenant creation was successful
@@ -874,6 +3047,7 @@ def get_msp_id(msp_name):
 
 
 def delete_tenant(tenant_name, msp_name):
+    fqdn, key = _credentials()
 
     #convert provided msp_name to msp_id
     msp_id = get_msp_id(msp_name)
@@ -891,7 +3065,7 @@ def delete_tenant(tenant_name, msp_name):
     headers = {'Authorization': key}
 
     #send request to server
-    response = requests.delete(request_url, headers=headers)
+    response = _request('DELETE', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -908,6 +3082,7 @@ def delete_tenant(tenant_name, msp_name):
         return False
 
 def request_agent_logs(device_id, device_id_only=True):
+    fqdn, key = _credentials()
 
     if not device_id_only:
         device_id = device_id['id']
@@ -917,7 +3092,7 @@ def request_agent_logs(device_id, device_id_only=True):
     headers = {'Authorization': key, 'accept': 'application/json'}
 
     # Send request to server
-    response = requests.post(request_url, headers=headers)
+    response = _request('POST', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -934,6 +3109,7 @@ def request_agent_logs(device_id, device_id_only=True):
         return False
 
 def close_events(event_id_list, open=False, suspicious=False):
+    fqdn, key = _credentials()
 
     #calculate URL
     if suspicious:
@@ -954,7 +3130,7 @@ def close_events(event_id_list, open=False, suspicious=False):
     payload = {'ids': event_id_list}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -977,6 +3153,7 @@ def open_suspicious_events(event_id_list):
     return open_events(event_id_list=event_id_list, suspicious=True)
 
 def archive_events(event_id_list, unarchive=False, suspicious=False):
+    fqdn, key = _credentials()
 
     #calculate URL
     if suspicious:
@@ -997,7 +3174,7 @@ def archive_events(event_id_list, unarchive=False, suspicious=False):
     payload = {'ids': event_id_list}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -1012,6 +3189,7 @@ def archive_events(event_id_list, unarchive=False, suspicious=False):
 
 # Disable scanning and enforcement on a device
 def disable_device(device, device_id_only=False):
+    fqdn, key = _credentials()
 
     #PROCESS INPUT
     if device_id_only:
@@ -1024,7 +3202,7 @@ def disable_device(device, device_id_only=False):
     #DISABLE THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/disable'
     headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = _request('POST', request_url, headers=headers)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -1037,6 +3215,7 @@ def disable_device(device, device_id_only=False):
 
 # Enable scanning and enforcement on a device
 def enable_device(device, device_id_only=False):
+    fqdn, key = _credentials()
 
     #PROCESS INPUT
     if device_id_only:
@@ -1049,7 +3228,7 @@ def enable_device(device, device_id_only=False):
     #ENABLE THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/enable'
     headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = _request('POST', request_url, headers=headers)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -1060,22 +3239,27 @@ def enable_device(device, device_id_only=False):
         return False
 
 
-def get_event_counts_by_device_id(minimum_event_id=0, event_filters={}):
+def get_event_counts_by_device_id(minimum_event_id=0, event_filters={}, event_store=None):
 
-    #get event data from server
-    events = get_events(minimum_event_id=minimum_event_id, search=event_filters)
+    #if enabled, count in the local event store without downloading all events
+    store = _synced_event_store(event_filters, False, event_store)
+    if store is not None:
+        return store.count_by('device_id', search=event_filters, minimum_event_id=minimum_event_id)
 
-    #convert to PivotTable style summary of event count by device id
+    #stream event data from server into a PivotTable style summary of event
+    #count by device id, without holding all events in memory
+    events = iter_events(minimum_event_id=minimum_event_id, search=event_filters)
     event_counts = count_data_by_field(events, 'device_id')
 
     #return the data
     return event_counts
 
 
-def export_event_count_by_device_id(minimum_event_id=0, event_filters={}):
+def export_event_count_by_device_id(minimum_event_id=0, event_filters={}, event_store=None):
+    fqdn, key = _credentials()
 
     #get events counts
-    event_counts = get_event_counts_by_device_id(minimum_event_id=minimum_event_id, event_filters=event_filters)
+    event_counts = get_event_counts_by_device_id(minimum_event_id=minimum_event_id, event_filters=event_filters, event_store=event_store)
 
     #above returns a dictionary; the syntax below flattens this into a 2-column dataframe
     event_counts_df = pandas.DataFrame(list(event_counts.items()),columns = ['device_id','event_count'])
@@ -1094,38 +3278,363 @@ def export_event_count_by_device_id(minimum_event_id=0, event_filters={}):
     #return event_counts in case needed for further analysis in another method
     return event_counts
 
+# Returns a dictionary of {value: number of records with that value in
+# field_name}. data may be a list or an iterator such as iter_events().
 def count_data_by_field(data, field_name):
+    return count_by(data, field_name)
+
+
+# Derived fields that Aggregator can group by in addition to record fields,
+# as {name: function(record) -> value}. Add entries to define your own.
+aggregation_fields = {
+    'day': lambda record: record['timestamp'][:10] if record.get('timestamp') else None,
+}
+
+
+# Returns the value of a field of a record: a derived field from
+# aggregation_fields, a field name, or a dotted path into nested dictionaries
+# such as 'recorded_device_info.hostname'. Missing fields return None.
+def _field_value(record, field_name):
+    if field_name in aggregation_fields:
+        return aggregation_fields[field_name](record)
+    if field_name in record or '.' not in field_name:
+        return record.get(field_name)
+    value = record
+    for part in field_name.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+# Streaming group-by over records (events, devices, ...). Records are consumed
+# one at a time, for example straight from iter_events(), and only one entry
+# per distinct group is kept, so memory scales with the number of groups
+# rather than the number of records. For each group it tracks the count, and
+# optionally the minimum and maximum of some fields and the number of
+# distinct values of others.
+#   aggregator = di.Aggregator(['device_id', 'day'], maximum=['timestamp'], distinct=['type'])
+#   aggregator.update(di.iter_events(search={'status': ['OPEN']}))
+#   aggregator.results()
+#   -> [{'device_id': 12, 'day': '2022-05-01', 'count': 3, 'max_timestamp': ..., 'distinct_type': 2}, ...]
+class Aggregator:
+
+    def __init__(self, keys, minimum=[], maximum=[], distinct=[]):
+        self.keys = list(keys)
+        self.minimum = list(minimum)
+        self.maximum = list(maximum)
+        self.distinct = list(distinct)
+        self.total = 0  #number of records consumed
+        self._counts = collections.Counter()  #group -> count
+        self._minimums = {}  #group -> list of minimums, in the order of self.minimum
+        self._maximums = {}  #group -> list of maximums, in the order of self.maximum
+        self._distincts = {}  #group -> list of sets of values, in the order of self.distinct
+
+    def __repr__(self):
+        return f'Aggregator({self.keys}, groups={len(self._counts)}, total={self.total})'
+
+    def __len__(self):
+        return len(self._counts)
+
+    # Consumes records from a list or iterator. Returns self, so calls can be
+    # chained.
+    def update(self, records):
+        keys = self.keys
+        if not (self.minimum or self.maximum or self.distinct):
+            #count only; let Counter do the work
+            before = sum(self._counts.values())
+            self._counts.update(tuple(_field_value(record, key) for key in keys) for record in records)
+            self.total += sum(self._counts.values()) - before
+            return self
+        for record in records:
+            self.add(record)
+        return self
+
+    # Consumes one record
+    def add(self, record):
+        group = tuple(_field_value(record, key) for key in self.keys)
+        self.total += 1
+        self._counts[group] += 1
+        for position, field_name in enumerate(self.minimum):
+            value = _field_value(record, field_name)
+            if value is not None:
+                minimums = self._minimums.setdefault(group, [None] * len(self.minimum))
+                if minimums[position] is None or value < minimums[position]:
+                    minimums[position] = value
+        for position, field_name in enumerate(self.maximum):
+            value = _field_value(record, field_name)
+            if value is not None:
+                maximums = self._maximums.setdefault(group, [None] * len(self.maximum))
+                if maximums[position] is None or value > maximums[position]:
+                    maximums[position] = value
+        if self.distinct:
+            distincts = self._distincts.setdefault(group, [set() for field_name in self.distinct])
+            for position, field_name in enumerate(self.distinct):
+                value = _field_value(record, field_name)
+                if value is not None:
+                    distincts[position].add(value)
+
+    # Returns a dictionary of {group: count}. With a single key field the
+    # group is that field's value, otherwise a tuple of the key values.
+    def counts(self):
+        if len(self.keys) == 1:
+            return {group[0]: count for group, count in self._counts.items()}
+        return dict(self._counts)
+
+    # Returns one dictionary per group with the key fields, count,
+    # min_<field>, max_<field> and distinct_<field> (number of distinct values)
+    def results(self):
+        results = []
+        for group, count in self._counts.items():
+            result = dict(zip(self.keys, group))
+            result['count'] = count
+            minimums = self._minimums.get(group, [None] * len(self.minimum))
+            for field_name, value in zip(self.minimum, minimums):
+                result[f'min_{field_name}'] = value
+            maximums = self._maximums.get(group, [None] * len(self.maximum))
+            for field_name, value in zip(self.maximum, maximums):
+                result[f'max_{field_name}'] = value
+            distincts = self._distincts.get(group, [set() for field_name in self.distinct])
+            for field_name, values in zip(self.distinct, distincts):
+                result[f'distinct_{field_name}'] = len(values)
+            results.append(result)
+        return results
+
+
+# Groups records (list or iterator) by one or more fields in a single pass and
+# returns one dictionary per group; see Aggregator
+def aggregate(data, keys, minimum=[], maximum=[], distinct=[]):
+    return Aggregator(keys, minimum=minimum, maximum=maximum, distinct=distinct).update(data).results()
+
+
+# Helpers for combining related records (devices, policies, groups, events,
+# tenants, msps) with dictionary lookups instead of nested loops, so joining
+# n records to m related records takes O(n+m) rather than O(n*m).
+
+# Returns a dictionary of {record[field_name]: record}. If several records
+# have the same value, the last one wins.
+def index_by(data, field_name='id'):
+    return {record.get(field_name): record for record in data}
+
+
+# Returns a dictionary of {value: list of records with record[field_name] == value}
+def group_by(data, field_name):
     result = {}
     for record in data:
-        if record[field_name] in result.keys():
-            result[record[field_name]] += 1
-        else:
-            result[record[field_name]] = 1
+        result.setdefault(record.get(field_name), []).append(record)
     return result
 
-def is_prevention_policy(policy, exclude_static_analysis=False, exclude_ransomware_behavior=False, exclude_remote_code_injection=False, exclude_arbritrary_shallcode_execution=False):
-
-    verdict = False #start with false until proven otherwise
 
-    #For windows, require that all [currently exposed] features that Best Practices call for general usage be in prevention
-    if policy['os'] == 'WINDOWS':
-        if policy['prevention_level'] in ('LOW', 'MEDIUM') or exclude_static_analysis:
-            if policy['ransomware_behavior'] == 'PREVENT' or exclude_ransomware_behavior:
-                if policy['remote_code_injection'] == 'PREVENT' or exclude_remote_code_injection:
-                    if policy['arbitrary_shellcode_execution'] == 'PREVENT' or exclude_arbritrary_shallcode_execution:
-                        verdict = True
+# Returns a dictionary of {value: number of records with record[field_name] == value}
+def count_by(data, field_name):
+    return Aggregator([field_name]).update(data).counts()
 
-    #This covers all non-Windows platforms that have a prevention threshold (current and future)
-    elif 'prevention_level' in policy.keys():
-        if policy['prevention_level'] in ('LOW', 'MEDIUM', 'HIGH') or exclude_static_analysis:
-            verdict = True
 
-    return verdict
+# For each record in data, finds the record in related whose related_field
+# matches record[field_name] and copies the listed fields from it into the
+# record, named prefix + field. Records without a match get None for those
+# fields. Modifies data in place and returns it.
+#   di.join(devices, 'policy_id', policies, ['name'], prefix='policy_')
+#   -> every device gets a 'policy_name'
+def join(data, field_name, related, fields, related_field='id', prefix=''):
+    related_index = index_by(related, related_field)
+    for record in data:
+        match = related_index.get(record.get(field_name))
+        for field in fields:
+            record[prefix + field] = match.get(field) if match is not None else None
+    return data
+
+
+# Adds fields of each device's policy to the device (default: policy_name)
+def join_devices_to_policies(devices, policies, fields=['name']):
+    return join(devices, 'policy_id', policies, fields, prefix='policy_')
+
+
+# Adds fields of each device's group to the device (default: group_name)
+def join_devices_to_groups(devices, groups, fields=['name']):
+    return join(devices, 'group_id', groups, fields, prefix='group_')
+
+
+# Adds fields of the device that raised each event to the event (default:
+# device_hostname)
+def join_events_to_devices(events, devices, fields=['hostname']):
+    return join(events, 'device_id', devices, fields, prefix='device_')
+
+
+# Adds fields of each tenant's MSP to the tenant (default: msp_name)
+def join_tenants_to_msps(tenants, msps, fields=['name']):
+    return join(tenants, 'msp_id', msps, fields, prefix='msp_')
+
+# Rules that policy settings are evaluated against, as {name: list of rules}.
+# Each rule is a dictionary with:
+#   field             - policy data field, e.g. 'ransomware_behavior'
+#   operator          - 'in' (value must be one of values) or 'not in'
+#   values            - list of expected (or, for 'not in', disallowed) values
+#   platforms         - optional list of platforms the rule applies to
+#   exclude_platforms - optional list of platforms the rule doesn't apply to
+#   name              - optional name reported for violations (default: field)
+# A policy missing a field violates any 'in' rule on it. Add entries or pass
+# your own lists of rules to evaluate_policy_rules.
+policy_rules = {
+    #features that Best Practices call for in general usage are in prevention
+    'prevention': [
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM'], 'platforms': ['WINDOWS']},
+        {'field': 'ransomware_behavior', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'remote_code_injection', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'arbitrary_shellcode_execution', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM', 'HIGH'], 'exclude_platforms': ['WINDOWS']},
+    ],
+    #policy is in prevention mode at any prevention level
+    'prevention_mode': [
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM', 'HIGH'], 'platforms': ['WINDOWS']},
+        {'field': 'ransomware_behavior', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'remote_code_injection', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'arbitrary_shellcode_execution', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM', 'HIGH'], 'exclude_platforms': ['WINDOWS']},
+    ],
+    #Ransomware Warranty requirements for Windows policies
+    #TODO: D-Cloud Services and Malicious PowerShell Prevention (not yet visible via the REST API; FR-166 and FR-167)
+    'warranty_compliance': [
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['HIGH', 'MEDIUM', 'LOW'], 'platforms': ['WINDOWS']},
+        {'field': 'remote_code_injection', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'arbitrary_shellcode_execution', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'ransomware_behavior', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+    ],
+    #prescribed security settings for Windows policies
+    'prescribed_settings': [
+        {'name': 'Static Analysis PE Detection', 'field': 'detection_level', 'operator': 'in', 'values': ['MEDIUM'], 'platforms': ['WINDOWS']},
+        {'name': 'Static Analysis PE Prevention', 'field': 'prevention_level', 'operator': 'in', 'values': ['MEDIUM'], 'platforms': ['WINDOWS']},
+        {'name': 'Known PUA', 'field': 'protection_level_pua', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'Network Drive Protection', 'field': 'scan_network_drives', 'operator': 'in', 'values': [True], 'platforms': ['WINDOWS']},
+        {'name': 'Macro Execution', 'field': 'office_macro_script_action', 'operator': 'in', 'values': ['USE_D_BRAIN'], 'platforms': ['WINDOWS']},
+        {'name': 'Ransomware', 'field': 'ransomware_behavior', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'In-Memory Protection', 'field': 'in_memory_protection', 'operator': 'in', 'values': [True], 'platforms': ['WINDOWS']},
+        {'name': 'Arbitrary Shellcode', 'field': 'arbitrary_shellcode_execution', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'Remote Code Injection', 'field': 'remote_code_injection', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'Reflective DLL Injection', 'field': 'reflective_dll_loading', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': '.Net Reflection', 'field': 'reflective_dotnet_injection', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'AMSI Bypass', 'field': 'amsi_bypass', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'Credential Dumping', 'field': 'credentials_dump', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'Known Payload Execution', 'field': 'known_payload_execution', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'PowerShell', 'field': 'powershell_script_action', 'operator': 'in', 'values': ['ALLOW'], 'platforms': ['WINDOWS']},
+        {'name': 'HTML Applications', 'field': 'html_applications_action', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'name': 'ActiveScript Usage', 'field': 'prevent_all_activescript_usage', 'operator': 'in', 'values': ['ALLOW'], 'platforms': ['WINDOWS']},
+        {'name': 'ActiveScript Execution', 'field': 'activescript_action', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+    ],
+}
+
+
+# Stands in for the value of a field a policy doesn't have; it is not equal
+# to any value, so a missing field violates any 'in' rule on it
+_missing_field = object()
+
+
+# Returns a boolean array of which values are in accepted
+def _isin(values, accepted):
+    return numpy.fromiter((value in accepted for value in values), dtype=bool, count=len(values))
+
+
+# Returns a boolean array of the policies that violate a rule, given the
+# platform of each policy and its value of the rule's field (_missing_field
+# if it has none). This is the only place the rule operators are defined.
+def _rule_violations(rule, platforms, values):
+    if rule['operator'] not in ('in', 'not in'):
+        raise ValueError(f"Unknown operator {rule['operator']} in policy rule for {rule['field']}")
+    applies = numpy.ones(len(platforms), dtype=bool)
+    if 'platforms' in rule:
+        applies &= _isin(platforms, rule['platforms'])
+    if 'exclude_platforms' in rule:
+        applies &= ~_isin(platforms, rule['exclude_platforms'])
+    matches = _isin(values, rule['values'])
+    if rule['operator'] == 'in':
+        return applies & ~matches
+    return applies & matches
+
+
+# Checks rules against a list of policies, one column of values per rule.
+# Returns (violated, rule_violations): a boolean array with one entry per
+# policy, and a list of (rule name, values, positions of violating policies)
+# for each rule that is violated.
+def _check_policy_rules(policies, rules, ignore_fields=[]):
+    if isinstance(rules, str):
+        rules = policy_rules[rules]
+    platforms = [policy.get('os') for policy in policies]
+    violated = numpy.zeros(len(policies), dtype=bool)
+    rule_violations = []
+    for rule in rules:
+        if rule['field'] in ignore_fields:
+            continue
+        values = [policy.get(rule['field'], _missing_field) for policy in policies]
+        rule_violated = _rule_violations(rule, platforms, values)
+        if rule_violated.any():
+            violated |= rule_violated
+            rule_violations.append((rule.get('name', rule['field']), values, numpy.flatnonzero(rule_violated)))
+    return violated, rule_violations
+
+
+# Evaluates a list of rules (or the name of an entry in policy_rules) against
+# a list of policies as returned by get_policies(include_policy_data=True).
+# Each rule is checked for all policies at once as a column comparison, so
+# large policy sets (e.g. every tenant policy on a multi-tenancy server)
+# evaluate quickly, while a single policy costs no more than a few lookups.
+# Rules on fields in ignore_fields are skipped.
+#
+# Returns one dictionary per policy, in the same order, with the policy 'id',
+# 'verdict' (True if no applicable rule is violated) and 'violations' as
+# {rule name: actual value}.
+def evaluate_policy_rules(policies, rules, ignore_fields=[]):
+    if len(policies) == 0:
+        return []
+    violated, rule_violations = _check_policy_rules(policies, rules, ignore_fields=ignore_fields)
+    results = [{'id': policy.get('id'), 'verdict': not violated[position], 'violations': {}} for position, policy in enumerate(policies)]
+    for name, values, positions in rule_violations:
+        for position in positions:
+            value = values[position]
+            if value is _missing_field:
+                value = None
+            results[position]['violations'][name] = value
+    return results
+
+
+# Classifies policies by the first entry of classes ({label: rules}) whose
+# rules they pass, or default if none. Returns a list of labels in the same
+# order as policies.
+def classify_policies(policies, classes, default=None, ignore_fields=[]):
+    labels = numpy.full(len(policies), None, dtype=object)
+    unclassified = numpy.ones(len(policies), dtype=bool)
+    if len(policies) > 0:
+        for label, rules in classes.items():
+            violated, rule_violations = _check_policy_rules(policies, rules, ignore_fields=ignore_fields)
+            passed = unclassified & ~violated
+            labels[passed] = label
+            unclassified &= ~passed
+    labels[unclassified] = default
+    return labels.tolist()
+
+
+# Returns True if the policy is in prevention per policy_rules['prevention'].
+# The exclude_ flags skip the corresponding setting.
+def is_prevention_policy(policy, exclude_static_analysis=False, exclude_ransomware_behavior=False, exclude_remote_code_injection=False, exclude_arbritrary_shallcode_execution=False):
+    #non-Windows platforms without a prevention threshold have no prevention mode
+    if policy['os'] != 'WINDOWS' and 'prevention_level' not in policy.keys():
+        return False
+    ignore_fields = []
+    if exclude_static_analysis:
+        ignore_fields.append('prevention_level')
+    if exclude_ransomware_behavior:
+        ignore_fields.append('ransomware_behavior')
+    if exclude_remote_code_injection:
+        ignore_fields.append('remote_code_injection')
+    if exclude_arbritrary_shallcode_execution:
+        ignore_fields.append('arbitrary_shellcode_execution')
+    violated, rule_violations = _check_policy_rules([policy], 'prevention', ignore_fields=ignore_fields)
+    return not violated[0]
 
 def download_uploaded_file(file_hash):
+    fqdn, key = _credentials()
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/events/actions/download-uploaded-file/{file_hash}'
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
     if response.status_code == 200:
         folder_name = create_export_folder()
         file_name = f'{file_hash}.zip'
@@ -1136,13 +3645,14 @@ def download_uploaded_file(file_hash):
         return False
 
 def request_malware_sample(event_id):
+    fqdn, key = _credentials()
 
     #calculate URL and headers
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/devices/actions/request-remote-file-upload/{event_id}'
 
     # Send request to server
-    response = requests.post(request_url, headers=headers)
+    response = _request('POST', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -1156,6 +3666,7 @@ def request_malware_sample(event_id):
         return False
 
 def isolate_from_network(devices, release_from_isolation=False, input_is_hostnames=True):
+    fqdn, key = _credentials()
 
     if input_is_hostnames:
         device_ids = get_device_ids(search_list=devices)
@@ -1172,7 +3683,7 @@ def isolate_from_network(devices, release_from_isolation=False, input_is_hostnam
                 'Authorization': key}
     payload = {'ids': device_ids}
 
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = _request('POST', request_url, headers=headers, json=payload)
 
     if response.status_code == 200:
         if remove_from_isolation:
@@ -1190,7 +3701,132 @@ def remove_from_isolation(device_ids, input_is_hostnames=True):
     return isolate_from_network(device_ids=device_ids, release_from_isolation=True, input_is_hostnames=input_is_hostnames)
 
 
+# A collection of file hashes with set semantics, for de-duplicating and
+# comparing allow/deny list contents without scanning lists. Hashes are
+# compared case-insensitively and with surrounding whitespace ignored, while
+# the first spelling seen of each hash is the one kept and returned.
+#
+# By default the collection is an exact set that remembers insertion order.
+# For multi-million hash corpora, bloom_filter=True stores the hashes in a
+# Bloom filter sized for capacity hashes at the given error_rate instead
+# (about 1.8 MB per million hashes at the default 0.1%). Memory is then fixed
+# up front, but the hashes can't be listed back out and membership tests may
+# give false positives (never false negatives), at up to error_rate once
+# capacity hashes have been added.
+#   hashes = di.HashCollection(event['file_hash'] for event in events)
+#   hashes_to_remove = hashes.missing(hash_list)
+class HashCollection:
+
+    def __init__(self, hashes=[], bloom_filter=False, capacity=10000000, error_rate=0.001):
+        self.bloom_filter = bloom_filter
+        self._count = 0
+        if bloom_filter:
+            if capacity < 1 or not 0 < error_rate < 1:
+                raise ValueError('capacity must be at least 1 and error_rate between 0 and 1')
+            self._bit_count = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+            self._hash_count = max(1, int(round(self._bit_count / capacity * math.log(2))))
+            self._bits = bytearray((self._bit_count + 7) // 8)
+        else:
+            self._hashes = {}  #normalized hash -> hash as first seen
+        self.update(hashes)
+
+    def __repr__(self):
+        if self.bloom_filter:
+            return f'HashCollection({self._count} hashes, bloom_filter=True, {len(self._bits)} bytes)'
+        return f'HashCollection({self._count} hashes)'
+
+    # Number of distinct hashes added. In Bloom filter mode this is an
+    # estimate that can undercount slightly, as a false positive on add is
+    # taken to mean the hash was already present.
+    def __len__(self):
+        return self._count
+
+    # Yields the hashes in the order they were first added (exact mode only)
+    def __iter__(self):
+        if self.bloom_filter:
+            raise TypeError('a HashCollection in bloom_filter mode can not be iterated')
+        return iter(self._hashes.values())
+
+    # Returns the bit positions of a normalized hash in the Bloom filter,
+    # derived from one blake2b digest by double hashing
+    def _positions(self, normalized):
+        digest = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self._bit_count for i in range(self._hash_count)]
+
+    # Adds a hash. Returns True if it was not already in the collection.
+    def add(self, hash):
+        normalized = str(hash).strip().lower()
+        if not self.bloom_filter:
+            if normalized in self._hashes:
+                return False
+            self._hashes[normalized] = hash
+            self._count += 1
+            return True
+        bits = self._bits
+        new = False
+        for position in self._positions(normalized):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        if new:
+            self._count += 1
+        return new
+
+    # Adds hashes from a list or iterator. Returns self, so calls can be
+    # chained.
+    def update(self, hashes):
+        for hash in hashes:
+            self.add(hash)
+        return self
+
+    def __contains__(self, hash):
+        normalized = str(hash).strip().lower()
+        if not self.bloom_filter:
+            return normalized in self._hashes
+        bits = self._bits
+        for position in self._positions(normalized):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    # Returns the hashes as a list in the order they were first added (exact
+    # mode only)
+    def to_list(self):
+        return list(self)
+
+    # Returns the hashes from hash_list that are not in this collection, de-
+    # duplicated and in their original order. In Bloom filter mode a false
+    # positive can leave a hash out, never add one.
+    def missing(self, hash_list):
+        return [hash for hash in HashCollection(hash_list) if hash not in self]
+
+    # Returns the hashes from hash_list that are also in this collection, de-
+    # duplicated and in their original order
+    def present(self, hash_list):
+        return [hash for hash in HashCollection(hash_list) if hash in self]
+
+    # Builds a collection from the values of one field in a list or iterator
+    # of records (e.g. events), skipping records without a value
+    @classmethod
+    def from_records(cls, records, field_name='file_hash', **kwargs):
+        collection = cls(**kwargs)
+        for record in records:
+            value = record.get(field_name)
+            if value:
+                collection.add(value)
+        return collection
+
+
+# Returns the hashes from hash_list de-duplicated, in their original order
+def deduplicate_hashes(hash_list):
+    return HashCollection(hash_list).to_list()
+
+
 def add_hashes_to_deny_list(hash_list, policy_id=0, all_policies=False, platforms=['WINDOWS','MAC','LINUX','NETWORK_AGENTLESS']):
+    fqdn, key = _credentials()
 
     policies = get_policies(include_policy_data=False)
     policy_id_list = []
@@ -1199,8 +3835,8 @@ def add_hashes_to_deny_list(hash_list, policy_id=0, all_policies=False, platform
             if all_policies or policy['id'] == policy_id:
                 policy_id_list.append(policy['id'])
 
-    payload = {'items:': []}
-    for hash in hash_list:
+    payload = {'items': []}
+    for hash in deduplicate_hashes(hash_list):
         payload_entry = {'item': hash, 'comment': 'Deny Listed by di.add_hashes_to_deny_list'}
         payload['items'].append(payload_entry)
 
@@ -1211,7 +3847,7 @@ def add_hashes_to_deny_list(hash_list, policy_id=0, all_policies=False, platform
     error_count = 0
     for policy_id in policy_id_list:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/deny-list/hashes'
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = _request('POST', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('INFO: Successfully added', len(payload['items']), 'hashes to the deny list for policy', policy_id)
         else:
@@ -1222,72 +3858,341 @@ def add_hashes_to_deny_list(hash_list, policy_id=0, all_policies=False, platform
     else:
         return True
 
-# Method to copy policies from one MSP to another on a multi-tenancy server
-def migrate_policies(source_msp_id, destination_msp_id, platforms_to_migrate=['WINDOWS', 'MAC'], allow_deny_and_exclusion_list_types = ['allow-list/hashes', 'allow-list/paths', 'allow-list/certificates', 'allow-list/process_paths', 'allow-list/scripts', 'deny-list/hashes', 'exclusion-list/folder_path', 'exclusion-list/process_path'] , null_comment_workaround_enabled=True):
-
-    #get policies from each of the MSPs
-    source_msp_policies = get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True, msp_id=source_msp_id)
-    destination_msp_policies = get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True, msp_id=destination_msp_id)
-
-    #build list of policy names in destination MSP (so as to avoid collissions)
-    destination_msp_policy_names = []
-    for policy in destination_msp_policies:
-        destination_msp_policy_names.append(policy['name'])
+# Returns the key that identifies an item in an allow, deny or exclusion list:
+# its 'item' value (case-insensitive for hash lists), or for items without one
+# all of its fields. Comments are not part of the key.
+def _list_item_key(list_type, item):
+    if isinstance(item, str):
+        value = item
+    elif 'item' in item:
+        value = item['item']
+    else:
+        return json.dumps({name: value for name, value in item.items() if name != 'comment'}, sort_keys=True)
+    if list_type.endswith('/hashes') and isinstance(value, str):
+        return value.strip().lower()
+    return value
+
+
+# Returns a list item ready to be written to the server. Plain strings become
+# {'item': value, 'comment': ''}, and a missing or null (None) comment is
+# replaced with an empty string to avoid an HTTP 400 error.
+def _list_item_payload(item):
+    if isinstance(item, str):
+        return {'item': item, 'comment': ''}
+    item = dict(item)
+    if item.get('comment') is None:
+        item['comment'] = ''
+    return item
+
+
+# Compares the current and desired contents of one allow, deny or exclusion
+# list. Returns (items_to_add, items_to_remove). Items are only removed when
+# remove_extra is True; otherwise the desired items are added to what is
+# already there.
+def diff_list_items(list_type, current_items, desired_items, remove_extra=False):
+    current = {_list_item_key(list_type, item): item for item in current_items}
+    desired = {}
+    for item in desired_items:
+        desired.setdefault(_list_item_key(list_type, item), item)
+    items_to_add = [_list_item_payload(item) for item_key, item in desired.items() if item_key not in current]
+    items_to_remove = []
+    if remove_extra:
+        items_to_remove = [_list_item_payload(item) for item_key, item in current.items() if item_key not in desired]
+    return items_to_add, items_to_remove
+
+
+# Brings allow, deny and exclusion lists to a desired state, sending only the
+# difference from what is on the server. desired_state is a dictionary of
+# {policy_id: {list_type: items}}, where items are list entries as returned by
+# get_policies (e.g. {'item': ..., 'comment': ...}) or plain strings. Current
+# contents are read concurrently (reusing lists fetched less than max_age
+# seconds ago, default policy_cache_ttl), and additions and removals are sent
+# concurrently in batches of up to batch_size items. Lists that are already
+# in the desired state cost no write requests at all.
+#
+# Lists already in hand can be passed as current_state, in the same shape as
+# desired_state, to skip reading them again. With dry_run=True nothing is
+# written. A list type the server has no API method for (404) is skipped with
+# a warning and counted under 'lists_skipped' rather than as an error.
+# Returns a dictionary summarizing the changes, including one entry per
+# changed list under 'changes'.
+#   di.sync_policy_lists({1001: {'allow-list/hashes': ['9e78...', 'e3b0...']}})
+def sync_policy_lists(desired_state, remove_extra=False, batch_size=500, dry_run=False, max_age=None, current_state={}):
+    fqdn, key = _credentials()
+    summary = {'lists_checked': 0, 'lists_changed': 0, 'lists_skipped': 0, 'items_added': 0, 'items_removed': 0,
+        'requests': 0, 'errors': 0, 'changes': []}
+
+    #read current contents of each list not passed in current_state
+    def get_list(policy_id, list_type):
+        if list_type in current_state.get(policy_id, {}):
+            return 200, {'items': current_state[policy_id][list_type]}
+        return _get_policy_part(policy_id, list_type, max_age=max_age)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list_futures = {}
+        for policy_id in desired_state:
+            for list_type in desired_state[policy_id]:
+                list_futures[policy_id, list_type] = executor.submit(_with_active_client(get_list), policy_id, list_type)
+        requests_to_send = []
+        for (policy_id, list_type), future in list_futures.items():
+            status_code, current = future.result()
+            if status_code == 404:
+                print('WARNING: Response 404 reading', list_type, 'for policy', policy_id, '. This list type is not available on this server and was skipped.')
+                summary['lists_skipped'] += 1
+                continue
+            if current is None:
+                print('ERROR: Unexpected response', status_code, 'reading', list_type, 'for policy', policy_id)
+                summary['errors'] += 1
+                continue
+            summary['lists_checked'] += 1
+            items_to_add, items_to_remove = diff_list_items(list_type, current['items'], desired_state[policy_id][list_type], remove_extra=remove_extra)
+            if len(items_to_add) == 0 and len(items_to_remove) == 0:
+                continue
+            summary['lists_changed'] += 1
+            summary['items_added'] += len(items_to_add)
+            summary['items_removed'] += len(items_to_remove)
+            summary['changes'].append({'policy_id': policy_id, 'list_type': list_type,
+                'items_to_add': items_to_add, 'items_to_remove': items_to_remove})
+            for method, items in (('DELETE', items_to_remove), ('POST', items_to_add)):
+                for start in range(0, len(items), batch_size):
+                    requests_to_send.append((method, policy_id, list_type, items[start:start + batch_size]))
+
+        if dry_run:
+            summary['requests'] = len(requests_to_send)
+            return summary
+
+        #write the changes
+        def send(method, policy_id, list_type, items):
+            request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/{list_type}'
+            headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+            response = _request(method, request_url, headers=headers, json={'items': items})
+            if response.status_code == 404:
+                print('WARNING: Response', response.status_code, 'on', method, 'to', request_url, '. This indicates there is no API method for this list type on this server, so it was skipped.')
+            elif response.status_code != 204:
+                print('ERROR: Unexpected response', response.status_code, 'on', method, 'to', request_url)
+            return response.status_code
+
+        send_futures = [executor.submit(_with_active_client(send), *request) for request in requests_to_send]
+        skipped_lists = set()
+        for request, future in zip(requests_to_send, send_futures):
+            summary['requests'] += 1
+            status_code = future.result()
+            if status_code == 404:
+                skipped_lists.add(request[1:3])
+            elif status_code != 204:
+                summary['errors'] += 1
+        summary['lists_skipped'] += len(skipped_lists)
 
-    #build a dictionary of default policy IDs in destination MSP (used for policy creation)
+    if not quiet_mode:
+        print('INFO: Checked', summary['lists_checked'], 'lists, added', summary['items_added'], 'and removed',
+            summary['items_removed'], 'items using', summary['requests'], 'requests')
+    return summary
+
+
+# Makes every policy in policy_ids contain every item that any of them has in
+# each of the given list types, sending only the items each policy is missing
+def expand_lists_to_policies(policy_ids, list_types=allow_deny_and_exclusion_list_types, batch_size=500, dry_run=False, max_age=None):
+    policy_ids = list(policy_ids)
+    policies = get_policies(include_allow_deny_lists=True, keep_data_encapsulated=True, max_age=max_age)
+    lists = {policy['id']: policy['allow_deny_and_exclusion_lists'] for policy in policies if policy['id'] in policy_ids}
+
+    #union of the items of each list type across the policies
+    desired_items = {}
+    current_state = {}
+    for list_type in list_types:
+        items_by_key = {}
+        for policy_id in policy_ids:
+            if policy_id in lists and list_type in lists[policy_id]:
+                items = lists[policy_id][list_type]['items']
+                current_state.setdefault(policy_id, {})[list_type] = items
+                for item in items:
+                    items_by_key.setdefault(_list_item_key(list_type, item), item)
+        desired_items[list_type] = list(items_by_key.values())
+
+    desired_state = {}
+    for policy_id in current_state:
+        desired_state[policy_id] = {list_type: desired_items[list_type] for list_type in current_state[policy_id]}
+    return sync_policy_lists(desired_state, batch_size=batch_size, dry_run=dry_run, current_state=current_state)
+
+
+# Returns a SHA-256 hex digest of JSON-compatible data, independent of the
+# order of dictionary keys
+def _content_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+# Plans copying policies to a destination (another MSP or another server)
+# without sending any requests. source_policies and destination_policies are
+# as returned by get_policies(include_policy_data=True,
+# keep_data_encapsulated=True, include_allow_deny_lists=True); destination
+# lists may be left out, in which case they are read when the plan is run.
+#
+# Policies are matched by name. Returns one entry per source policy of the
+# given platforms, with 'action' set to:
+#   'create'   - no policy by that name at the destination yet
+#   'update'   - policy data (compared by content hash) or lists differ
+#   'skip'     - destination already matches
+#   'conflict' - the name is used by more than one source policy or by a
+#                destination policy of another platform, or there is no
+#                default policy to base a new policy on ('conflict_reason'
+#                says which)
+# and the work to do: 'update_data', 'lists' (the source items by list type,
+# for lists missing any of them), 'list_items' (the number of items to add)
+# and 'requests' (the estimated number of write requests).
+def plan_policy_migration(source_policies, destination_policies, platforms_to_migrate=['WINDOWS', 'MAC'], allow_deny_and_exclusion_list_types=allow_deny_and_exclusion_list_types, batch_size=500):
+    destination_policies_by_name = {}
     destination_default_policy_ids = {}
-    for policy in destination_msp_policies:
+    for policy in destination_policies:
+        destination_policies_by_name.setdefault(policy['name'], policy)
         if policy['is_default_policy']:
-            destination_default_policy_ids[policy['os']] = policy['id']
-
-    #build list of policies to migrate
-    policies_to_migrate = []
-    for source_msp_policy in source_msp_policies:
-        if source_msp_policy['os'] in platforms_to_migrate:
-            policies_to_migrate.append(source_msp_policy)
-
-    #Migrate the policies
-    for policy in policies_to_migrate:
-
-        #first step is to create the base policy, which we'll base on the platform-specific default policy
-        if policy['name'] in destination_msp_policy_names:
-            for destination_msp_policy in destination_msp_policies:
-                if policy['name'] == destination_msp_policy['name']:
-                    new_policy = destination_msp_policy
+            destination_default_policy_ids.setdefault(policy['os'], policy['id'])
+
+    source_policies = [policy for policy in source_policies if policy['os'] in platforms_to_migrate]
+    source_name_counts = collections.Counter(policy['name'] for policy in source_policies)
+
+    plan = []
+    for policy in source_policies:
+        entry = {'name': policy['name'], 'os': policy['os'], 'source_policy_id': policy['id'],
+            'destination_policy_id': None, 'base_policy_id': None, 'action': 'update', 'conflict_reason': None,
+            'content_hash': _content_hash(policy.get('data')), 'data': policy.get('data'),
+            'update_data': 'data' in policy, 'lists': {}, 'current_lists': {}, 'list_items': 0, 'requests': 0}
+        plan.append(entry)
+
+        destination_policy = destination_policies_by_name.get(policy['name'])
+        if source_name_counts[policy['name']] > 1:
+            #policies are matched by name, so both would create or overwrite the same policy
+            entry['action'] = 'conflict'
+            entry['conflict_reason'] = f'{source_name_counts[policy["name"]]} source policies have this name'
+            continue
+        if destination_policy is None:
+            entry['action'] = 'create'
+            entry['base_policy_id'] = destination_default_policy_ids.get(policy['os'])
+            if entry['base_policy_id'] is None:
+                entry['action'] = 'conflict'
+                entry['conflict_reason'] = f'there is no default {policy["os"]} policy at the destination'
+                continue
+            entry['requests'] += 1
+        elif destination_policy['os'] != policy['os']:
+            entry['action'] = 'conflict'
+            entry['conflict_reason'] = f'the name is used by a {destination_policy["os"]} policy at the destination'
+            entry['destination_policy_id'] = destination_policy['id']
+            continue
         else:
-            new_policy = create_policy(policy['name'], destination_default_policy_ids[policy['os']], quiet_mode=True, )
-
-        #next step is to overwrite the policy data on the newly-create policy with data from source policy
-        new_policy_id = new_policy['id']
-        request_url = f'https://{fqdn}/api/v1/policies/{new_policy_id}/data'
-        headers = {'accept': 'application/json', 'Authorization': key}
-        payload = {'data': policy['data']}
-        response = requests.put(request_url, json=payload, headers=headers)
-        if response.status_code != 204:
-            print('ERROR: Unexpected response', response.status_code, 'on PUT to', request_url)
-
-        #last step is to migrate the associated allow list, deny list, and exclusion lists for the policy
-        headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+            entry['destination_policy_id'] = destination_policy['id']
+            if 'data' in destination_policy and _content_hash(destination_policy['data']) == entry['content_hash']:
+                entry['update_data'] = False
+        if entry['update_data']:
+            entry['requests'] += 1
+
+        source_lists = policy.get('allow_deny_and_exclusion_lists', {})
+        destination_lists = {}
+        if destination_policy is not None:
+            destination_lists = destination_policy.get('allow_deny_and_exclusion_lists', {})
         for list_type in allow_deny_and_exclusion_list_types:
-            if list_type in policy['allow_deny_and_exclusion_lists']:
-                if len(policy['allow_deny_and_exclusion_lists'][list_type]['items']) > 0:
+            if list_type not in source_lists or len(source_lists[list_type]['items']) == 0:
+                continue
+            items = source_lists[list_type]['items']
+            if list_type in destination_lists:
+                entry['current_lists'][list_type] = destination_lists[list_type]['items']
+                items_to_add, items_to_remove = diff_list_items(list_type, destination_lists[list_type]['items'], items)
+                if len(items_to_add) == 0:
+                    continue
+            else:
+                items_to_add = items
+            entry['lists'][list_type] = items
+            entry['list_items'] += len(items_to_add)
+            entry['requests'] += -(-len(items_to_add) // batch_size)
+
+        if entry['action'] == 'update' and not entry['update_data'] and len(entry['lists']) == 0:
+            entry['action'] = 'skip'
+    return plan
+
+
+# Returns the cost of a migration plan: the number of policies per action,
+# the list items to copy and the estimated number of write requests
+def policy_migration_cost(plan):
+    cost = {'policies': len(plan), 'create': 0, 'update': 0, 'skip': 0, 'conflict': 0, 'list_items': 0, 'requests': 0}
+    for entry in plan:
+        cost[entry['action']] += 1
+        cost['requests'] += entry['requests']
+        cost['list_items'] += entry['list_items']
+    return cost
+
+
+# Runs a migration plan from plan_policy_migration against the active client.
+# Policies are migrated concurrently on up to max_workers threads; for each
+# policy the dependent steps run in order: create the policy, then write its
+# data, then add the missing list items. Sets 'destination_policy_id' and
+# 'success' on each entry and returns the plan.
+def run_policy_migration(plan, batch_size=500):
+    fqdn, key = _credentials()
+
+    def migrate(entry):
+        if entry['action'] == 'skip':
+            return True
+        if entry['action'] == 'conflict':
+            print('ERROR: Unable to migrate', entry['os'], 'policy', entry['name'], 'because', entry['conflict_reason'])
+            return False
 
-                    #workaround to issue where entries with {'comment': None} trigger HTTP 400 error when writing data
-                    if null_comment_workaround_enabled:
-                        for item in policy['allow_deny_and_exclusion_lists'][list_type]['items']:
-                            if 'comment' in item.keys():
-                                if item['comment'] == None:
-                                    item['comment'] = ''
+        #create the policy, based on the platform-specific default policy
+        if entry['action'] == 'create':
+            new_policy = create_policy(entry['name'], entry['base_policy_id'], quiet_mode=True)
+            if new_policy is None:
+                return False
+            entry['destination_policy_id'] = new_policy['id']
+        policy_id = entry['destination_policy_id']
 
-                    payload = policy['allow_deny_and_exclusion_lists'][list_type]
-                    request_url = f'https://{fqdn}/api/v1/policies/{new_policy_id}/{list_type}'
-                    response = requests.post(request_url, headers=headers, json=payload)
-                    if response.status_code != 204:
-                        print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
+        #overwrite the policy data with data from the source policy
+        if entry['update_data']:
+            request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
+            headers = {'accept': 'application/json', 'Authorization': key}
+            response = _request('PUT', request_url, json={'data': entry['data']}, headers=headers)
+            if response.status_code != 204:
+                print('ERROR: Unexpected response', response.status_code, 'on PUT to', request_url)
+                return False
+
+        #add the allow list, deny list, and exclusion list items it is missing
+        if len(entry['lists']) > 0:
+            current_state = {}
+            if entry['action'] == 'update':
+                current_state = {policy_id: entry['current_lists']}
+            summary = sync_policy_lists({policy_id: entry['lists']}, batch_size=batch_size, current_state=current_state)
+            if summary['errors'] > 0:
+                return False
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_with_active_client(migrate), entry) for entry in plan]
+        for entry, future in zip(plan, futures):
+            entry['success'] = future.result()
+    return plan
+
+
+# Method to copy policies from one MSP to another on a multi-tenancy server.
+# Builds a plan with plan_policy_migration and runs it with
+# run_policy_migration, so policies that already match are skipped and only
+# missing list items are copied. With dry_run=True the plan and its cost are
+# printed but nothing is changed. Returns the plan. Null (None) comments on
+# list items are always replaced; null_comment_workaround_enabled is kept for
+# backwards compatibility.
+def migrate_policies(source_msp_id, destination_msp_id, platforms_to_migrate=['WINDOWS', 'MAC'], allow_deny_and_exclusion_list_types = ['allow-list/hashes', 'allow-list/paths', 'allow-list/certificates', 'allow-list/process_paths', 'allow-list/scripts', 'deny-list/hashes', 'exclusion-list/folder_path', 'exclusion-list/process_path'] , null_comment_workaround_enabled=True, dry_run=False):
+    #get policies from each of the MSPs
+    source_msp_policies = get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True, msp_id=source_msp_id)
+    destination_msp_policies = get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True, msp_id=destination_msp_id)
 
-    print('INFO: Done migrating', len(policies_to_migrate), 'policies from MSP', source_msp_id , 'to MSP', destination_msp_id)
+    plan = plan_policy_migration(source_msp_policies, destination_msp_policies, platforms_to_migrate=platforms_to_migrate, allow_deny_and_exclusion_list_types=allow_deny_and_exclusion_list_types)
+    cost = policy_migration_cost(plan)
+    print('INFO: Migration plan from MSP', source_msp_id, 'to MSP', destination_msp_id, ':', cost['create'], 'to create,', cost['update'], 'to update,',
+        cost['skip'], 'already up to date,', cost['conflict'], 'conflicts,', cost['list_items'], 'list items and about', cost['requests'], 'write requests')
+    if dry_run:
+        return plan
+
+    run_policy_migration(plan)
+    print('INFO: Done migrating', len(plan), 'policies from MSP', source_msp_id , 'to MSP', destination_msp_id)
+    return plan
 
 def health_check(minimum_event_id=0):
+    fqdn, key = _credentials()
     export_devices()
     print()
     export_policies()
@@ -1300,12 +4205,13 @@ def health_check(minimum_event_id=0):
     wcs.do_warranty_compliance_check(fqdn=fqdn, key=key, exclude_empty_policies=True)
 
 def add_process_exclusion(exclusion, policy_id, comment='', exclusion_type='process_path', delete=False):
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/exclusion-list/{exclusion_type}'
     headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
 
     if not delete:
         payload = {'items': [ {'item': exclusion, 'comment': comment} ]}
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = _request('POST', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('Successfully added', exclusion_type, 'exclusion', exclusion, 'to policy', policy_id)
             return True
@@ -1315,7 +4221,7 @@ def add_process_exclusion(exclusion, policy_id, comment='', exclusion_type='proc
 
     else:
         payload = {'items': [ {'item': exclusion} ]}
-        response = requests.delete(request_url, headers=headers, json=payload)
+        response = _request('DELETE', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('Successfully removed', exclusion_type, 'exclusion', exclusion, 'from policy', policy_id)
             return True
@@ -1334,11 +4240,12 @@ def remove_folder_exclusion(exclusion, policy_id):
     return add_folder_exclusionn(exclusion=exclusion, policy_id=policy_id, delete=True)
 
 def remove_all_exclusions(policy_id, exclusion_types=['folder_path', 'process_path']):
+    fqdn, key = _credentials()
     headers = {'accept': 'application/json', 'Authorization': key}
     for exclusion_type in exclusion_types:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/exclusion-list/{exclusion_type}'
-        response = requests.get(request_url, headers=headers)
-        exclusions = response.json()['items']
+        response = _request('GET', request_url, headers=headers)
+        exclusions = _decode(response)['items']
         if len(exclusions) > 0:
             print('INFO: Removing', len(exclusions), exclusion_type, 'exclusions from policy', policy_id)
             for exclusion in exclusions:
@@ -1346,25 +4253,26 @@ def remove_all_exclusions(policy_id, exclusion_types=['folder_path', 'process_pa
                 add_process_exclusion(exclusion=exclusion, policy_id=policy_id, exclusion_type=exclusion_type, delete=True)
 
 def add_allow_list_hashes(hash_list, policy_id, comment='', delete=False):
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/hashes'
     headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
 
     item_list = []
-    for hash in hash_list:
+    for hash in deduplicate_hashes(hash_list):
         item = {'item': hash, 'comment': comment}
         item_list.append(item)
     payload = {'items': item_list}
 
     if not delete:
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = _request('POST', request_url, headers=headers, json=payload)
     else:
-        response = requests.delete(request_url, headers=headers, json=payload)
+        response = _request('DELETE', request_url, headers=headers, json=payload)
 
     if response.status_code == 204:
         if not delete:
-            print('Successfully added', len(hash_list), 'hashes to allow list for policy', policy_id)
+            print('Successfully added', len(item_list), 'hashes to allow list for policy', policy_id)
         else:
-            print('Successfully removed', len(hash_list), 'hashes from allow list for policy', policy_id)
+            print('Successfully removed', len(item_list), 'hashes from allow list for policy', policy_id)
         return True
     else:
         print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
@@ -1374,8 +4282,9 @@ def remove_allow_list_hashes(hash_list, policy_id):
     return add_allow_list_hashes(hash_list, policy_id, delete=True)
 
 def is_server_multitenancy_enabled():
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp'
-    response = requests.get(request_url)
+    response = _request('GET', request_url)
     if response.status_code == 404:
         return False
     else:
@@ -1384,11 +4293,10 @@ def is_server_multitenancy_enabled():
 def remove_all_allow_list_hashes():
     policies = get_policies(include_allow_deny_lists=True, keep_data_encapsulated=True)
     for policy in policies:
-        if len( policy['allow_deny_and_exclusion_lists']['allow-list/hashes']['items'] ) > 1:
-            hash_list = []
-            for item in policy['allow_deny_and_exclusion_lists']['allow-list/hashes']['items']:
-                hash_list.append(item['item'])
-            remove_allow_list_hashes(hash_list, policy['id'])
+        items = policy['allow_deny_and_exclusion_lists']['allow-list/hashes']['items']
+        if len(items) > 1:
+            hashes = HashCollection(item['item'] for item in items)
+            remove_allow_list_hashes(hashes.to_list(), policy['id'])
 
 #Archives (hides from GUI and API) a single device
 def archive_device(device, device_id_only=False):
@@ -1401,56 +4309,47 @@ def archive_device(device, device_id_only=False):
 
 #returns first (lowest device id) device ID matching a single hostname; excludes deactivated devices
 def get_device_id(hostname):
-    headers = {'accept': 'application/json', 'Authorization': key}
-    last_id = 0
-    while last_id != None:
-        request_url = f'https://{fqdn}/api/v1/devices?after_device_id={last_id}'
-        response = requests.get(request_url, headers=headers)
-        if response.status_code == 200:
-            response = response.json()
-            if 'devices' in response:
-                for device in response['devices']:
-                    if device['license_status'] == 'ACTIVATED' and device['hostname'].lower() == hostname.lower():
-                        return device['id']
-            if 'last_id' in response:
-                last_id = response['last_id']
-            else:
-                last_id = None
-        else:
-            print('Unexpected return code', response.status_code, 'on GET', request_url, 'with headers', headers)
-            time.sleep(10)
+    #look in the device inventory first, then check for newly enrolled devices
+    inventory = get_device_inventory()
+    for check_new_devices in (False, True):
+        if check_new_devices:
+            if device_cache_ttl == 0:
+                break  #devices() below already downloaded all devices
+            inventory.refresh(full=False)
+        device_ids = inventory.index(include_deactivated=False).ids_by_hostname(hostname, ignore_case=True)
+        if len(device_ids) > 0:
+            return device_ids[0]
     #no match found
     return 0
 
 #returns list of Administrator Accounts
 def get_users():
+    fqdn, key = _credentials()
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/users/'
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
     if response.status_code == 200:
-        users = response.json()
+        users = _decode(response)
         return users
 
-#exports a list of Administator Accounts to Excel format
-def export_users():
+#exports a list of Administator Accounts to Excel format (or file_format='csv', 'jsonl' or 'parquet')
+def export_users(file_format='xlsx'):
     users = get_users()
-    users_df = pandas.DataFrame(users)
-    folder_name = create_export_folder()
-    timestamp = datetime.datetime.today().strftime('%Y-%m-%d_%H.%M')
-    file_name = f'users_{timestamp}_{fqdn.split(".",1)[0]}.xlsx'
-    users_df.to_excel(f'{folder_name}/{file_name}', index=False)
-    print (f'INFO: {str(len(users))} users exported to {folder_name}/{file_name}')
+    writer = _export_records('users', users, file_format=file_format)
+    print (f'INFO: {str(writer.rows)} users exported to {writer.file_name}')
+    return writer.file_name
 
 #creates a user
 def create_user(username, password, first_name='First', last_name='Last', email='user@domain.com', role='MASTER_ADMINISTRATOR'):
+    fqdn, key = _credentials()
     headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
     payload = {'first_name': first_name, 'last_name': last_name, 'email': email,
                 'username': username, 'role': role, 'password': password,
                 'auth_type': 'LOCAL'}
     request_url = f'https://{fqdn}/api/v1/users/'
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = _request('POST', request_url, json=payload, headers=headers)
     if response.status_code == 200:
-        print('INFO: Successfully created user\n', json.dumps(response.json(), indent=4))
+        print('INFO: Successfully created user\n', json.dumps(_decode(response), indent=4))
     elif response.status_code == 409:
         print('ERROR: Username', username, 'already exists')
     elif response.status_code == 403:
@@ -1462,9 +4361,10 @@ def create_user(username, password, first_name='First', last_name='Last', email=
 
 #deletes a user
 def delete_user(user):
+    fqdn, key = _credentials()
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/users/{user["id"]}'
-    response = requests.delete(request_url, headers=headers)
+    response = _request('DELETE', request_url, headers=headers)
     if response.status_code == 204:
         print('INFO: User', user['id'], user['username'], 'deleted')
     elif response.status_code == 404:
@@ -1474,13 +4374,14 @@ def delete_user(user):
 
 #modify role (permission level) on an existing user
 def change_user_role(username, new_role='READ_ONLY'):
+    fqdn, key = _credentials()
     all_users = get_users()
     for user in all_users:
         if user['username'] == username:
             headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
             request_url = f'https://{fqdn}/api/v1/users/{user["id"]}'
             payload = {'first_name': user['first_name'], 'last_name': user['last_name'], 'email': user['email'], 'role': new_role}
-            response = requests.put(request_url, json=payload, headers=headers)
+            response = _request('PUT', request_url, json=payload, headers=headers)
             if response.status_code == 204:
                 print('INFO: User', user['id'], user['username'], 'updated to new role', new_role)
             elif response.status_code == 404:
@@ -1491,28 +4392,31 @@ def change_user_role(username, new_role='READ_ONLY'):
     print('ERROR: No user found with provided username', username)
 
 def set_uninstall_password(policy_id, new_password):
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
     headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.get(request_url, headers=headers)
-    policy_data = response.json()
+    response = _request('GET', request_url, headers=headers)
+    policy_data = _decode(response)
     policy_data['data']['uninstall_password_hash'] = hashlib.sha256(new_password.encode('utf-16-le')).hexdigest()
-    response = requests.put(request_url, json=policy_data, headers=headers)
+    response = _request('PUT', request_url, json=policy_data, headers=headers)
 
 def set_disable_password(policy_id, new_password):
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
     headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.get(request_url, headers=headers)
-    policy_data = response.json()
+    response = _request('GET', request_url, headers=headers)
+    policy_data = _decode(response)
     policy_data['data']['disable_password_hash'] = hashlib.sha256(new_password.encode('utf-16-le')).hexdigest()
-    response = requests.put(request_url, json=policy_data, headers=headers)
+    response = _request('PUT', request_url, json=policy_data, headers=headers)
 
 def get_behavioral_allow_lists(policy_id):
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/process_paths'
     headers = {'accept': 'application/json', 'Authorization': key}
     behavioral_allow_lists = []
-    response = requests.get(request_url, headers=headers)
+    response = _request('GET', request_url, headers=headers)
     if response.status_code == 200:
-        items = response.json()['items']
+        items = _decode(response)['items']
         for item in items:
             behavioral_allow_list = {'process': item['item'], 'behavior_name_list': [], 'comment': item['comment']}
             if 1 in item['behavior_ids']:
@@ -1537,6 +4441,7 @@ def get_behavioral_allow_lists(policy_id):
     return behavioral_allow_lists
 
 def add_behavioral_allow_lists(policy_id, process_list, behavior_name_list, comment):
+    fqdn, key = _credentials()
     behavior_id_list = []
     if 'RANSOMWARE_FILE_ENCRYPTION' in behavior_name_list:
         behavior_id_list.append(1)
@@ -1565,7 +4470,7 @@ def add_behavioral_allow_lists(policy_id, process_list, behavior_name_list, comm
 
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/process_paths'
     headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = _request('POST', request_url, headers=headers, json=payload)
 
     if response.status_code == 204:
         print('Successfully added', len(process_list), 'entries to the', behavior_name_list, 'allow lists for policy', policy_id)
@@ -1575,12 +4480,13 @@ def add_behavioral_allow_lists(policy_id, process_list, behavior_name_list, comm
         return False
 
 def remove_behavioral_allow_lists(policy_id, process_list):
+    fqdn, key = _credentials()
     payload = {'items': []}
     for process in process_list:
         payload['items'].append({'item': process})
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/process_paths'
     headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.delete(request_url, headers=headers, json=payload)
+    response = _request('DELETE', request_url, headers=headers, json=payload)
     if response.status_code == 204:
         print('Successfully removed', len(process_list), 'entries from the Behavioral Allow List for policy', policy_id)
         return True
@@ -1596,10 +4502,11 @@ def remove_all_behavioral_allow_lists(policy_id):
     remove_behavioral_allow_lists(policy_id=policy_id, process_list=process_list)
 
 def add_script_path_allow_list(policy_id, path, comment=''):
+    fqdn, key = _credentials()
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/scripts'
     headers = {'accept': 'application/json', 'Authorization': key}
     payload = {'items': [ {'comment': comment, 'item': path} ] }
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = _request('POST', request_url, headers=headers, json=payload)
     if response.status_code == 204:
         print('Successfully added', path, 'to script path allow list for policy', policy_id)
         return True
@@ -1607,25 +4514,418 @@ def add_script_path_allow_list(policy_id, path, comment=''):
         print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
         return False
 
-def get_audit_log():
-    page_size = 100
+# Yields the audit log, one page (list of up to page_size entries) at a time
+@_client_bound_generator
+def iter_audit_log_pages(page_size=100):
+    fqdn, key = _credentials()
     offset = 0
-    collected_data = []
     headers = {'accept': 'application/json', 'Authorization': key}
     while True:
         request_url = f'https://{fqdn}/api/v1/audit_logs/?size={page_size}&offset={offset}'
-        response = requests.get(request_url, headers=headers)
-        #print(request_url, 'returned', response.status_code)
+        response = _request('GET', request_url, headers=headers)
         if response.status_code == 200:
-            audit_log_entries = response.json()
-            #print('The above request returned', len(audit_log_entries), 'entries.')
+            audit_log_entries = _decode(response)
             if len(audit_log_entries) > 0:
-                for item in audit_log_entries:
-                    collected_data.append(item)
-                    offset += 1
+                offset += len(audit_log_entries)
+                yield audit_log_entries
             else:
                 break
         else:
-            print('ERROR: Unexpected response code', response.status_code, 'on GET', request_url, 'with headers', headers)
-            time.sleep(10)
-    return collected_data
+            print('ERROR: Unexpected response code', response.status_code, 'on GET', request_url)
+            raise requests.exceptions.HTTPError(f'Unexpected return code {response.status_code} on GET {request_url}', response=response)
+
+
+# Yields audit log entries one at a time, with constant memory use
+@_client_bound_generator
+def iter_audit_log(page_size=100):
+    for audit_log_entries in iter_audit_log_pages(page_size=page_size):
+        yield from audit_log_entries
+
+
+def get_audit_log():
+    return list(iter_audit_log())
+
+
+# asyncio flavour of the wrapper, for running many requests in flight from a
+# single process (for example per-policy data fetches or bulk actions).
+# Requires aiohttp (pip install aiohttp). Usage:
+#   async with di.AsyncDeepInstinctClient('SERVER-NAME', 'API-KEY') as client:
+#       devices, policies = await asyncio.gather(client.get_devices(),
+#           client.get_policies(include_policy_data=True))
+# The methods mirror the module methods of the same name. max_in_flight caps
+# how many requests this client has outstanding at any one time; transport
+# settings work the same as for DeepInstinctClient.
+class AsyncDeepInstinctClient:
+
+    def __init__(self, fqdn=None, key=None, max_in_flight=100, **transport_settings):
+        self._sync_client = DeepInstinctClient(fqdn, key, **transport_settings)
+        self.max_in_flight = max_in_flight
+        self._session = None
+        self._semaphore = None
+        self.metrics = RequestMetrics()
+
+    def __repr__(self):
+        return f'AsyncDeepInstinctClient({self.fqdn!r})'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def fqdn(self):
+        return self._sync_client.fqdn
+
+    @property
+    def key(self):
+        return self._sync_client.key
+
+    def setting(self, name):
+        return self._sync_client.setting(name)
+
+    # Returns this client's aiohttp.ClientSession, creating it on first use
+    def _get_session(self):
+        if self._session is None:
+            import aiohttp, ssl
+            verify = self.setting('verify_tls')
+            certificate = self.setting('client_certificate')
+            if verify is False:
+                ssl_context = False
+            else:
+                if isinstance(verify, str):
+                    ssl_context = ssl.create_default_context(cafile=verify)
+                else:
+                    ssl_context = ssl.create_default_context()
+                if isinstance(certificate, str):
+                    ssl_context.load_cert_chain(certificate)
+                elif certificate is not None:
+                    ssl_context.load_cert_chain(*certificate)
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight,
+                limit_per_host=self.setting('pool_maxsize'), ssl=ssl_context)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.setting('connect_timeout'),
+                sock_read=self.setting('read_timeout'))
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    # Sends a request and returns an _AsyncResponse once the body is read,
+    # retrying transient failures as allowed by the retry policy
+    async def request(self, method, request_url, **kwargs):
+        import aiohttp
+        session = self._get_session()
+        policy = self.setting('retry_policy')
+        limiter = get_rate_limiter(urllib.parse.urlsplit(request_url).netloc)
+        attempt = 0
+        waited = 0
+        while True:
+            if debug_mode:
+                print('DEBUG:', method, request_url)
+            wait_start = time.perf_counter()
+            start = None
+            try:
+                async with self._semaphore:
+                    await limiter.acquire_async()
+                    try:
+                        start = time.perf_counter()
+                        self.metrics.record_wait(method, request_url, start - wait_start)
+                        async with session.request(method, request_url, **kwargs) as raw_response:
+                            response = _AsyncResponse(raw_response.status, raw_response.headers, await raw_response.read())
+                    finally:
+                        limiter.release()
+                exception = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                response = None
+                exception = e
+            latency = time.perf_counter() - (start or wait_start)
+            if response is not None:
+                self.metrics.record(method, request_url, response.status_code, latency,
+                    _body_length(json.dumps(kwargs['json']) if 'json' in kwargs else kwargs.get('data')), len(response.content))
+                limiter.record(response.status_code)
+                retry_after = _retry_after_seconds(response.headers)
+                if not policy.is_retryable_status(response.status_code, method, retry_after, request_url):
+                    return response
+                delay = policy.next_delay(attempt, waited, retry_after)
+                reason = f'return code {response.status_code}'
+            else:
+                self.metrics.record(method, request_url, None, latency)
+                delay = None
+                if isinstance(exception, aiohttp.ClientSSLError):
+                    pass
+                elif policy.is_idempotent(method, request_url) or isinstance(exception, aiohttp.ClientConnectorError):
+                    #non-idempotent requests are only retried if they never reached the server
+                    delay = policy.next_delay(attempt, waited)
+                reason = type(exception).__name__
+            if delay is None:
+                if exception is not None:
+                    raise exception
+                return response
+            if not quiet_mode:
+                print('WARNING:', reason, 'on', method, request_url, f'. Retrying in {delay:.1f} seconds.')
+            await asyncio.sleep(delay)
+            self.metrics.record_wait(method, request_url, delay, retry=True)
+            waited += delay
+            attempt += 1
+
+    def _headers(self, content_type=False):
+        headers = {'accept': 'application/json', 'Authorization': self.key}
+        if content_type:
+            headers['Content-Type'] = 'application/json'
+        return headers
+
+    # Returns list of visible Tenants
+    async def get_tenants(self):
+        request_url = f'https://{self.fqdn}/api/v1/multitenancy/tenant/'
+        response = await self.request('GET', request_url, headers=self._headers())
+        if response.status_code == 200:
+            return _decode(response)['tenants']
+        return []
+
+    # Returns list of visible MSPs
+    async def get_msps(self):
+        request_url = f'https://{self.fqdn}/api/v1/multitenancy/msp/'
+        response = await self.request('GET', request_url, headers=self._headers())
+        if response.status_code == 200:
+            return _decode(response)['msps']
+        return []
+
+    # Returns a list of all visible Device Groups
+    async def get_groups(self, exclude_default_groups=False):
+        request_url = f'https://{self.fqdn}/api/v1/groups/'
+        response = await self.request('GET', request_url, headers=self._headers())
+        if response.status_code == 200:
+            groups = _decode(response)
+            if exclude_default_groups:
+                groups = [group for group in groups if not group['is_default_group']]
+            return groups
+        return []
+
+    # Gets a single device
+    async def get_device(self, device_id):
+        request_url = f'https://{self.fqdn}/api/v1/devices/{device_id}'
+        response = await self.request('GET', request_url, headers=self._headers())
+        if response.status_code == 200:
+            return _decode(response)
+        return None
+
+    # Gets a single event
+    async def get_event(self, event_id, suspicious=False):
+        if suspicious:
+            request_url = f'https://{self.fqdn}/api/v1/suspicious-events/{event_id}'
+        else:
+            request_url = f'https://{self.fqdn}/api/v1/events/{event_id}'
+        response = await self.request('GET', request_url, headers=self._headers())
+        if response.status_code == 200:
+            return _decode(response)['event']
+        print('ERROR: Unexpected return code', response.status_code, 'on request to', request_url)
+        return []
+
+    # Async generator that yields all visible devices, one page at a time
+    async def iter_device_pages(self, include_deactivated=True):
+        last_id = 0
+        while last_id != None:
+            request_url = f'https://{self.fqdn}/api/v1/devices?after_device_id={last_id}'
+            response = await self.request('GET', request_url, headers=self._headers())
+            if response.status_code == 200:
+                response = _decode(response)
+                last_id = response.get('last_id')
+                devices = response.get('devices', [])
+                yield [device for device in devices if device['license_status'] == 'ACTIVATED' or include_deactivated]
+            else:
+                response.raise_unexpected_status(request_url)
+
+    # Async generator that yields all visible devices one at a time. With
+    # prefetch=N, up to N pages are requested ahead in a background task.
+    async def iter_devices(self, include_deactivated=True, prefetch=None):
+        pages = self.iter_device_pages(include_deactivated=include_deactivated)
+        async for devices in _prefetch_pages_async(pages, prefetch_depth if prefetch is None else prefetch):
+            for device in devices:
+                yield device
+
+    # Returns a list of all visible Devices
+    async def get_devices(self, include_deactivated=True, prefetch=None):
+        return [device async for device in self.iter_devices(include_deactivated=include_deactivated, prefetch=prefetch)]
+
+    # Async generator that yields events matching search, one page at a time
+    async def iter_event_pages(self, search={}, minimum_event_id=0, suspicious=False):
+        while minimum_event_id != None:
+            if suspicious:
+                request_url = f'https://{self.fqdn}/api/v1/suspicious-events/search?after_event_id={minimum_event_id}'
+            else:
+                request_url = f'https://{self.fqdn}/api/v1/events/search?after_event_id={minimum_event_id}'
+            response = await self.request('POST', request_url, headers=self._headers(content_type=True), json=search)
+            if response.status_code == 200:
+                response = _decode(response)
+                minimum_event_id = response['last_id']
+                if minimum_event_id != None:
+                    yield response['events']
+            else:
+                response.raise_unexpected_status(request_url)
+
+    # Async generator that yields matching events one at a time. With
+    # prefetch=N, up to N pages are requested ahead in a background task.
+    async def iter_events(self, search={}, minimum_event_id=0, suspicious=False, prefetch=None):
+        pages = self.iter_event_pages(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious)
+        async for events in _prefetch_pages_async(pages, prefetch_depth if prefetch is None else prefetch):
+            for event in events:
+                yield event
+
+    # Returns a list of events matching specified search parameters and/or
+    # minimum event id
+    async def get_events(self, search={}, minimum_event_id=0, suspicious=False, prefetch=None):
+        return [event async for event in self.iter_events(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious, prefetch=prefetch)]
+
+    async def get_suspicious_events(self, search={}, minimum_event_id=0):
+        return await self.get_events(search=search, minimum_event_id=minimum_event_id, suspicious=True)
+
+    # Collect and return list of Device Policies. Policy data and list
+    # contents for all policies are requested concurrently.
+    async def get_policies(self, include_policy_data=False, include_allow_deny_lists=False, keep_data_encapsulated=False, msp_id='ALL'):
+        request_url = f'https://{self.fqdn}/api/v1/policies/'
+        response = await self.request('GET', request_url, headers=self._headers())
+        policies = _decode(response)
+        if msp_id != 'ALL':
+            policies = [policy for policy in policies if policy['msp_id'] == msp_id]
+
+        async def add_policy_data(policy):
+            request_url = f'https://{self.fqdn}/api/v1/policies/{policy["id"]}/data'
+            response = await self.request('GET', request_url, headers=self._headers())
+            if response.status_code == 200:
+                if keep_data_encapsulated:
+                    policy.update(_decode(response))
+                else:
+                    policy.update(_decode(response)['data'])
+
+        async def add_list(policy, list_type):
+            request_url = f'https://{self.fqdn}/api/v1/policies/{policy["id"]}/{list_type}'
+            response = await self.request('GET', request_url, headers=self._headers())
+            if response.status_code == 200:
+                policy['allow_deny_and_exclusion_lists'][list_type] = _decode(response)
+
+        tasks = []
+        if include_policy_data:
+            tasks.extend(add_policy_data(policy) for policy in policies)
+        if include_allow_deny_lists:
+            for policy in policies:
+                policy['allow_deny_and_exclusion_lists'] = {}
+                tasks.extend(add_list(policy, list_type) for list_type in allow_deny_and_exclusion_list_types)
+        await asyncio.gather(*tasks)
+        #list types are inserted in completion order; restore the standard order
+        if include_allow_deny_lists:
+            for policy in policies:
+                lists = policy['allow_deny_and_exclusion_lists']
+                policy['allow_deny_and_exclusion_lists'] = {list_type: lists[list_type] for list_type in allow_deny_and_exclusion_list_types if list_type in lists}
+        return policies
+
+    # Closes (or opens) a list of events
+    async def close_events(self, event_id_list, open=False, suspicious=False):
+        action = 'open' if open else 'close'
+        event_type = 'suspicious-events' if suspicious else 'events'
+        request_url = f'https://{self.fqdn}/api/v1/{event_type}/actions/{action}'
+        response = await self.request('POST', request_url, headers=self._headers(content_type=True), json={'ids': event_id_list})
+        if response.status_code == 204:
+            return True
+        print('ERROR: Unexpected return code', response.status_code, 'on POST to', request_url)
+        return False
+
+    async def open_events(self, event_id_list, suspicious=False):
+        return await self.close_events(event_id_list, open=True, suspicious=suspicious)
+
+    # Archives (or unarchives) a list of events
+    async def archive_events(self, event_id_list, unarchive=False, suspicious=False):
+        action = 'unarchive' if unarchive else 'archive'
+        event_type = 'suspicious-events' if suspicious else 'events'
+        request_url = f'https://{self.fqdn}/api/v1/{event_type}/actions/{action}'
+        response = await self.request('POST', request_url, headers=self._headers(content_type=True), json={'ids': event_id_list})
+        if response.status_code == 204:
+            return True
+        print('ERROR: Unexpected return code', response.status_code, 'on POST to', request_url)
+        return False
+
+    async def unarchive_events(self, event_id_list, suspicious=False):
+        return await self.archive_events(event_id_list, unarchive=True, suspicious=suspicious)
+
+    # Archives (or unarchives) a list of devices
+    async def archive_devices(self, device_ids, unarchive=False):
+        action = 'unarchive' if unarchive else 'archive'
+        request_url = f'https://{self.fqdn}/api/v1/devices/actions/{action}'
+        response = await self.request('POST', request_url, headers=self._headers(content_type=True), json={'ids': device_ids})
+        return response.status_code == 200
+
+    async def unarchive_devices(self, device_ids):
+        return await self.archive_devices(device_ids, unarchive=True)
+
+    # Adds (or removes) a list of Devices to a Device Group
+    async def add_devices_to_group(self, device_ids, group_id, remove=False):
+        action = 'remove-devices' if remove else 'add-devices'
+        request_url = f'https://{self.fqdn}/api/v1/groups/{group_id}/{action}'
+        response = await self.request('POST', request_url, headers=self._headers(content_type=True), json={'devices': device_ids})
+        return response.status_code == 204
+
+    async def remove_devices_from_group(self, device_ids, group_id):
+        return await self.add_devices_to_group(device_ids, group_id, remove=True)
+
+    # Remotely uninstall a device
+    async def remove_device(self, device_id):
+        request_url = f'https://{self.fqdn}/api/v1/devices/{device_id}/actions/remove'
+        response = await self.request('POST', request_url, headers=self._headers())
+        return response.status_code == 204
+
+    # Runs one of the methods above for each item, all in flight at once
+    # (subject to max_in_flight), and returns the results in input order.
+    # Example: await client.map(client.get_device, device_ids)
+    async def map(self, method, items):
+        return await asyncio.gather(*(method(item) for item in items))
+
+
+# asyncio version of prefetch_pages: a background task fetches up to depth
+# pages ahead of the consumer
+async def _prefetch_pages_async(pages, depth):
+    if not depth:
+        async for page in pages:
+            yield page
+        return
+    buffer = asyncio.Queue(maxsize=depth)
+    done = object()
+
+    async def fetch():
+        try:
+            async for page in pages:
+                await buffer.put(page)
+            await buffer.put(done)
+        except Exception as e:
+            await buffer.put(e)
+
+    task = asyncio.ensure_future(fetch())
+    try:
+        while True:
+            page = await buffer.get()
+            if page is done:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        task.cancel()
+
+
+# Response returned by AsyncDeepInstinctClient.request, with the parts of the
+# requests.Response interface used in this module
+class _AsyncResponse:
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return _decode(self)
+
+    def raise_unexpected_status(self, request_url):
+        print('ERROR: Unexpected return code', self.status_code, 'on request to', request_url)
+        raise requests.exceptions.HTTPError(f'Unexpected return code {self.status_code} on request to {request_url}')
@@ -14,43 +14,45 @@
 import deepinstinct30 as di, json, datetime, pandas, re, sys
 from dateutil import parser
 
-# Calculates deployment phase for a Windows policy. Non-conforming and non-Windows policies return 0.
-def classify_policy(policy, config):
-
-    if policy['os'] == 'WINDOWS':
-
-        if policy['prevention_level'] == 'DISABLED':
-            if policy['detection_level'] in ['LOW', 'MEDIUM']:
-                if policy['ransomware_behavior'] == 'DETECT':
-                    return 1
-
-        elif policy['prevention_level'] in ['LOW', 'MEDIUM']:
-            if policy['ransomware_behavior'] == 'PREVENT':
-                if policy['in_memory_protection'] == False:
-                    return 1.5
-
-                elif policy['in_memory_protection'] == True:
-                    if policy['remote_code_injection'] == 'DETECT':
-                        if policy['arbitrary_shellcode_execution'] == 'DETECT':
-                            if policy['reflective_dll_loading'] == 'DETECT':
-                                if policy['reflective_dotnet_injection'] == 'DETECT':
-                                    if policy['amsi_bypass'] == 'DETECT':
-                                        if policy['credentials_dump'] == 'DETECT':
-                                            if policy['html_applications_action'] == 'DETECT' or config['ignore_html_applications_action']:
-                                                if policy['activescript_action'] == 'DETECT' or config['ignore_activescript_action']:
-                                                    return 2
-
-                    if policy['remote_code_injection'] == 'PREVENT':
-                        if policy['arbitrary_shellcode_execution'] == 'PREVENT':
-                            if policy['reflective_dll_loading'] == 'PREVENT':
-                                if policy['reflective_dotnet_injection'] == 'PREVENT':
-                                    if policy['amsi_bypass'] == 'PREVENT':
-                                        if policy['credentials_dump'] == 'PREVENT':
-                                            if policy['html_applications_action'] == 'PREVENT' or config['ignore_html_applications_action']:
-                                                if policy['activescript_action'] == 'PREVENT' or config['ignore_activescript_action']:
-                                                    return 3
-
-    return 0
+# Criteria for each deployment phase of a Windows policy, as rules for
+# di.evaluate_policy_rules. Non-conforming and non-Windows policies are phase 0.
+windows_only = {'field': 'os', 'operator': 'in', 'values': ['WINDOWS']}
+deployment_phase_rules = {
+    1: [
+        windows_only,
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['DISABLED'], 'platforms': ['WINDOWS']},
+        {'field': 'detection_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM'], 'platforms': ['WINDOWS']},
+        {'field': 'ransomware_behavior', 'operator': 'in', 'values': ['DETECT'], 'platforms': ['WINDOWS']},
+    ],
+    1.5: [
+        windows_only,
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM'], 'platforms': ['WINDOWS']},
+        {'field': 'ransomware_behavior', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'in_memory_protection', 'operator': 'in', 'values': [False], 'platforms': ['WINDOWS']},
+    ],
+}
+for phase, action in ((2, 'DETECT'), (3, 'PREVENT')):
+    deployment_phase_rules[phase] = [
+        windows_only,
+        {'field': 'prevention_level', 'operator': 'in', 'values': ['LOW', 'MEDIUM'], 'platforms': ['WINDOWS']},
+        {'field': 'ransomware_behavior', 'operator': 'in', 'values': ['PREVENT'], 'platforms': ['WINDOWS']},
+        {'field': 'in_memory_protection', 'operator': 'in', 'values': [True], 'platforms': ['WINDOWS']},
+    ]
+    for field in ['remote_code_injection', 'arbitrary_shellcode_execution', 'reflective_dll_loading',
+                  'reflective_dotnet_injection', 'amsi_bypass', 'credentials_dump',
+                  'html_applications_action', 'activescript_action']:
+        deployment_phase_rules[phase].append({'field': field, 'operator': 'in', 'values': [action], 'platforms': ['WINDOWS']})
+
+# Calculates deployment phase for each policy in a list
+def classify_policies(policies, config):
+    ignore_fields = []
+    if config['ignore_html_applications_action']:
+        ignore_fields.append('html_applications_action')
+    if config['ignore_activescript_action']:
+        ignore_fields.append('activescript_action')
+    deployment_phases = di.classify_policies(policies, deployment_phase_rules, default=0, ignore_fields=ignore_fields)
+    for policy, deployment_phase in zip(policies, deployment_phases):
+        policy['deployment_phase'] = deployment_phase
 
 
 # Calculates search parameters for events based on current deployment phase
@@ -130,18 +132,21 @@ def run_deployment_phase_progression_readiness(fqdn, key, config):
     #collect event data
     search_parameters = get_event_search_parameters(config['deployment_phase'])
     suspicious_search_parameters = get_suspicious_event_search_parameters(config['deployment_phase'])
+    #events are streamed and counted by device as they arrive, so memory use
+    #doesn't grow with the number of events
     print('\nGetting event data from server')
-    events = di.get_events(search=search_parameters)
-    print(len(events), 'events were returned.')
+    event_counts = di.Aggregator(['device_id'])
+    event_counts.update(di.iter_events(search=search_parameters))
+    print(event_counts.total, 'events were returned.')
 
     if not config['ignore_suspicious_events']:
         if suspicious_search_parameters != {}:
             print('\nGetting suspicious event data from server')
-            suspicious_events = di.get_suspicious_events(search=suspicious_search_parameters)
-            print(len(suspicious_events), 'suspicious events were returned.')
-            events = events + suspicious_events
+            event_count = event_counts.total
+            event_counts.update(di.iter_events(search=suspicious_search_parameters, suspicious=True))
+            print(event_counts.total - event_count, 'suspicious events were returned.')
 
-    event_counts = di.count_data_by_field(events, 'device_id')
+    event_counts = event_counts.counts()
 
     #collect device data
     print('\nGetting device data from server')
@@ -149,10 +154,7 @@ def run_deployment_phase_progression_readiness(fqdn, key, config):
     print(len(devices), 'devices were found.')
 
     #determine if we have data from a single MSP or multiple
-    policy_msp_ids = []
-    for policy in policies:
-        if policy['msp_id'] not in policy_msp_ids:
-            policy_msp_ids.append(policy['msp_id'])
+    policy_msp_ids = set(policy['msp_id'] for policy in policies)
     if len(policy_msp_ids) > 1:
         multiple_msps = True
     else:
@@ -160,8 +162,8 @@ def run_deployment_phase_progression_readiness(fqdn, key, config):
 
     print('\nAnalyzing policy data')
     policy_evaluation_results = []
+    classify_policies(policies, config)
     for policy in policies:
-        policy['deployment_phase'] = classify_policy(policy, config)
         if policy['os'] == 'WINDOWS':
             if policy['deployment_phase'] > 0:
                 result = f"Policy '{policy['name']}' (ID {policy['id']}) is a Phase {policy['deployment_phase']} policy."
@@ -173,12 +175,13 @@ def run_deployment_phase_progression_readiness(fqdn, key, config):
             policy_evaluation_results.append(result)
 
     filtered_devices = []
+    policies_by_id = di.index_by(policies, 'id')
     for device in devices:
-        for policy in policies:
-            if policy['id'] == device['policy_id']:
-                device['deployment_phase'] = policy['deployment_phase']
-                if device['deployment_phase'] == config['deployment_phase']:
-                    filtered_devices.append(device)
+        policy = policies_by_id.get(device['policy_id'])
+        if policy is not None:
+            device['deployment_phase'] = policy['deployment_phase']
+            if device['deployment_phase'] == config['deployment_phase']:
+                filtered_devices.append(device)
     excluded_device_count = len(devices) - len(filtered_devices)
     devices = filtered_devices
 
@@ -1,11 +1,11 @@
 import deepinstinct30 as di
 import datetime, pandas, json, re
 
-def check_policy_setting(expected, actual):
-    if str(actual) == expected:
-        return str(actual)
-    else:
+def format_policy_setting(actual, violations, name):
+    if name in violations:
         return '-' + str(actual) + '-'
+    else:
+        return str(actual)
 
 def prompt_user_for_config():
     di.fqdn = input('Enter FQDN of DI Server, or press enter to accept the default [di-service.customers.deepinstinctweb.com]: ')
@@ -32,39 +32,34 @@ def data_from_more_than_one_msp(policies):
     else:
         return False
 
+# Settings in the order they are exported. Those not (yet) visible via the
+# REST API require manual review; the rest are checked against
+# di.policy_rules['prescribed_settings'].
+settings_to_export = ['D-Cloud Reputation Service', 'Static Analysis PE Detection', 'Static Analysis PE Prevention',
+    'Known PUA', 'Embedded DDE Objects', 'Network Drive Protection', 'Macro Execution', 'Ransomware',
+    'In-Memory Protection', 'Arbitrary Shellcode', 'Remote Code Injection', 'Reflective DLL Injection',
+    '.Net Reflection', 'AMSI Bypass', 'Credential Dumping', 'Known Payload Execution',
+    'Suspicious Script Execution', 'Malicious PowerShell Commands', 'Suspicious Activity Detection',
+    'PowerShell', 'HTML Applications', 'ActiveScript Usage', 'ActiveScript Execution']
+
 def evaluate_policies(policies, multi_msp):
+    #evaluate all policies at once
+    rules_by_name = di.index_by(di.policy_rules['prescribed_settings'], 'name')
+    evaluation = di.evaluate_policy_rules(policies, 'prescribed_settings')
     results = []
-    for policy in policies:
+    for policy, evaluation_result in zip(policies, evaluation):
         result = {}
         if multi_msp:
             result['MSP ID'] = policy['msp_id']
             result['MSP Name'] = policy['msp_name']
         result['ID'] = policy['id']
         result['Name'] = policy['name']
-        result['D-Cloud Reputation Service'] = '-manual_review-'
-        result['Static Analysis PE Detection'] = check_policy_setting('MEDIUM', policy['detection_level'])
-        result['Static Analysis PE Prevention'] = check_policy_setting('MEDIUM', policy['prevention_level'])
-        result['Known PUA'] = check_policy_setting('PREVENT', policy['protection_level_pua'])
-        result['Embedded DDE Objects'] = '-manual_review-'
-        result['Network Drive Protection'] = check_policy_setting('True', policy['scan_network_drives'])
-        result['Macro Execution'] = check_policy_setting('USE_D_BRAIN', policy['office_macro_script_action'])
-        result['Ransomware'] = check_policy_setting('PREVENT', policy['ransomware_behavior'])
-        result['In-Memory Protection'] = check_policy_setting('True', policy['in_memory_protection'])
-        result['Arbitrary Shellcode'] = check_policy_setting('PREVENT', policy['arbitrary_shellcode_execution'])
-        result['Remote Code Injection'] = check_policy_setting('PREVENT', policy['remote_code_injection'])
-        result['Reflective DLL Injection'] = check_policy_setting('PREVENT', policy['reflective_dll_loading'])
-        result['.Net Reflection'] = check_policy_setting('PREVENT', policy['reflective_dotnet_injection'])
-        result['AMSI Bypass'] = check_policy_setting('PREVENT', policy['amsi_bypass'])
-        result['Credential Dumping'] = check_policy_setting('PREVENT', policy['credentials_dump'])
-        result['Known Payload Executionn'] = check_policy_setting('PREVENT', policy['known_payload_execution'])
-        result['Suspicious Script Execution'] = '-manual_review-'
-        result['Malicious PowerShell Commands'] = '-manual_review-'
-        result['Suspicious Activity Detection'] = '-manual_review-'
-        result['Malicious PowerShell Commands'] = '-manual_review-'
-        result['PowerShell'] = check_policy_setting('ALLOW', policy['powershell_script_action'])
-        result['HTML Applications'] = check_policy_setting('PREVENT', policy['html_applications_action'])
-        result['ActiveScript Usage'] = check_policy_setting('ALLOW', policy['prevent_all_activescript_usage'])
-        result['ActiveScript Execution'] = check_policy_setting('PREVENT', policy['activescript_action'])
+        for name in settings_to_export:
+            if name in rules_by_name:
+                actual = policy.get(rules_by_name[name]['field'])
+                result[name] = format_policy_setting(actual, evaluation_result['violations'], name)
+            else:
+                result[name] = '-manual_review-'
         results.append(result)
     return results
 
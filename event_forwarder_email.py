@@ -117,18 +117,11 @@ while True:
     max_event_processed_previously = get_config()
     print('Getting new events with id greater than', max_event_processed_previously)
 
+    #events are streamed page by page, so memory use stays flat however many
+    #new events there are; the next 2 pages are fetched while events are sent
+    event_count = 0
     try:
-        new_events = di.get_events(minimum_event_id=max_event_processed_previously, search=search_parameters)
-    except requests.exceptions.RequestException as e:
-        now = datetime.datetime.now()
-        print(now.strftime("%H:%M"), 'ERROR:', e)
-        new_events = []
-
-    print(len(new_events), 'events were returned')
-
-    if len(new_events) > 0:
-
-        for event in new_events:
+        for event in di.iter_events(minimum_event_id=max_event_processed_previously, search=search_parameters, prefetch=2):
             sanitize_event(event)
             print('Sending event', event['id'], 'to', recepient)
             try:
@@ -138,8 +131,14 @@ while True:
                 print(now.strftime("%H:%M"), 'ERROR:', e)
             if event['id'] > max_event_processed_previously:
                 max_event_processed_previously = event['id']
+            event_count += 1
+    except requests.exceptions.RequestException as e:
+        now = datetime.datetime.now()
+        print(now.strftime("%H:%M"), 'ERROR:', e)
 
+    print(event_count, 'events were processed')
     print('max_event_processed_previously is now', max_event_processed_previously)
     save_config(max_event_processed_previously)
+
     print('Sleeping for', sleep_time_in_seconds, 'seconds')
     time.sleep(sleep_time_in_seconds)
@@ -22,13 +22,15 @@ while True:
 
         if response.status_code == 200:
 
-            if 'last_id' in response.json():
-                last_id = response.json()['last_id']
+            response = response.json()  #parse the response only once
+
+            if 'last_id' in response:
+                last_id = response['last_id']
             else:
                 last_id = None
 
-            if 'events' in response.json():
-                events = response.json()['events']
+            if 'events' in response:
+                events = response['events']
                 print('INFO: Found', len(events), 'events on query to', request_url)
                 for event in events:
                     if event['id'] > highest_event_id_collected_previously:
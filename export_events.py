@@ -35,6 +35,16 @@ while di.key == 'API-KEY':
 # Example of how to filter on minimum event_id
 #events = di.get_events(minimum_event_id=1001)
 
+# Example of a large export split into 8 ranges of event ids which are fetched
+# in parallel (shards works with any of the other examples too)
+#events = di.get_events(shards=8)
+
+# Example of answering from a local copy of the events (a SQLite file under
+# event_store/). Only events newer than the last run are downloaded, so
+# repeated exports are fast. Searches on fields that can change, such as
+# status, are still sent to the server
+#events = di.get_events(event_store=True)
+
 # Example of how to build a set of search search parameters
 # --> All provided parameters must match (AND operation, not OR)
 # --> Event search is exact match only (no regex/etc) with exception of timestamp
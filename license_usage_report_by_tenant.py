@@ -39,10 +39,7 @@ devices = di.get_devices(include_deactivated=False)
 
 # add msp_name to tenant data
 print('INFO: Adding MSP names to Tenant data')
-for tenant in tenants:
-    for msp in msps:
-        if tenant['msp_id'] == msp['id']:
-            tenant['msp_name'] = msp['name']
+di.join_tenants_to_msps(tenants, msps)
 
 # If option to include policy mode counts is enabled, get policy details,
 # then parse policies to calculate mode, then add that data to devices
@@ -52,26 +49,11 @@ if include_policy_mode_counts:
 
     print('INFO: Parsing policy data to determine policy mode')
 
-    for policy in policies:
-
-        policy['prevention_mode'] = False
-
-        if policy['os'] == 'WINDOWS':
-            if policy['prevention_level'] in ('LOW', 'MEDIUM', 'HIGH'):
-                if policy['ransomware_behavior'] == 'PREVENT':
-                    if policy['remote_code_injection'] == 'PREVENT':
-                        if policy['arbitrary_shellcode_execution'] == 'PREVENT':
-                            policy['prevention_mode'] = True
-
-        elif 'prevention_level' in policy.keys():
-            if policy['prevention_level'] in ('LOW', 'MEDIUM', 'HIGH'):
-                policy['prevention_mode'] = True
+    for policy, result in zip(policies, di.evaluate_policy_rules(policies, 'prevention_mode')):
+        policy['prevention_mode'] = result['verdict']
 
     print('INFO: Adding policy mode to device data')
-    for device in devices:
-        for policy in policies:
-            if policy['id'] == device['policy_id']:
-                device['prevention_mode'] = policy['prevention_mode']
+    di.join_devices_to_policies(devices, policies, fields=['prevention_mode'])
 
 # Calculate license usage for each tenant (plus prevention/detection data, if enabled in config)
 if include_policy_mode_counts:
@@ -83,20 +65,21 @@ for tenant in tenants:
     if include_policy_mode_counts:
         tenant['devices_in_prevention_mode'] = 0
         tenant['devices_in_detection_mode'] = 0
+tenants_by_id = di.index_by(tenants, 'id')
 for device in devices:
     # Check if the device has an activated license (if not skip it)
     if device['license_status'] == 'ACTIVATED':
         # If yes, then find the Tenant that this device belongs to
-        for tenant in tenants:
-            if tenant['id'] == device['tenant_id']:
-                # ...and increment the licenses_used counter in the matching tenant by 1
-                tenant['licenses_used'] += 1
-                # If enabled, also increment the prevention/detection counter
-                if include_policy_mode_counts:
-                    if device['prevention_mode']:
-                        tenant['devices_in_prevention_mode'] += 1
-                    else:
-                        tenant['devices_in_detection_mode'] += 1
+        tenant = tenants_by_id.get(device['tenant_id'])
+        if tenant is not None:
+            # ...and increment the licenses_used counter in the matching tenant by 1
+            tenant['licenses_used'] += 1
+            # If enabled, also increment the prevention/detection counter
+            if include_policy_mode_counts:
+                if device['policy_prevention_mode']:
+                    tenant['devices_in_prevention_mode'] += 1
+                else:
+                    tenant['devices_in_detection_mode'] += 1
 
 # Calculate percent_of_licenses_used for reach tenant and add results to tenants data
 print('INFO: Calculating percentage of licenses used for each tenant')
@@ -10,19 +10,22 @@ server_list = [
 
 
 #import required libraries
-import requests
-import json
+import deepinstinct30 as di
+import concurrent.futures
 
-for server in servers:
+def modify_prevention_threshold(server):
 
     #define DI server config
     fqdn = server['fqdn']
     key = server['key']
 
+    #each server gets its own client, so all servers can be processed in parallel
+    client = di.DeepInstinctClient(fqdn, key)
+
     #get list of policies
     request_url = f'https://{fqdn}/api/v1/policies/'
     headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.get(request_url, headers=headers)
+    response = client.request('GET', request_url, headers=headers)
     policies = response.json()
 
     for policy in policies:
@@ -30,11 +33,15 @@ for server in servers:
         if policy['os'] == 'WINDOWS':
             #get policy data from server
             request_url = f'https://{fqdn}/api/v1/policies/{policy["id"]}/data'
-            response = requests.get(request_url, headers=headers)
+            response = client.request('GET', request_url, headers=headers)
             policy_data = response.json()
             #modify policy data
             if policy_data['data']['prevention_level'] in ['HIGH', 'VERY_HIGH']:
                 print(f"Modifying prevention_level setting from '{policy_data['data']['prevention_level']}' to 'MEDIUM' for MSP '{policy['msp_name']}' (ID {policy['msp_id']}) Policy '{policy['name']}' (ID {policy['id']})")
                 policy_data['data']['prevention_level'] = 'MEDIUM'
                 #save modified policy data to server
-                response = requests.put(request_url, json=policy_data, headers=headers)
+                response = client.request('PUT', request_url, json=policy_data, headers=headers)
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(server_list))) as executor:
+    for result in executor.map(modify_prevention_threshold, server_list):
+        pass
@@ -63,13 +63,15 @@ if destination_key == 'api_key_for_bar':
 import deepinstinct30 as di
 
 #import additional libraries
-import requests, sys, json
+import sys
+
+#create a client for each server so that both can be used side by side
+source_server = di.DeepInstinctClient(source_fqdn, source_key)
+destination_server = di.DeepInstinctClient(destination_fqdn, destination_key)
 
 #get policies from source server
 print('INFO: Getting policies from source server', source_fqdn)
-di.fqdn = source_fqdn
-di.key = source_key
-source_server_policies = di.get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True)
+source_server_policies = source_server.get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True)
 
 #confirm that source server policy data is for a single MSP only (this script does not support multi-MSP policy migration)
 source_server_msp_ids = []
@@ -82,9 +84,7 @@ if len(source_server_msp_ids) != 1:
 
 #get policies from destination server
 print('INFO: Getting policies from destination server', destination_fqdn)
-di.fqdn = destination_fqdn
-di.key = destination_key
-destination_server_policies = di.get_policies(include_policy_data=True, keep_data_encapsulated=True)
+destination_server_policies = destination_server.get_policies(include_policy_data=True, keep_data_encapsulated=True, include_allow_deny_lists=True)
 
 #confirm that destination server policy data is for a single MSP only (this script does not support multi-MSP policy migration)
 destination_server_msp_ids = []
@@ -95,39 +95,27 @@ if len(destination_server_msp_ids) != 1:
     print(f'ERROR: Unexpected data from destination server {source_fqdn}! The policy list returned includes policies from {len(destination_server_msp_ids)} unique MSPs. This must be 1. Please try again with a different API key.')
     sys.exit(0)
 
-#safety check for cross-platform policy name collission (breaks future logic)
-print('INFO: Checking for cross-platform policy name collission')
-for source_policy in source_server_policies:
-    for destination_policy in destination_server_policies:
-        if source_policy['name'] == destination_policy == ['name']:
-            if source_policy['os'] != destination_policy['os']:
-                print('ERROR: Unable to proceed with migration because policy', source_policy['name'], 'is a', source_policy['os'], 'policy on the source server and a policy with the same name is a', destination_policy['os'], 'policy on the destination server.')
-                sys.exit(0)
-
-#build a list of policy names from destination server
-destination_server_policy_names = []
-for policy in destination_server_policies:
-    destination_server_policy_names.append(policy['name'])
-
-#build dictionary of default policy IDs on destination server
-print('INFO: Building dictionary of default policy IDs by platform on', destination_fqdn)
-destination_default_policy_ids = {}
-for policy in destination_server_policies:
-    if policy['is_default_policy']:
-        destination_default_policy_ids[policy['os']] = policy['id']
+#build migration plan (create, update, or skip each policy, with only the
+#policy data and list items that differ being written)
+print('INFO: Building migration plan')
+plan = di.plan_policy_migration(source_server_policies, destination_server_policies, platforms_to_migrate=platforms_to_migrate, allow_deny_and_exclusion_list_types=allow_deny_and_exclusion_list_types)
+cost = di.policy_migration_cost(plan)
 
-#build list of policies to migrate
-policies_to_migrate = []
-for source_server_policy in source_server_policies:
-    if source_server_policy['os'] in platforms_to_migrate:
-        policies_to_migrate.append(source_server_policy)
+#safety check for policy name collissions (duplicate source names or another
+#platform at the destination) and missing default policies
+for entry in plan:
+    if entry['action'] == 'conflict':
+        print('ERROR: Unable to proceed with migration of', entry['os'], 'policy', entry['name'], 'because', entry['conflict_reason'] + '.')
+        sys.exit(0)
 
 #Confirm with user
 print('INFO: Prep work is done. Ready to migrate data from', source_fqdn, 'to', destination_fqdn)
-print('The following', len(policies_to_migrate), 'policies will be migrated:')
-print(json.dumps(policies_to_migrate, indent=4))
+print('The following', len(plan), 'policies will be migrated:')
+for entry in plan:
+    print('     ', entry['action'].ljust(6), entry['os'], 'policy', entry['source_policy_id'], entry['name'], '(' + str(entry['list_items']), 'list items,', entry['requests'], 'requests)')
+print('In total', cost['create'], 'policies will be created,', cost['update'], 'updated and', cost['skip'], 'skipped as already up to date, using about', cost['requests'], 'requests')
 print()
-user_prompt_text = f'Do you want to proceed with migrating the {str(len(policies_to_migrate))} policies detailed above [YES | NO] ?  '
+user_prompt_text = f'Do you want to proceed with migrating the {str(len(plan))} policies detailed above [YES | NO] ?  '
 user_response = input(user_prompt_text)
 if user_response.lower() != 'yes':
     print('WARNING: Terminating script based on user response', user_response)
@@ -135,53 +123,12 @@ if user_response.lower() != 'yes':
 else:
     print('INFO: Proceeding with migration based on user response', user_response)
 
-    #define a counter used for console output during policy migration
-    counter = 1
-
-    #Migrate the policies
-    for policy in policies_to_migrate:
-
-        #first step is to create the base policy, which we'll base on the platform-specific default policy
-        print('\nINFO: Beginning migration of policy', counter, 'of', len(policies_to_migrate), ':', policy['os'], 'policy', policy['id'], policy['name'])
-        if policy['name'] in destination_server_policy_names:
-            for destination_server_policy in destination_server_policies:
-                if policy['name'] == destination_server_policy['name']:
-                    new_policy = destination_server_policy
-                    print('      Reusing existing policy on destination server:', new_policy['id'], new_policy['name'], new_policy['os'])
+    #Migrate the policies (independent policies are migrated concurrently)
+    destination_server.run_policy_migration(plan)
+    for entry in plan:
+        if entry['success']:
+            print('INFO: Done with migration of', entry['os'], 'policy', entry['source_policy_id'], entry['name'], 'to policy', entry['destination_policy_id'])
         else:
-            new_policy = di.create_policy(policy['name'], destination_default_policy_ids[policy['os']], quiet_mode=True)
-            print('      Newly created policy on destination server:', new_policy['id'], new_policy['name'], new_policy['os'])
-
-        #next step is to overwrite the policy data on the newly-create policy with data from old server
-        print('      Overwriting policy data on new policy', new_policy['id'], 'with data collected from old policy', policy['id'])
-        new_policy_id = new_policy['id']
-        request_url = f'https://{di.fqdn}/api/v1/policies/{new_policy_id}/data'
-        headers = {'accept': 'application/json', 'Authorization': di.key}
-        payload = {'data': policy['data']}
-        response = requests.put(request_url, json=payload, headers=headers)
-        if response.status_code == 204:
-            print('      Successfully overwrote policy data on new policy', new_policy['id'])
-        else:
-            print('ERROR: Unexpected response', response.status_code, 'on PUT to', request_url)
-            sys.exit(0)
-
-        #last step is to migrate the associated allow list, deny list, and exclusion lists for the policy
-        print('      Copying any existing allow list, deny list, and exclusion lists from policy', policy['id'], 'to policy', new_policy['id'])
-        headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': di.key}
-        for list_type in allow_deny_and_exclusion_list_types:
-            if list_type in policy['allow_deny_and_exclusion_lists']:
-                if len(policy['allow_deny_and_exclusion_lists'][list_type]['items']) > 0:
-                    payload = policy['allow_deny_and_exclusion_lists'][list_type]
-                    request_url = f'https://{di.fqdn}/api/v1/policies/{new_policy_id}/{list_type}'
-                    response = requests.post(request_url, headers=headers, json=payload)
-                    if response.status_code == 204:
-                        print('      Successfully copied', len( policy['allow_deny_and_exclusion_lists'][list_type]['items'] ), 'entries of type', list_type)
-                    elif response.status_code == 404:
-                        print('WARNING: Response', response.status_code, 'on POST to', request_url, '. This indicates data of this type existed on the source server but was not migrated to the destination server due to no available API method on the destination.')
-                    else:
-                        print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
-                        sys.exit(0)
-        print('INFO: Done with migration of policy', counter, 'of', len(policies_to_migrate), ':', policy['os'], 'policy', policy['id'], policy['name'])
-        counter += 1
-
-    print('\nDone migrating', len(policies_to_migrate), 'policies from', source_fqdn, 'to', destination_fqdn)
+            print('ERROR: Migration of', entry['os'], 'policy', entry['source_policy_id'], entry['name'], 'did not complete. See errors above.')
+
+    print('\nDone migrating', len(plan), 'policies from', source_fqdn, 'to', destination_fqdn)
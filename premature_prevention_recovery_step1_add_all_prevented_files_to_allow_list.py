@@ -27,10 +27,7 @@ search_parameters['last_action'] = ['QUARANTINE_SUCCESS']
 events = di.get_events(search=search_parameters)
 
 #using events, calculate list of unique hashes
-hash_list = []
-for event in events:
-    if event['file_hash'] not in hash_list:
-        hash_list.append(event['file_hash'])
+hash_list = di.HashCollection.from_records(events, 'file_hash').to_list()
 
 #get policies
 all_policies = di.get_policies()
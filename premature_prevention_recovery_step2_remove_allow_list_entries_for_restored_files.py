@@ -31,19 +31,15 @@ search_parameters = {}
 search_parameters['type'] = ['STATIC_ANALYSIS']
 search_parameters['action'] = ['PREVENTED']
 search_parameters['last_action'] = ['QUARANTINE_SUCCESS']
-events = di.get_events(search=search_parameters)
+events = di.iter_events(search=search_parameters)
 
-#calculate list of hashes for files still in quarantine
-hash_list_still_in_quarantine = []
-for event in events:
-    if event['file_hash'] not in hash_list_still_in_quarantine:
-        hash_list_still_in_quarantine.append(event['file_hash'])
+#calculate set of hashes for files still in quarantine
+#(for very large environments, add bloom_filter=True to cap memory use; a
+#false positive only keeps a hash on the allow list, never removes one early)
+hashes_still_in_quarantine = di.HashCollection.from_records(events, 'file_hash')
 
 #calculate hashes safe to remove from allow list
-hashes_to_remove = []
-for hash in hash_list:
-    if hash not in hash_list_still_in_quarantine:
-        hashes_to_remove.append(hash)
+hashes_to_remove = hashes_still_in_quarantine.missing(hash_list)
 
 #get policies
 all_policies = di.get_policies()
@@ -11,15 +11,10 @@ def do_warranty_compliance_check(fqdn, key, exclude_empty_policies):
     devices = di.get_devices(include_deactivated=False)
 
     # Calculate device_count for each policy (how many active devices in policy)
-    # Add device_countfield with initial value zero
     print('INFO: Calculating device count for each policy')
+    device_counts = di.count_by(devices, 'policy_id')
     for policy in policies:
-        policy['device_count'] = 0
-    # Iterate through devices and policies, incrementing device_count appropriately
-    for device in devices:
-        for policy in policies:
-            if policy['id'] == device['policy_id']:
-                policy['device_count'] +=1
+        policy['device_count'] = device_counts.get(policy['id'], 0)
 
     if exclude_empty_policies:
         print('INFO: Narrowing policy list to include only those which contain 1 or more activated devices')
@@ -46,32 +41,11 @@ def do_warranty_compliance_check(fqdn, key, exclude_empty_policies):
     compliant_windows_policies = []
     noncompliant_windows_policies = []
 
-    for policy in windows_policies:
-
-        policy['compliant'] = True  #initially assume compliant; will change to false if violation(s) identified
-        policy['compliance_violations'] = {}  #define dictionary to store details of violation(s) if any
-
-        if policy['prevention_level'] not in ['HIGH', 'MEDIUM', 'LOW']:
-            policy['compliant'] = False
-            policy['compliance_violations']['prevention_level'] = policy['prevention_level']
-
-        if policy['remote_code_injection'] != 'PREVENT':
-            policy['compliant'] = False
-            policy['compliance_violations']['remote_code_injection'] = policy['remote_code_injection']
-
-        if policy['arbitrary_shellcode_execution'] != 'PREVENT':
-            policy['compliant'] = False
-            policy['compliance_violations']['arbitrary_shellcode_execution'] = policy['arbitrary_shellcode_execution']
-
-        if policy['ransomware_behavior'] != 'PREVENT':
-            policy['compliant'] = False
-            policy['compliance_violations']['ransomware_behavior'] = policy['ransomware_behavior']
-
-        #TODO: Add logic to check the following atttributes of the Windows policy:
-        #   1. D-Cloud Services (compliance requires that this be enabled)
-        #   2. Malicious PowerShell Prevention (compliance requires that this be in Prevention)
-        #Both of above require that product make these fields visible via the REST API. Submitted
-        #as FR-166 and FR-167 on 2021-07-06
+    #evaluate all Windows policies at once against di.policy_rules['warranty_compliance']
+    results = di.evaluate_policy_rules(windows_policies, 'warranty_compliance')
+    for policy, result in zip(windows_policies, results):
+        policy['compliant'] = result['verdict']
+        policy['compliance_violations'] = result['violations']  #details of violation(s) if any
 
         if policy['compliant'] == True:
             compliant_windows_policies.append(policy)